@@ -1,13 +1,32 @@
+import atexit
+import copy
+import os
+import signal
 import pickle
+import random
 import socket
 import time
+import traceback
 import uuid
-from queue import Queue
-from threading import local, Thread
+import zlib
+from collections import deque, OrderedDict
+from concurrent.futures import (Future, InvalidStateError, ProcessPoolExecutor,
+                                ThreadPoolExecutor)
+from contextlib import contextmanager
+from functools import partial
+from multiprocessing import Process
+from queue import Empty, Full
+from concurrent.futures import wait as wait_futures
+from threading import (Condition, Event, get_ident, local, Lock, Thread,
+                       current_thread, main_thread)
 
 import pika
 import pika.exceptions
 
+from utils.fingerprints import BloomFilter, FingerprintSet
+from utils import framing, serializers
+from utils.journal import Journal
+from utils.lanes import LaneQueue, TokenBucket
 from utils.queues import declare_queues
 
 
@@ -20,54 +39,389 @@ class Config(object):
         # self.log = g.log
         self.amqp_virtual_host = g['amqp_virtual_host']
         self.amqp_logging = g['amqp_logging']
-        # self.stats = g.stats
+        # 流水线发布时允许的最大未确认消息数, 为1时退化为逐条同步确认
+        self.amqp_confirm_window = int(g.get('amqp_confirm_window', 256))
+        # 发布线程每批合并处理的最大消息数和时间(秒)
+        self.amqp_worker_batch_size = int(g.get('amqp_worker_batch_size', 1000))
+        self.amqp_worker_batch_time = float(g.get('amqp_worker_batch_time', 0.05))
+        # 发布线程数量，每个线程有自己的连接和通道
+        self.amqp_worker_count = int(g.get('amqp_worker_count', 4))
+        # 每个发布线程队列中每个通道的最大任务数(0为不限制)，可以按通道单独设置
+        # {lane: size}；以及通道满时的处理方式
+        self.amqp_worker_queue_size = int(g.get('amqp_worker_queue_size', 10000))
+        self.amqp_lane_queue_sizes = dict(g.get('amqp_lane_queue_sizes') or {})
+        self.amqp_overflow_policy = g.get('amqp_overflow_policy', 'block')
+        # 磁盘溢出日志的目录、段文件大小，以及恢复连接后重新发布的速度(条/秒, 0为不限速)
+        # 相对路径相对于本模块所在的目录，不随进程的工作目录变化；为空时不写入磁盘
+        spill_dir = g.get('amqp_spill_dir', 'amqp_spill')
+        self.amqp_spill_dir = spill_dir and os.path.join(
+            os.path.dirname(os.path.abspath(__file__)), spill_dir)
+        self.amqp_spill_segment_size = int(
+            g.get('amqp_spill_segment_size', 64 * 1024 * 1024))
+        self.amqp_spill_replay_rate = float(g.get('amqp_spill_replay_rate', 1000))
+        # 进程退出时等待发布线程发出剩余消息的最长时间(秒)
+        self.amqp_close_timeout = float(g.get('amqp_close_timeout', 10))
+        # add_kw使用的序列化方式(pickle/json/msgpack)，以及超过多少字节时使用的压缩方式(zlib/lz4)
+        self.amqp_codec = g.get('amqp_codec', 'pickle')
+        self.amqp_compression = g.get('amqp_compression') or None
+        self.amqp_compress_threshold = int(g.get('amqp_compress_threshold', 1024))
+        # add_records 打包时每个消息体的最大字节数
+        self.amqp_record_body_size = int(g.get('amqp_record_body_size', 64 * 1024))
+        # heartbeat间隔(秒, 0为关闭)，以及重连时指数退避的初始和最大等待时间
+        self.amqp_heartbeat = int(g.get('amqp_heartbeat', 60))
+        self.amqp_reconnect_base_delay = float(g.get('amqp_reconnect_base_delay', 0.5))
+        self.amqp_reconnect_max_delay = float(g.get('amqp_reconnect_max_delay', 30))
+        # 连接池的连接数，以及每个连接上最多同时借出的通道数
+        self.amqp_pool_size = int(g.get('amqp_pool_size', 8))
+        self.amqp_pool_max_channels = int(g.get('amqp_pool_max_channels', 4))
+        # 发布通道(lane)的限速(条/秒)：按通道 {lane: rate}，按路由键 {routing_key: rate}
+        self.amqp_lane_rates = dict(g.get('amqp_lane_rates') or {})
+        self.amqp_routing_key_rates = dict(g.get('amqp_routing_key_rates') or {})
+        # 没有指定lane时，路由键默认使用的发布通道 {routing_key: lane}
+        self.amqp_routing_key_lanes = dict(g.get('amqp_routing_key_lanes') or {})
+        # stats.Stats 实例，为None时不记录统计信息
+        self.stats = g.get('stats')
         self.queues = g["queues"]
 
 
+class PublishDroppedError(Exception):
+    """发布队列已满，消息按drop_oldest策略被丢弃"""
+
+
+class Spilled(object):
+    """发布返回的Future以这个值(而不是broker确认的delivery tag)结束时，消息还没有
+    被broker确认，而是写入了磁盘日志，之后由 replay_spill() 重新发布"""
+
+
+class WorkerClosedError(Exception):
+    """发布线程已经关闭，不再接受新的任务"""
+
+
+OVERFLOW_BLOCK = 'block'
+OVERFLOW_DROP_OLDEST = 'drop_oldest'
+OVERFLOW_SPILL = 'spill'
+
+# 发布通道，优先级从高到低：发布线程总是先发出优先级高的通道中的消息
+LANE_REALTIME = 'realtime'
+LANE_NORMAL = 'normal'
+LANE_BULK = 'bulk'
+LANES = (LANE_REALTIME, LANE_NORMAL, LANE_BULK)
+
+
 class Worker:
-    def __init__(self):
-        self.q = Queue()
-        self.t = Thread(target=self._handle)
-        # self.t.setDaemon(True) # 设置为守护线程后，当主线程退出时，守护线程也会立即结束，不管是否执行完成
+    def __init__(self, idle_fn=None, batch_size=1000, batch_time=0.05,
+                 maxsize=0, overflow=OVERFLOW_BLOCK, drop_fn=None,
+                 spill_fn=None, lanes=LANES, lane_limits=None,
+                 key_limits=None, classify=None, error_fn=None, exit_fn=None,
+                 lane_maxsize=None):
+        if overflow not in (OVERFLOW_BLOCK, OVERFLOW_DROP_OLDEST,
+                            OVERFLOW_SPILL):
+            raise ValueError("unknown overflow policy %r" % (overflow,))
+        if overflow == OVERFLOW_SPILL and not spill_fn:
+            raise ValueError("spill overflow policy requires spill_fn")
+
+        # 按优先级分通道的任务队列，classify(item)返回任务的 lane / key(限速用) / cost
+        self.q = LaneQueue(lanes, maxsize, lane_limits=lane_limits,
+                           key_limits=key_limits, lane_maxsize=lane_maxsize)
+        self.classify = classify
+        # 任务所在的通道满时的处理方式:
+        #   block: 阻塞调用方直到通道有空位
+        #   drop_oldest: 丢弃这个通道中最早的任务(交给drop_fn处理)，放入新任务
+        #   spill: 新任务不入队，交给spill_fn(如写入磁盘)
+        self.overflow = overflow
+        self.drop_fn = drop_fn
+        self.spill_fn = spill_fn
+        # 每处理完一批任务调用一次(如等待未确认的消息)，保证join()返回时消息已被broker确认
+        self.idle_fn = idle_fn
+        # 任务抛出异常时以 error_fn(item, error) 通知任务的调用方
+        self.error_fn = error_fn
+        # 线程退出前在线程上调用(如关闭线程自己的连接)
+        self.exit_fn = exit_fn
+        # 一批最多处理的任务数和时间，超过后先等待确认，避免Future迟迟不能完成
+        self.batch_size = batch_size
+        self.batch_time = batch_time
+        self.closed = False
+        # 工作线程已经取出、还没有完成(idle_fn没有成功返回)的任务，
+        # 关闭超时时和队列中剩余的任务一起交给spill_fn/drop_fn
+        self.inflight = []
+        # 线程因为异常重新开始处理的次数，以及连续失败的次数(用于退避)
+        self.restarts = 0
+        self.failures = 0
+        self.lock = Lock()
+        self.t = None
+        self._start()
+
+    def _start(self):
+        self.t = Thread(target=self._run)
+        # 设置为守护线程后，当主线程退出时，守护线程也会立即结束，不管是否执行完成
+        # 需要确保消息发出的调用方应先调用 flush() 或 close()
+        self.t.daemon = True
         self.t.start()
 
+    def _run(self):
+        # 监督循环：出现异常时记录下来，退避后继续处理，线程不会悄悄退出
+        try:
+            while True:
+                try:
+                    self._handle()
+                    return
+                except Exception:
+                    traceback.print_exc()
+                    self.restarts += 1
+                    self.failures += 1
+                    time.sleep(_backoff_delay(self.failures))
+        finally:
+            if self.exit_fn:
+                self.exit_fn()
+
     def _handle(self):
+        """处理任务直到队列被关闭"""
         while True:
-            fn = self.q.get()
             try:
-                fn()
-                self.q.task_done()
-            except Exception as e:
-                import traceback
-                traceback.format_exc()
-                raise e
+                fn = self.q.get()
+            except Empty:
+                # 队列已关闭，且没有可以取出的任务
+                return
+            count = 0
+            deadline = time.time() + self.batch_time
+            try:
+                # 把当前队列中已有的任务一起取出执行，最后只等待一次确认
+                while True:
+                    count += 1
+                    self.inflight.append(fn)
+                    try:
+                        fn()
+                    except Exception as e:
+                        traceback.print_exc()
+                        if self.error_fn:
+                            self.error_fn(fn, e)
+                    if count >= self.batch_size or time.time() >= deadline:
+                        break
+                    try:
+                        fn = self.q.get_nowait()
+                    except Empty:
+                        break
+                if self.idle_fn:
+                    self.idle_fn()
+                # idle_fn出错时保留这些任务：没有确认的消息会在之后重新发布
+                self.inflight = []
+                self.failures = 0
+            finally:
+                # 无论成功与否都标记完成，join()/flush() 不会因为异常而一直等待
+                for _ in range(count):
+                    self.q.task_done()
 
     def do(self, fn, *a, **kw):
-        fn1 = lambda: fn(*a, **kw)
-        self.q.put(fn1)
+        # 用partial而不是lambda，丢弃/溢出时可以从中取回参数
+        item = partial(fn, *a, **kw)
+        put_kw = self.classify(item) if self.classify else {}
+        with self.lock:
+            if self.closed:
+                raise WorkerClosedError(fn)
+            if not self.t.is_alive():
+                # 线程意外退出(如BaseException)：重新启动，已入队的任务不会丢失
+                print('amqp worker thread died, restarting')
+                self.restarts += 1
+                self._start()
+
+        if self.overflow == OVERFLOW_BLOCK:
+            self.q.put(item, **put_kw)
+            return
+
+        while True:
+            try:
+                self.q.put_nowait(item, **put_kw)
+                return
+            except Full:
+                pass
+
+            if self.overflow == OVERFLOW_SPILL:
+                self.spill_fn(item)
+                return
+
+            # 丢弃同一个通道中最早的任务
+            try:
+                dropped = self.q.drop_oldest(
+                    put_kw.get('lane') or self.q.default_lane)
+            except Empty:
+                continue
+            self.q.task_done()
+            if self.drop_fn:
+                self.drop_fn(dropped)
 
     def join(self):
         self.q.join()
 
+    def flush(self, timeout=None):
+        """等待已提交的任务全部完成(消息已被broker确认)，返回是否在timeout秒内完成"""
+        return self.q.join(timeout)
+
+    def close(self, timeout=None):
+        """不再接受新任务，等待已提交的任务完成后结束线程
+
+        timeout秒内没有完成的任务不再执行：有spill_fn时交给spill_fn(如写入磁盘，
+        之后重新发布)，否则交给drop_fn。这包括队列中剩余的任务，以及工作线程已经
+        取出但没有完成的任务(spill_fn/drop_fn 需要跳过其中已经完成的部分)。
+        返回是否所有任务都已完成。
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self.lock:
+            if self.closed:
+                return self.q.join(0)
+            self.closed = True
+
+        done = self.q.join(timeout)
+        self.q.close()
+        self.t.join(None if deadline is None else max(0, deadline - time.time()))
+
+        # 线程可能还卡在任务中(如broker不可用时一直重连)，之后完成的部分由任务自己跳过
+        abandoned = list(self.inflight)
+        for item in abandoned:
+            self._abandon(item)
+        for item in self.q.drain():
+            self._abandon(item)
+            self.q.task_done()
+        return done and not abandoned
+
+    def _abandon(self, item):
+        if self.spill_fn:
+            self.spill_fn(item)
+        elif self.drop_fn:
+            self.drop_fn(item)
+
+
+class WorkerPool(object):
+    """多个发布线程
+
+    任务按路由键哈希分配到固定的线程，同一路由键的消息在同一个线程中按顺序发布；
+    每个线程通过ConnectionManager拥有自己的连接和通道。
+    """
+
+    def __init__(self, size, **worker_kw):
+        self.workers = [Worker(**worker_kw) for _ in range(max(1, size))]
+
+    def get_worker(self, key):
+        if isinstance(key, str):
+            key = key.encode('utf-8')
+        return self.workers[zlib.crc32(key) % len(self.workers)]
+
+    def do(self, key, fn, *a, **kw):
+        self.get_worker(key).do(fn, *a, **kw)
+
+    def join(self):
+        for w in self.workers:
+            w.join()
+
+    def flush(self, timeout=None):
+        deadline = None if timeout is None else time.time() + timeout
+        done = True
+        for w in self.workers:
+            remaining = None if deadline is None else max(0, deadline - time.time())
+            done = w.flush(remaining) and done
+        return done
+
+    def close(self, timeout=None):
+        """关闭所有发布线程，timeout为所有线程共用的总时间(见 Worker.close)"""
+        deadline = None if timeout is None else time.time() + timeout
+        # 先让所有线程同时发出剩余的消息，再逐个关闭
+        self.flush(timeout)
+        done = True
+        for w in self.workers:
+            remaining = None if deadline is None else max(0, deadline - time.time())
+            done = w.close(remaining) and done
+        return done
+
+    def lane_stats(self):
+        """所有发布线程合计的每个通道的统计(见 LaneQueue.lane_stats)"""
+        total = {}
+        for w in self.workers:
+            for lane, stats in w.q.lane_stats().items():
+                merged = total.setdefault(lane, dict.fromkeys(stats, 0))
+                for name, value in stats.items():
+                    merged[name] += value
+        return total
+
+
+def _connection_parameters():
+    """由配置生成连接参数，heartbeat用于让broker和客户端都能及时发现失效的连接"""
+    host, _, port = cfg.amqp_host.partition(':')
+    return pika.ConnectionParameters(
+        host=host,
+        port=int(port or 5672),
+        virtual_host=cfg.amqp_virtual_host.strip() or '/',
+        credentials=pika.PlainCredentials(cfg.amqp_user, cfg.amqp_pass),
+        heartbeat=cfg.amqp_heartbeat,
+        blocked_connection_timeout=cfg.amqp_heartbeat or None)
+
+
+def _backoff_delay(attempt):
+    """第attempt次重连前等待的秒数：指数增长并封顶，再加上随机抖动，
+    避免broker恢复时所有进程同时重连"""
+    delay = min(cfg.amqp_reconnect_max_delay,
+                cfg.amqp_reconnect_base_delay * 2 ** attempt)
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+def _connect(max_attempts=None):
+    """连接broker，失败时按指数退避重试；max_attempts为None时一直重试"""
+    attempt = 0
+    while True:
+        try:
+            connection = pika.BlockingConnection(_connection_parameters())
+        except (socket.error, IOError,
+                pika.exceptions.AMQPConnectionError) as e:
+            print('error connecting to amqp %s @ %s (%r)' %
+                  (cfg.amqp_user, cfg.amqp_host, e))
+            # broker不可用期间，新的发布直接写入磁盘，不再堆积在内存队列中
+            broker_available.clear()
+            if max_attempts is not None and attempt + 1 >= max_attempts:
+                raise
+            time.sleep(_backoff_delay(attempt))
+            attempt += 1
+        else:
+            _on_broker_available()
+            return connection
+
+
+def _is_alive(connection):
+    """检查连接是否可用
+
+    处理一次网络事件(不阻塞)，收发heartbeat；broker已经关闭的连接会在这里
+    抛出异常或变为关闭状态。
+    """
+    if not connection or not connection.is_open:
+        return False
+    try:
+        connection.process_data_events(time_limit=0)
+    except pika.exceptions.AMQPError:
+        return False
+    return connection.is_open
+
 
 class ConnectionManager(local):
-    """应该只有两个线程与 AMQP 通信：工作线程和前台线程（无论是使用队列项还是 shell）。 这个类只是一个包装器，以确保它们获得单独的连接"""
+    """应该只有两个线程与 AMQP 通信：工作线程和前台线程（无论是使用队列项还是 shell）。 这个类只是一个包装器，以确保它们获得单独的连接
+
+    长期运行的线程(发布线程、消费者)使用这里的连接；线程池中的短任务应该通过
+    get_connection_pool().channel() 借用连接，而不是每个线程都保持一个连接。
+    """
 
     def __init__(self):
         self.connection = None
         self.channel = None
+        self.publisher = None
         self.have_init = False
         # self.queues = queues
 
     def get_connection(self):
-        while not self.connection:
-            try:
-                self.connection = pika.BlockingConnection(pika.ConnectionParameters('localhost'))
-                # self.connection.channel().basic_publish()
-            except (socket.error, IOError) as e:
-                print('error connecting to amqp %s @ %s (%r)' %
-                      (cfg.amqp_user, cfg.amqp_host, e))
-                time.sleep(1)
+        # 连接对象还在但已被broker关闭(如heartbeat超时)时，重新连接
+        if self.connection and not self.connection.is_open:
+            self.connection = None
+            self.channel = None
+
+        if not self.connection:
+            self.connection = _connect()
+            # 每个新连接都确认一次拓扑，broker重启后丢失的队列会被重新声明
+            self.have_init = False
 
         if not self.have_init:
             self.init_queue()
@@ -76,154 +430,1143 @@ class ConnectionManager(local):
         return self.connection
 
     def get_channel(self, reconnect=False):
-        # Periodic (and increasing with uptime) errors appearing when
-        # connection object is still present, but appears to have been
-        # closed.  This checks that the the connection is still open.
-        # if self.connection and self.connection.channels is None:
-        #     print("Error: amqp.py, connection object with no available channels.")
-        #     self.connection = None
-
-        if not self.connection or reconnect:
+        if not self.connection or not self.connection.is_open or reconnect:
             self.connection = None
             self.channel = None
             self.get_connection()
 
-        if not self.channel:
+        if not self.channel or not self.channel.is_open:
             self.channel = self.connection.channel()
 
         return self.channel
 
+    def get_publisher(self):
+        """每个线程一个流水线发布器，与该线程的通道绑定"""
+        if not self.publisher:
+            self.publisher = ConfirmPublisher(self, window=cfg.amqp_confirm_window)
+        return self.publisher
+
     def init_queue(self):
-        chan = self.get_channel()
-        # 声明交换机
-        chan.exchange_declare(exchange="reddit_exchange",
-                              exchange_type="direct",
-                              durable=True,
-                              auto_delete=False)
-        # 声明队列
-        for queue in cfg.queues:
-            chan.queue_declare(queue=queue.name,
-                               durable=queue.durable,
-                               exclusive=queue.exclusive,
-                               auto_delete=queue.auto_delete)
-
-        # 队列与交换机,通过binding进行绑定
-        for queue, key in cfg.queues.bindings:
-            chan.queue_bind(routing_key=key,
-                            queue=queue,
-                            exchange="reddit_exchange")
+        declare_topology(self.connection)
+
+    def close(self):
+        """关闭当前线程的连接"""
+        connection = self.connection
+        self.connection = None
+        self.channel = None
+        self.publisher = None
+        if connection and connection.is_open:
+            try:
+                connection.close()
+            except pika.exceptions.AMQPError:
+                pass
+
+
+# 本进程已经在broker上声明过的拓扑：(host, virtual_host) -> 指纹
+_declared_topology = {}
+
+
+def _send_declarations(chan, passive=False):
+    """在底层异步通道上以nowait方式发出所有声明，不等待broker逐条回复
+
+    passive为True时只检查交换机和队列是否存在(绑定无法被动检查)。
+    """
+    # 声明交换机
+    chan.exchange_declare(exchange=cfg.amqp_exchange,
+                          exchange_type="direct",
+                          passive=passive,
+                          durable=True,
+                          auto_delete=False)
+    # 声明队列
+    for queue in cfg.queues:
+        chan.queue_declare(queue=queue.name,
+                           passive=passive,
+                           durable=queue.durable,
+                           exclusive=queue.exclusive,
+                           auto_delete=queue.auto_delete,
+                           arguments=queue.arguments)
+    if passive:
+        return
+
+    # 队列与交换机,通过binding进行绑定
+    for queue, key in sorted(cfg.queues.bindings):
+        chan.queue_bind(routing_key=key,
+                        queue=queue,
+                        exchange=cfg.amqp_exchange)
+
+
+def _pipeline_declarations(connection, passive=False):
+    """在新通道上流水线地发出声明，最后用一次同步调用等待全部完成
+
+    broker按顺序处理同一通道上的命令，任何一条声明失败都会关闭通道，
+    最后的同步调用会因此抛出 ChannelClosedByBroker。
+    """
+    chan = connection.channel()
+    try:
+        _send_declarations(chan._impl, passive=passive)
+        chan.exchange_declare(exchange=cfg.amqp_exchange, passive=True)
+    finally:
+        if chan.is_open:
+            chan.close()
+
+
+def declare_topology(connection):
+    """声明cfg.queues中的交换机、队列和绑定
+
+    本进程在这个broker上已经声明过同样的拓扑时(重新连接)，先被动检查交换机和
+    队列是否都还在，都在就不再重复声明；否则流水线地重新声明全部拓扑。
+    无论哪种情况都只需要一次往返。
+    """
+    key = (cfg.amqp_host, cfg.amqp_virtual_host.strip() or '/')
+    fingerprint = cfg.queues.fingerprint(cfg.amqp_exchange)
+    # 排他或自动删除的队列随连接消失，每个连接都要重新声明
+    cacheable = cfg.queues.persistent
+
+    if cacheable and _declared_topology.get(key) == fingerprint:
+        try:
+            _pipeline_declarations(connection, passive=True)
+            return False
+        except pika.exceptions.ChannelClosedByBroker as e:
+            print('amqp topology changed on broker (%r), redeclaring' % (e,))
+
+    _pipeline_declarations(connection)
+    if cacheable:
+        _declared_topology[key] = fingerprint
+    return True
+
+
+class PooledConnection(object):
+    """连接池中的一个连接，以及其上空闲的通道"""
+
+    def __init__(self):
+        self.connection = None
+        self.idle_channels = []
+        # 借出该连接的线程和借出的通道数；BlockingConnection不是线程安全的，
+        # 同一时间只能由一个线程使用，但这个线程可以同时借用多个通道
+        self.owner = None
+        self.leases = 0
+        self.last_used = time.time()
+
+    def close(self):
+        self.idle_channels = []
+        if self.connection and self.connection.is_open:
+            try:
+                self.connection.close()
+            except pika.exceptions.AMQPError:
+                pass
+        self.connection = None
+
+
+class ConnectionPool(object):
+    """有上限的连接池，供线程池中的任务借用通道
+
+        with get_connection_pool().channel() as chan:
+            chan.basic_publish(...)
+
+    最多size个连接，按需建立。借出通道时整个连接归借用线程所有，直到该线程
+    归还所有通道，其他线程借用时使用别的连接，连接都被占用时等待；同一线程
+    嵌套借用时在同一连接上最多打开max_channels个通道。归还的通道留在连接上
+    下次复用，不必每次重新打开。
+
+    借出前检查连接是否可用，空闲超过heartbeat一半时间的连接先处理一次网络事件；
+    后台线程定期为空闲连接收发heartbeat，及时发现并关闭失效的连接。
+    """
+
+    def __init__(self, size=8, max_channels=4, check_interval=None):
+        self.size = max(1, size)
+        self.max_channels = max(1, max_channels)
+        if check_interval is None:
+            check_interval = (cfg.amqp_heartbeat / 2.0
+                              if cfg.amqp_heartbeat else 0)
+        self.check_interval = check_interval
+        self.cond = Condition()
+        self.connections = [PooledConnection() for _ in range(self.size)]
+        self.checker = None
+
+    def _lease(self, timeout):
+        me = get_ident()
+        deadline = None if timeout is None else time.time() + timeout
+        with self.cond:
+            while True:
+                # 优先使用本线程已经借用的连接，其次是已连接的空闲连接
+                owned = [pc for pc in self.connections if pc.owner == me]
+                if owned:
+                    pc = owned[0]
+                    if pc.leases >= self.max_channels:
+                        raise RuntimeError("thread already holds %d channels"
+                                           % pc.leases)
+                    break
+                idle = [pc for pc in self.connections if pc.owner is None]
+                if idle:
+                    idle.sort(key=lambda pc: pc.connection is None)
+                    pc = idle[0]
+                    break
+
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    raise TimeoutError("no amqp connection available in pool")
+                self.cond.wait(remaining)
+
+            pc.owner = me
+            pc.leases += 1
+            return pc
+
+    def _release(self, pc):
+        with self.cond:
+            pc.leases -= 1
+            if pc.leases <= 0:
+                pc.leases = 0
+                pc.owner = None
+                pc.last_used = time.time()
+                self.cond.notify()
+
+    def checkout(self, timeout=None):
+        """借出一个可用的通道，返回 (pooled_connection, channel)
+
+        必须用 checkin() 归还；连接都被占用时最多等待timeout秒。
+        """
+        if self.check_interval and self.checker is None:
+            self._start_health_checks()
+
+        pc = self._lease(timeout)
+        try:
+            if pc.leases == 1:
+                # 新借出的连接先做健康检查，失效时重新连接
+                stale = time.time() - pc.last_used > self.check_interval
+                if not pc.connection or not pc.connection.is_open or (
+                        stale and not _is_alive(pc.connection)):
+                    pc.close()
+                    pc.connection = _connect()
+                    declare_topology(pc.connection)
+
+            while pc.idle_channels:
+                chan = pc.idle_channels.pop()
+                if chan.is_open:
+                    return pc, chan
+            return pc, pc.connection.channel()
+        except BaseException:
+            if pc.leases == 1:
+                pc.close()
+            self._release(pc)
+            raise
+
+    def checkin(self, pc, chan, broken=False):
+        """归还通道；broken为True时(使用中出现连接错误)关闭这个连接"""
+        if broken or not pc.connection or not pc.connection.is_open:
+            if pc.leases == 1:
+                pc.close()
+        elif chan.is_open and len(pc.idle_channels) < self.max_channels:
+            pc.idle_channels.append(chan)
+        self._release(pc)
+
+    @contextmanager
+    def channel(self, timeout=None):
+        pc, chan = self.checkout(timeout)
+        try:
+            yield chan
+        except pika.exceptions.AMQPConnectionError:
+            self.checkin(pc, chan, broken=True)
+            raise
+        except BaseException:
+            self.checkin(pc, chan)
+            raise
+        else:
+            self.checkin(pc, chan)
+
+    def _start_health_checks(self):
+        with self.cond:
+            if self.checker is None:
+                self.checker = Thread(target=self._check_loop)
+                self.checker.daemon = True
+                self.checker.start()
+
+    def _check_loop(self):
+        while True:
+            time.sleep(self.check_interval)
+            self.check()
+
+    def check(self):
+        """为所有空闲的连接处理一次网络事件(收发heartbeat)，关闭失效的连接"""
+        me = get_ident()
+        with self.cond:
+            idle = [pc for pc in self.connections
+                    if pc.owner is None and pc.connection]
+            # 检查期间占用这些连接，避免与借用线程同时使用
+            for pc in idle:
+                pc.owner = me
+                pc.leases = 1
+
+        for pc in idle:
+            if not _is_alive(pc.connection):
+                print('amqp pool: dropping dead connection to %s' %
+                      (cfg.amqp_host,))
+                pc.close()
+            self._release(pc)
+
+    def close(self):
+        """关闭所有空闲的连接"""
+        with self.cond:
+            for pc in self.connections:
+                if pc.owner is None:
+                    pc.close()
+
+
+def _noop():
+    pass
+
+
+def _resolve_future(future, result=None, error=None):
+    """以result(或异常error)结束future，返回是否结束了它
+
+    已经结束的future不变：发布线程和关闭时的 Worker.close 可能同时结束同一条消息。
+    """
+    try:
+        if not future.running() and not future.set_running_or_notify_cancel():
+            # 已被调用方取消
+            return False
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+    except (RuntimeError, InvalidStateError):
+        return False
+    return True
+
+
+class ConfirmPublisher(object):
+    """流水线发布器
+
+    每个通道只开启一次生产者确认模式，之后发布消息时不再逐条等待broker确认，
+    而是按delivery tag记录最多window条未确认的消息，收到 Basic.Ack / Basic.Nack
+    (以及mandatory消息的 Basic.Return)时再完成对应的Future。
+
+    通道重建后，旧通道上尚未确认的消息会在新通道上重新发布(至少一次语义)。
+    """
+
+    def __init__(self, conn_mgr, window=256):
+        self.conn_mgr = conn_mgr
+        self.window = max(1, window)
+        self.channel = None
+        self.next_tag = 1
+        # delivery_tag -> [future, exchange, routing_key, body, properties, mandatory, returned]
+        self.outstanding = OrderedDict()
+
+    def _get_channel(self):
+        chan = self.conn_mgr.get_channel()
+        if chan is self.channel:
+            return chan
+
+        # 新通道上delivery tag从1重新计数，旧通道上未确认的消息需要重发
+        pending = list(self.outstanding.values())
+        self.outstanding = OrderedDict()
+        self.channel = chan
+        self.next_tag = 1
+
+        # BlockingChannel.confirm_delivery() 会让每次basic_publish都同步等待确认，
+        # 这里直接在底层异步通道上开启确认模式，确认帧到达时回调 _on_confirm
+        chan._impl.confirm_delivery(ack_nack_callback=self._on_confirm)
+        # 同样注册在底层通道上，保证 Basic.Return 先于对应的 Basic.Ack 被处理
+        chan._impl.add_on_return_callback(self._on_return)
+
+        for entry in pending:
+            self._publish(chan, entry)
+        return chan
+
+    def _publish(self, chan, entry):
+        future, exchange, routing_key, body, properties, mandatory, _ = entry
+        entry[-1] = False
+        # 只写入底层连接的发送缓冲区，由之后的 process_data_events 一次性发送，
+        # 避免 BlockingChannel.basic_publish 每条消息都刷新一次
+        chan._impl.basic_publish(exchange=exchange, routing_key=routing_key,
+                                 body=body, properties=properties,
+                                 mandatory=mandatory)
+        self.outstanding[self.next_tag] = entry
+        self.next_tag += 1
+
+    def publish(self, exchange, routing_key, body, properties=None,
+                mandatory=True, future=None, flush=True):
+        """发布一条消息，返回在broker确认后完成的Future"""
+        futures = [future] if future is not None else None
+        return self.publish_many(exchange, routing_key, [body], properties,
+                                 mandatory=mandatory, futures=futures,
+                                 flush=flush)[0]
+
+    def publish_many(self, exchange, routing_key, bodies, properties=None,
+                     mandatory=True, futures=None, flush=True):
+        """批量发布多条消息，返回与bodies一一对应的Future列表
+
+        properties 可以是所有消息共用的一个对象，也可以是与bodies等长的列表。
+        flush=False 时消息只进入发送缓冲区，由调用方之后的 wait_for_confirms() 发出。
+        """
+        if futures is None:
+            futures = [Future() for _ in bodies]
+        if not isinstance(properties, (list, tuple)):
+            properties = [properties] * len(bodies)
+
+        chan = self._get_channel()
+        for body, props, future in zip(bodies, properties, futures):
+            try:
+                future.set_running_or_notify_cancel()
+            except RuntimeError:
+                # 关闭超时时已经写入磁盘日志或被丢弃(见 Worker.close)
+                continue
+            entry = [future, exchange, routing_key, body, props, mandatory, False]
+            self._publish(chan, entry)
+
+            # 未确认的消息达到窗口上限时，阻塞到有确认返回为止
+            while len(self.outstanding) >= self.window:
+                self._process_events(time_limit=1)
+                chan = self.channel
+
+        if flush:
+            self._process_events(time_limit=0)
+        return futures
+
+    def wait_for_confirms(self):
+        """阻塞直到所有已发布的消息都被确认"""
+        while self.outstanding:
+            self._process_events(time_limit=1)
+
+    def _process_events(self, time_limit):
+        try:
+            self.channel.connection.process_data_events(time_limit=time_limit)
+        except (pika.exceptions.AMQPConnectionError,
+                pika.exceptions.AMQPChannelError) as e:
+            print('error waiting for amqp confirms (%r), republishing' % (e,))
+            self.conn_mgr.get_channel(reconnect=True)
+            self._get_channel()
+
+    def _on_confirm(self, frame):
+        method = frame.method
+        nack = isinstance(method, pika.spec.Basic.Nack)
+        if method.multiple:
+            tags = [tag for tag in self.outstanding if tag <= method.delivery_tag]
+        else:
+            tags = [method.delivery_tag]
+
+        for tag in tags:
+            entry = self.outstanding.pop(tag, None)
+            if entry is None:
+                continue
+            future, exchange, routing_key, body = entry[:4]
+            if nack:
+                _resolve_future(future, error=pika.exceptions.NackError([body]))
+            elif entry[-1]:
+                # 开启确认模式并设置 mandatory=True 时，
+                # 无法将消息路由到队列的消息会先被退回，再被确认
+                print('Message was returned')
+                _resolve_future(future,
+                                error=pika.exceptions.UnroutableError([body]))
+            else:
+                _resolve_future(future, tag)
+
+        # 底层通道上的回调不会让 process_data_events 提前返回，
+        # 投递一个空回调以唤醒正在等待确认的发布线程
+        self.channel.connection.add_callback_threadsafe(_noop)
+
+    def _on_return(self, channel, method, properties, body):
+        # 退回的消息没有delivery tag，按发布顺序找到第一条匹配的未确认消息
+        for entry in self.outstanding.values():
+            if (not entry[-1] and entry[2] == method.routing_key
+                    and entry[3] == body):
+                entry[-1] = True
+                break
 
 
 DELIVERY_TRANSIENT = 1
 DELIVERY_DURABLE = 2
 
 
+def _make_properties(message_id=None, delivery_mode=None, headers=None):
+    # 设置消息的基本属性, 。这些属性包括消息的持久性、消息的优先级、消息的时间戳、消息的类型和其他元数据。
+    return pika.BasicProperties(
+        message_id=message_id,
+        delivery_mode=delivery_mode,
+        headers=headers,
+        # 设置消息的有效期为 10 秒
+        # expiration='10000'
+    )
+
+
+# 发布时间(毫秒时间戳)，消费者据此计算消息从发布到处理完的时间
+PUBLISHED_AT_HEADER = 'x-published-at'
+
+
+def _stamp_headers(headers):
+    """在消息头中加上发布时间；重新发布的消息保留最初的发布时间"""
+    headers = dict(headers) if headers else {}
+    headers.setdefault(PUBLISHED_AT_HEADER, int(time.time() * 1000))
+    return headers
+
+
+def _send_stat(queue, name, delta=1):
+    if cfg.stats:
+        cfg.stats.amqp_event(queue, name, delta=delta)
+
+
+def _record_consumed(queue, properties, outcome):
+    """记录一批消息的处理结果(ack/reject等)，以及每条消息从发布到处理完的时间
+
+    properties 为这批消息的 pika.BasicProperties 列表。
+    """
+    stats = cfg.stats
+    if not stats or not properties:
+        return
+
+    stats.amqp_event(queue, outcome, delta=len(properties))
+    now = time.time()
+    for props in properties:
+        published_at = (props.headers or {}).get(PUBLISHED_AT_HEADER)
+        if published_at is not None:
+            stats.amqp_message_age(queue, published_at / 1000.0, now)
+
+
 def _add_item(routing_key, body, message_id=None,
               delivery_mode=DELIVERY_DURABLE, headers=None,
-              exchange=None, send_stats=True):
+              exchange=None, send_stats=True, future=None, lane=None):
+    # lane 只用于发布线程的调度(见 _classify_publish)
     if not exchange:
         exchange = cfg.amqp_exchange
 
-    chan = connection_manager.get_channel()
+    publisher = get_connection_manager().get_publisher()
+    properties = _make_properties(message_id, delivery_mode,
+                                  _stamp_headers(headers))
+    if send_stats:
+        _send_stat(routing_key, 'queue_put')
 
-    properties = pika.BasicProperties(  # 设置消息的基本属性, 。这些属性包括消息的持久性、消息的优先级、消息的时间戳、消息的类型和其他元数据。
-        message_id=message_id,
-        # 设置消息的有效期为 10 秒
-        # expiration='10000'
-    )
+    # 开启用生产者确认模式, 并设置：mandatory=True，
+    # 当无法将消息路由到队列时，返回的Future会以pika.exceptions.UnroutableError结束
+    # 消息由之后的 _wait_for_confirms() 统一发出并等待确认
+    return publisher.publish(exchange, routing_key, body, properties,
+                             mandatory=True, future=future, flush=False)
 
-    def on_return(*args, **kwargs):
-        print("Message1111 returned!", args, kwargs)
 
-    # 设置回调函数
-    chan.add_on_return_callback(on_return)
-    # 启用生产者确认模式
-    chan.confirm_delivery()
-    try:
-        chan.basic_publish(exchange=exchange,
-                           routing_key=routing_key,
-                           body=body, properties=properties, mandatory=True)
-    except pika.exceptions.UnroutableError:
-        # 开启用生产者确认模式：chan.confirm_delivery()
-        # 设置：mandatory=True ，设置为 True，
-        # 当无法将消息路由到队列时，会触发pika.exceptions.UnroutableError异常
-        print('Message was returned')
+def _add_items(routing_key, bodies, message_ids=None,
+               delivery_mode=DELIVERY_DURABLE, headers=None,
+               exchange=None, send_stats=True, futures=None, lane=None):
+    if not exchange:
+        exchange = cfg.amqp_exchange
+
+    publisher = get_connection_manager().get_publisher()
+    bodies = list(bodies)
+    headers = _stamp_headers(headers)
+    if message_ids is None:
+        # 所有消息共用一个属性对象
+        properties = _make_properties(None, delivery_mode, headers)
+    else:
+        properties = [_make_properties(message_id, delivery_mode, headers)
+                      for message_id in message_ids]
+    if send_stats:
+        _send_stat(routing_key, 'queue_put', len(bodies))
+
+    return publisher.publish_many(exchange, routing_key, bodies, properties,
+                                  mandatory=True, futures=futures, flush=False)
+
+
+def _wait_for_confirms():
+    """等待当前线程发布器上所有未确认的消息"""
+    publisher = get_connection_manager().publisher
+    if publisher:
+        publisher.wait_for_confirms()
+
+
+def shard_routing_key(prefix, key):
+    """分片队列族prefix中，key所在分片的路由键"""
+    return cfg.queues.shards[prefix].shard_for(key)
 
 
 def add_item(routing_key, body, message_id=None,
              delivery_mode=DELIVERY_DURABLE, headers=None,
-             exchange=None, send_stats=True):
-    """发布消息"""
+             exchange=None, send_stats=True, shard_key=None, lane=None):
+    """发布消息
+
+    返回一个Future，在broker确认该消息后完成；可通过 add_done_callback 注册回调。
+    broker不可用等情况下消息被写入磁盘日志时，Future的结果为 Spilled。
+    shard_key 不为None时，routing_key是分片队列族的前缀(如"commentstree")，
+    消息按shard_key的一致性哈希发到其中一个分片，同一个shard_key的消息保持顺序。
+    lane 为发布通道(LANE_REALTIME/LANE_NORMAL/LANE_BULK)，默认按 amqp_routing_key_lanes
+    配置，没有配置的为LANE_NORMAL；回填数据等大批量发布应该使用LANE_BULK。
+    """
 
     if exchange is None:  # 交换机
         exchange = cfg.amqp_exchange
+    if shard_key is not None:
+        routing_key = shard_routing_key(routing_key, shard_key)
 
-    worker.do(_add_item, routing_key, body, message_id=message_id,
-              delivery_mode=delivery_mode, headers=headers, exchange=exchange,
-              send_stats=send_stats)
+    future = Future()
+    _submit(routing_key, _add_item, routing_key, body,
+            message_id=message_id, delivery_mode=delivery_mode,
+            headers=headers, exchange=exchange, send_stats=send_stats,
+            future=future, lane=lane)
+    return future
 
 
-def handle_items(queue, callback, ack=True, limit=1, min_size=0,
-                 drain=False, sleep_time=1):
-    """对特定队列中的每个项目调用callback()。
-     handle_items 函数：处理队列中的消息，与 consume_items 不同，它可以一次处理多个消息。可以设置处理的消息数量、最小大小、是否要在处理之后确认消息等"""
-    if limit < min_size:
-        raise ValueError("min_size must be less than limit")
+def add_items(routing_key, bodies, message_ids=None,
+              delivery_mode=DELIVERY_DURABLE, headers=None,
+              exchange=None, send_stats=True, shard_key=None, lane=None):
+    """批量发布消息
 
-    chan = connection_manager.get_channel()
+    所有消息作为一个任务交给发布线程，一次性写出后只等待一次确认。
+    返回与bodies一一对应的Future列表(结果见 add_item)。shard_key 和 lane 的含义与 add_item 相同，
+    限速时这个任务按消息数计算。
+    """
+    bodies = list(bodies)
+    if message_ids is not None and len(message_ids) != len(bodies):
+        raise ValueError("message_ids must be the same length as bodies")
 
-    while True:
+    if exchange is None:
+        exchange = cfg.amqp_exchange
+
+    if shard_key is not None:
+        routing_key = shard_routing_key(routing_key, shard_key)
+
+    futures = [Future() for _ in bodies]
+    _submit(routing_key, _add_items, routing_key, bodies,
+            message_ids=message_ids, delivery_mode=delivery_mode,
+            headers=headers, exchange=exchange, send_stats=send_stats,
+            futures=futures, lane=lane)
+    # 返回副本：调用方修改这个列表不会影响发布线程中的任务
+    return list(futures)
+
+
+def _classify_publish(item):
+    """发布任务所在的通道、限速的键(路由键)和代价(消息数)"""
+    routing_key = item.args[0]
+    lane = (item.keywords.get('lane')
+            or cfg.amqp_routing_key_lanes.get(routing_key, LANE_NORMAL))
+    cost = 1 if item.func is _add_item else max(1, len(item.args[1]))
+    return dict(lane=lane, key=routing_key, cost=cost)
+
+
+def lane_stats():
+    """当前进程发布通道的统计：排队数(depth)、已发布的任务数和消息数、
+    排队时间之和(秒)、被限速和被丢弃的次数"""
+    return get_worker().lane_stats()
 
-        msg = chan.basic_get(queue)  # 允许消费者主动从队列中获取一条消息
-        if not msg and drain:
+
+def _publish_task_futures(item):
+    """取出发布任务(Worker中的partial)对应的Future列表"""
+    if item.keywords.get('future') is not None:
+        return [item.keywords['future']]
+    return item.keywords.get('futures') or []
+
+
+def _drop_publish(item):
+    """drop_oldest策略下被丢弃，或者关闭时没能发出的发布任务"""
+    print('amqp publish queue full, dropping %r' % (item.args[0],))
+    for future in _publish_task_futures(item):
+        _resolve_future(future, error=PublishDroppedError(item.args[0]))
+
+
+def _fail_publish(item, error):
+    """发布任务出错：还没有发出的消息以这个异常结束，已经发出的由发布器等待确认"""
+    for future in _publish_task_futures(item):
+        if not future.running():
+            _resolve_future(future, error=error)
+
+
+def _close_thread_connection():
+    """发布线程退出时关闭它自己的连接"""
+    get_connection_manager().close()
+
+
+_spill_journal = None
+_spill_journal_lock = Lock()
+_replay_lock = Lock()
+# broker是否可用，连接失败时清除，重新连上后设置
+broker_available = Event()
+broker_available.set()
+# 有消息被写入了磁盘日志，等待重新发布
+_spilled = Event()
+
+
+def _get_spill_journal():
+    global _spill_journal
+    with _spill_journal_lock:
+        if _spill_journal is None:
+            _spill_journal = Journal(cfg.amqp_spill_dir, prefix='amqp',
+                                     segment_size=cfg.amqp_spill_segment_size)
+        return _spill_journal
+
+
+def _spill_records(records):
+    journal = _get_spill_journal()
+    for record in records:
+        journal.append(pickle.dumps(record))
+        _spilled.set()
+
+
+def _spill_publish(item):
+    """把发布任务写入磁盘日志，之后由 replay_spill() 重新发布
+
+    用于broker不可用或者发布队列已满(spill策略)的时候。
+    """
+    kw = item.keywords
+    if item.func is _add_item:
+        routing_key, body = item.args
+        bodies, message_ids = [body], [kw.get('message_id')]
+    else:
+        routing_key, bodies = item.args
+        message_ids = kw.get('message_ids')
+
+    # 关闭时发布线程上没有完成的任务(见 Worker.close)：跳过其中已经被确认或出错的消息，
+    # 已经发出但还没有确认的消息也写入日志(至少一次语义)
+    futures = _publish_task_futures(item)
+    if futures:
+        keep = [not future.done() for future in futures]
+        if not any(keep):
             return
-        elif not msg:
-            time.sleep(sleep_time)
-            continue
+        bodies = [body for body, k in zip(bodies, keep) if k]
+        if message_ids is not None:
+            message_ids = [mid for mid, k in zip(message_ids, keep) if k]
+        futures = [future for future, k in zip(futures, keep) if k]
 
-        items = [msg]
+    _spill_records([dict(routing_key=routing_key, bodies=bodies,
+                         message_ids=message_ids,
+                         delivery_mode=kw.get('delivery_mode', DELIVERY_DURABLE),
+                         headers=kw.get('headers'),
+                         exchange=kw.get('exchange'))])
 
-        while len(items) < limit:
-            msg = chan.basic_get(queue)
-            if msg is None:
-                if len(items) < min_size:
-                    time.sleep(sleep_time)
-                else:
-                    break
-            else:
-                items.append(msg)
-        print('handle_items', len(items), items)
+    # 消息已经保存到本地，等重新发布后才会真正被确认
+    for future in futures:
+        _resolve_future(future, Spilled)
+
+
+def _submit(routing_key, fn, *a, **kw):
+    """把发布任务交给发布线程；broker不可用时直接写入磁盘，不阻塞调用方"""
+    if cfg.amqp_spill_dir and not broker_available.is_set():
+        _spill_publish(partial(fn, *a, **kw))
+    else:
+        get_worker().do(routing_key, fn, *a, **kw)
+
+
+def _start_replay():
+    _spilled.clear()
+    t = Thread(target=replay_spill)
+    t.daemon = True
+    t.start()
+
+
+def _on_broker_available():
+    broker_available.set()
+    if (cfg.amqp_spill_dir and os.path.isdir(cfg.amqp_spill_dir)
+            and _get_spill_journal()):
+        _start_replay()
+
+
+def _after_batch():
+    """发布线程每处理完一批任务后调用"""
+    _wait_for_confirms()
+    # 队列满时溢出到磁盘的消息，等发布线程空闲下来后再重新发布
+    if _spilled.is_set() and broker_available.is_set():
+        _start_replay()
+
+
+def replay_spill(rate=None):
+    """按 rate 条/秒 的速度把磁盘日志中的消息重新发布，返回重新发布的消息数
+
+    每个段的消息都被确认后才删除该段；发布失败的消息重新写入日志。
+    replay中途broker再次不可用时停止，剩下的段留到下次重新连接后再处理，
+    已经发布过的部分可能会被重复发布。
+    """
+    if not _replay_lock.acquire(False):
+        # 已经有线程在重新发布
+        return 0
+
+    try:
+        if rate is None:
+            rate = cfg.amqp_spill_replay_rate
+        journal = _get_spill_journal()
+        journal.rotate()
+
+        count = 0
+        start = time.time()
+        for path in journal.sealed_segments():
+            # 同一个目录中的段也可能正被另一个进程重新发布
+            segment = journal.claim(path)
+            if segment is None:
+                continue
+            try:
+                published = []
+                for data in journal.read_segment(path):
+                    if not broker_available.is_set():
+                        return count
+
+                    record = pickle.loads(data)
+                    futures = add_items(record['routing_key'], record['bodies'],
+                                        message_ids=record['message_ids'],
+                                        delivery_mode=record['delivery_mode'],
+                                        headers=record['headers'],
+                                        exchange=record['exchange'],
+                                        # 积压的消息不应该拖慢实时的发布
+                                        lane=LANE_BULK)
+                    published.append((record, futures))
+                    count += len(futures)
+
+                    if rate:
+                        delay = start + count / rate - time.time()
+                        if delay > 0:
+                            time.sleep(delay)
+
+                wait_futures([f for _, futures in published for f in futures])
+                failed = []
+                for record, futures in published:
+                    indexes = [i for i, f in enumerate(futures) if f.exception()]
+                    if indexes:
+                        message_ids = record['message_ids']
+                        failed.append(dict(
+                            record,
+                            bodies=[record['bodies'][i] for i in indexes],
+                            message_ids=message_ids and [message_ids[i]
+                                                         for i in indexes]))
+                _spill_records(failed)
+                journal.remove(path)
+            finally:
+                segment.close()
+        return count
+    finally:
+        _replay_lock.release()
+
+
+# 消息已经处理失败的次数，以及最后一次失败的异常
+ATTEMPTS_HEADER = 'x-attempts'
+ERROR_HEADER = 'x-last-error'
+
+
+def _retry_failed(queue, failures):
+    """把处理失败的消息转移到重试队列，失败次数达到上限的转移到死信队列
+
+    failures 为 (properties, body, error) 列表，body必须是原始的消息体。
+    消息在连接池的一个确认模式通道上发布，全部被broker确认后返回True，调用方
+    此时可以确认原消息；队列没有重试策略或发布失败时返回False，调用方应该拒绝
+    原消息并放回队列。
+    """
+    q = cfg.queues.get(queue)
+    policy = getattr(q, 'retry', None)
+    if not policy or not failures:
+        return False
+
+    messages = []
+    outcomes = {'retry': [], 'dead': []}
+    for properties, body, error in failures:
+        headers = dict(properties.headers or {})
+        attempts = int(headers.get(ATTEMPTS_HEADER, 0)) + 1
+        headers[ATTEMPTS_HEADER] = attempts
+        headers[ERROR_HEADER] = repr(error)[:500]
+        props = copy.copy(properties)
+        props.headers = headers
+
+        if attempts >= policy.max_attempts:
+            routing_key = q.dead_letter_name
+            outcomes['dead'].append(props)
+        else:
+            routing_key = q.retry_queue_name(policy.delay_for(attempts))
+            outcomes['retry'].append(props)
+        messages.append((routing_key, body, props))
+
+    try:
+        with get_connection_pool().channel() as chan:
+            try:
+                chan.confirm_delivery()
+                # 重试队列和死信队列没有绑定，通过默认交换机按队列名投递
+                for routing_key, body, props in messages:
+                    chan.basic_publish(exchange='', routing_key=routing_key,
+                                       body=body, properties=props,
+                                       mandatory=True)
+            finally:
+                # 确认模式的通道不放回连接池
+                if chan.is_open:
+                    chan.close()
+    except pika.exceptions.AMQPError as e:
+        print('error moving failed messages from %s to retry queues (%r)'
+              % (queue, e))
+        return False
+
+    for outcome, properties in outcomes.items():
+        _record_consumed(queue, properties, outcome)
+    return True
+
+
+def _bisect_failures(callback, items, chan, error=None):
+    """整批处理失败时二分重试，找出单独处理也会失败的消息
+
+    error 为整批处理时的异常(已经调用过一次callback)。返回 [(下标, 异常)]，
+    处理成功的部分不会再被调用。
+    """
+    if error is None:
         try:
             callback(items, chan)
+            return []
+        except Exception as e:
+            error = e
 
-            if ack:
-                # ack *all* outstanding messages
-                chan.basic_ack(0, multiple=True)
-                """
-                用于确认消息的接收
-                delivery_tag：表示要确认的消息的交付标签（delivery tag），交付标签是由 RabbitMQ 分配的唯一标识，它标识了要确认的消息。
-                multiple：一个布尔值，用于指定是确认单个消息还是多个消息
-                如果 multiple 为 False，那么只确认指定交付标签（delivery_tag）的消息。
-                如果 multiple 为 True，并且 delivery_tag 为 0，则表示确认所有已接收但未确认的消息。
-                如果 multiple 为 True，并且 delivery_tag 不为 0，则表示确认包括 delivery_tag 在内的所有消息，从 0 到 delivery_tag 之间的所有消息都会被确认。
-                """
-        except:
-            for msg in items:
-                # explicitly reject the items that we've not processed
-                chan.basic_reject(msg[1].delivery_tag, requeue=True)
-                """拒绝消息的接收
-                requeue：一个布尔值，用于指定是否将消息重新放入队列。
-                """
-            raise
+    if len(items) == 1:
+        return [(0, error)]
+
+    mid = len(items) // 2
+    left = _bisect_failures(callback, items[:mid], chan)
+    right = _bisect_failures(callback, items[mid:], chan)
+    return left + [(i + mid, e) for i, e in right]
+
+
+class GracefulStop(object):
+    """在收到SIGTERM(或调用stop())后，让消费循环处理完当前的消息并确认后返回
+
+        with GracefulStop(chan, chan.stop_consuming) as stop:
+            ...
+            if stop.requested: ...
+
+    on_stop在连接线程上调用(通过 add_callback_threadsafe，同时唤醒正在等待消息的
+    process_data_events)。只有主线程可以设置信号处理函数，其他线程中只能用stop()。
+    """
+
+    def __init__(self, chan, on_stop=None, signals=(signal.SIGTERM,)):
+        self.chan = chan
+        self.on_stop = on_stop or _noop
+        self.signals = signals
+        self.event = Event()
+        self.previous = {}
+
+    @property
+    def requested(self):
+        return self.event.is_set()
+
+    def stop(self):
+        if self.event.is_set():
+            return
+        self.event.set()
+        try:
+            self.chan.connection.add_callback_threadsafe(self.on_stop)
+        except pika.exceptions.AMQPError:
+            # 连接已经关闭，消费循环会自己退出
+            pass
+
+    def _on_signal(self, signum, frame):
+        print('amqp: received signal %d, stopping after the current messages'
+              % signum)
+        self.stop()
 
+    def __enter__(self):
+        if current_thread() is main_thread():
+            for signum in self.signals:
+                self.previous[signum] = signal.signal(signum, self._on_signal)
+        return self
+
+    def __exit__(self, *exc):
+        for signum, handler in self.previous.items():
+            signal.signal(signum, handler if handler is not None
+                          else signal.SIG_DFL)
+        self.previous = {}
+
+
+def handle_items(queue, callback, ack=True, limit=1, min_size=0,
+                 drain=False, sleep_time=1, max_wait=0.1, prefetch=None,
+                 decode=False, graceful=True, zero_copy=False):
+    """对特定队列中的每个项目调用callback()。
+     handle_items 函数：处理队列中的消息，与 consume_items 不同，它可以一次处理多个消息。可以设置处理的消息数量、最小大小、是否要在处理之后确认消息等
+
+    消息由broker通过basic_consume按prefetch推送过来，凑够limit条，或者收到第一条后
+    过了max_wait秒(且不少于min_size条)就调用一次callback(items, chan)，
+    items为 (method, properties, body) 列表。
+    sleep_time: 队列为空时每次等待新消息的最长时间
+    prefetch: broker最多推送的未确认消息数，默认为两批(limit * 2)，处理当前批时下一批已在本地
+    decode: 为True时items中的body是按消息头解码后的对象(见decode_body)
+    graceful: 为True时收到SIGTERM后处理并确认当前这一批消息后返回(见GracefulStop)
+    zero_copy: 为True时(且decode为False)items中的body是消息体的memoryview，不复制数据
+    """
+    if limit < min_size:
+        raise ValueError("min_size must be less than limit")
+
+    chan = get_connection_manager().get_channel()
+    chan.basic_qos(prefetch_size=0, prefetch_count=prefetch or limit * 2,
+                   global_qos=False)
+
+    # (item, 原始消息体)，失败的消息要以原始消息体重新发布
+    buffered = deque()
+
+    def _on_message(ch, method, properties, body):
+        buffered.append(((method, properties,
+                          _consumer_body(properties, body, decode, zero_copy)),
+                         body))
+
+    signals = (signal.SIGTERM,) if graceful else ()
+    with GracefulStop(chan, signals=signals) as stop:
+        consumer_tag = chan.basic_consume(queue=queue,
+                                          on_message_callback=_on_message,
+                                          auto_ack=False)
+        try:
+            while not stop.requested:
+                items = []
+                raws = []
+                deadline = None
+                while len(items) < limit:
+                    while buffered and len(items) < limit:
+                        item, raw = buffered.popleft()
+                        items.append(item)
+                        raws.append(raw)
+                    if len(items) >= limit:
+                        break
+
+                    now = time.time()
+                    if not items:
+                        # drain时，prefetch下队列中有消息会立即推送过来，等max_wait即可
+                        timeout = max_wait if drain else sleep_time
+                    elif len(items) < min_size:
+                        timeout = sleep_time
+                    else:
+                        if deadline is None:
+                            deadline = now + max_wait
+                        if now >= deadline:
+                            break
+                        timeout = deadline - now
+
+                    if stop.requested:
+                        # 处理并确认已经取出的消息后返回，其余的放回队列
+                        break
+                    chan.connection.process_data_events(time_limit=timeout)
+                    if drain and not items and not buffered:
+                        return
+                if not items:
+                    break
+
+                try:
+                    callback(items, chan)
+                    failures = []
+                except Exception as e:
+                    traceback.print_exc()
+                    # 二分找出有问题的消息，其余的消息正常处理，不受拖累
+                    failures = _bisect_failures(callback, items, chan, error=e)
+                    print('handle_items: %d of %d messages in %s failed'
+                          % (len(failures), len(items), queue))
+
+                failed = {i for i, _ in failures}
+                succeeded = [msg[1] for i, msg in enumerate(items) if i not in failed]
+                _record_consumed(queue, succeeded, 'ack' if ack else 'handled')
+
+                if failures and not _retry_failed(
+                        queue, [(items[i][1], raws[i], e) for i, e in failures]):
+                    # 无法转移到重试队列：失败的消息放回队列，其余的逐条确认
+                    for i, msg in enumerate(items):
+                        if i in failed:
+                            chan.basic_reject(msg[0].delivery_tag, requeue=True)
+                            """拒绝消息的接收
+                            requeue：一个布尔值，用于指定是否将消息重新放入队列。
+                            """
+                        elif ack:
+                            chan.basic_ack(msg[0].delivery_tag)
+                    _record_consumed(queue, [items[i][1] for i in failed], 'reject')
+                elif ack:
+                    # 只确认到这一批的最后一条，已经预取的下一批消息不受影响；
+                    # 失败的消息已经转移到了重试队列，也一起确认
+                    chan.basic_ack(items[-1][0].delivery_tag, multiple=True)
+                    """
+                    用于确认消息的接收
+                    delivery_tag：表示要确认的消息的交付标签（delivery tag），交付标签是由 RabbitMQ 分配的唯一标识，它标识了要确认的消息。
+                    multiple：一个布尔值，用于指定是确认单个消息还是多个消息
+                    如果 multiple 为 False，那么只确认指定交付标签（delivery_tag）的消息。
+                    如果 multiple 为 True，并且 delivery_tag 为 0，则表示确认所有已接收但未确认的消息。
+                    如果 multiple 为 True，并且 delivery_tag 不为 0，则表示确认包括 delivery_tag 在内的所有消息，从 0 到 delivery_tag 之间的所有消息都会被确认。
+                    """
+                else:
+                    # 由callback负责确认，已经转移到重试队列的消息在这里确认
+                    for i in sorted(failed):
+                        chan.basic_ack(items[i][0].delivery_tag)
+        finally:
+            # 停止消费，把已预取但还没处理的消息放回队列
+            try:
+                chan.basic_cancel(consumer_tag)
+                if ack:
+                    chan.basic_nack(delivery_tag=0, multiple=True, requeue=True)
+                else:
+                    # 交给callback的消息由callback负责确认，只放回还没交出去的消息
+                    for (method, _, _), _ in buffered:
+                        chan.basic_nack(delivery_tag=method.delivery_tag,
+                                        requeue=True)
+            except pika.exceptions.AMQPError:
+                pass
+
+
+class AckCoalescer(object):
+    """在连接线程上合并消息确认
+
+    回调在线程池/进程池中完成后调用complete()，它只记录结果并通过
+    add_callback_threadsafe 安排一次flush()；flush()在连接线程上执行，
+    把这段时间内完成的消息一起确认：从最早投递的消息开始连续完成的部分用一次
+    multiple ack，乱序完成的其余消息逐条确认(避免队头的慢消息占满prefetch窗口)，
+    失败的消息拒绝并放回队列。
+    """
 
-def consume_items(queue, callback, verbose=True):
+    def __init__(self, chan):
+        self.chan = chan
+        self.lock = Lock()
+        # 以下两个只在连接线程上访问
+        self.delivered = deque()  # 按投递顺序排列的delivery tag
+        self.done = {}  # delivery_tag -> True(待确认) / False(已拒绝) / None(已确认)
+        # 其他线程完成的 (delivery_tag, ok)
+        self.completed = []
+        self.scheduled = False
+
+    def deliver(self, delivery_tag):
+        self.delivered.append(delivery_tag)
+
+    def complete(self, delivery_tag, ok):
+        with self.lock:
+            self.completed.append((delivery_tag, ok))
+            if self.scheduled:
+                return
+            self.scheduled = True
+        self.chan.connection.add_callback_threadsafe(self.flush)
+
+    def flush(self):
+        with self.lock:
+            completed, self.completed = self.completed, []
+            self.scheduled = False
+
+        for tag, ok in completed:
+            if not ok:
+                self.chan.basic_reject(delivery_tag=tag, requeue=True)
+            self.done[tag] = ok
+
+        last = None
+        while self.delivered and self.delivered[0] in self.done:
+            tag = self.delivered.popleft()
+            if self.done.pop(tag):
+                last = tag
+        if last is not None:
+            self.chan.basic_ack(delivery_tag=last, multiple=True)
+
+        for tag, ok in self.done.items():
+            if ok:
+                self.chan.basic_ack(delivery_tag=tag)
+                self.done[tag] = None
+
+
+def consume_items(queue, callback, verbose=True, concurrency=0, pool='thread',
+                  prefetch_count=1000, decode=False, graceful=True,
+                  zero_copy=False):
     """
     消费者函数，用于消费队列中的消息
     :param queue: 要消费的队列的名称
     :param callback: 处理每条消息的回调函数
+    :param concurrency: 大于0时，回调交给有concurrency个worker的线程池/进程池并发执行，
+        确认在连接线程上合并进行(见AckCoalescer)；回调出现异常的消息被放回队列
+    :param pool: 'thread' 或 'process'，进程池要求callback可以被pickle
+    :param prefetch_count: broker最多推送的未确认消息数，并发执行时至少为2倍concurrency
+    :param decode: 为True时传给callback的是按消息头解码后的对象(见decode_body)；
+        使用进程池时分帧消息体的记录是列表，而不是迭代器
+    :param graceful: 为True时收到SIGTERM后停止消费，正在处理的消息完成并确认后返回，
+        已预取但还没处理的消息放回队列(见GracefulStop)
+    :param zero_copy: 为True时(且decode为False)传给callback的是消息体的memoryview，
+        不复制数据；memoryview不能被pickle，不能与进程池一起使用
     """
-    chan = connection_manager.get_channel()
+    if zero_copy and concurrency and pool == 'process':
+        raise ValueError("zero_copy bodies cannot be sent to a process pool")
+
+    chan = get_connection_manager().get_channel()
+    signals = (signal.SIGTERM,) if graceful else ()
+
+    if concurrency:
+        prefetch_count = max(prefetch_count, concurrency * 2)
 
     # configure the amount of data rabbit will send down to our buffer before
     # we're ready for it (to reduce network latency). by default, it will send
@@ -232,36 +1575,133 @@ def consume_items(queue, callback, verbose=True):
         # 预取窗口的大小，通常设置为0表示不限制消息的大小
         prefetch_size=0,
         # 最大预取消息数量，表示一次从队列中获取的消息数量。
-        prefetch_count=1000,
+        prefetch_count=prefetch_count,
         # 一个布尔值，表示是否将配置应用于所有通道，通常为 False，只应用于当前通道。
         global_qos=False
     )
 
-    def _callback(ch, method, properties, body):
-        print('_callback:', body, method, properties.__dict__, )
+    if concurrency:
+        return _consume_items_concurrently(chan, queue, callback, concurrency,
+                                           pool, verbose, decode, zero_copy,
+                                           signals)
 
-        ret = callback(body)
-        if body.decode('utf-8') == 'message_0005':
-            # 手动拒绝消息
+    stop = GracefulStop(chan, chan.stop_consuming, signals=signals)
+
+    def _callback(ch, method, properties, body):
+        if verbose:
+            print('_callback:', body, method, properties.__dict__, )
+        if stop.requested:
+            # 正在停止：之后收到的消息不再处理，放回队列
             ch.basic_reject(delivery_tag=method.delivery_tag, requeue=True)
-            """
-            delivery_tag: 表示要拒绝的消息的唯一标识符
-            requeue=True: 表示是否将拒绝的消息重新放回队列, 如果设置为 False，消息将被丢弃, 如果设置为 True，拒绝的消息将重新进入队列，可以被其他消费者重新处理；
-            """
-        else:
-            # 手动确认消息
-            ch.basic_ack(delivery_tag=method.delivery_tag)
+            return
+
+        try:
+            ret = callback(_consumer_body(properties, body, decode, zero_copy))
+        except Exception as e:
+            traceback.print_exc()
+            if _retry_failed(queue, [(properties, body, e)]):
+                # 已经转移到重试队列(或死信队列)，确认原消息
+                ch.basic_ack(delivery_tag=method.delivery_tag)
+            else:
+                # 手动拒绝消息
+                ch.basic_reject(delivery_tag=method.delivery_tag, requeue=True)
+                """
+                delivery_tag: 表示要拒绝的消息的唯一标识符
+                requeue=True: 表示是否将拒绝的消息重新放回队列, 如果设置为 False，消息将被丢弃, 如果设置为 True，拒绝的消息将重新进入队列，可以被其他消费者重新处理；
+                """
+                _record_consumed(queue, [properties], 'reject')
+            return
+
+        # 手动确认消息
+        ch.basic_ack(delivery_tag=method.delivery_tag)
+        _record_consumed(queue, [properties], 'ack')
         return ret
 
     # 轮询队列以获取新消息
     chan.basic_consume(queue=queue, on_message_callback=_callback, auto_ack=False)
     # 是一个阻塞调用，它会持续从队列中接收消息并调用指定的回调函数进行处理，直到程序手动停止或出现错误
-    chan.start_consuming()
+    with stop:
+        chan.start_consuming()
+
+
+def _consume_items_concurrently(chan, queue, callback, concurrency, pool,
+                                verbose, decode, zero_copy, signals):
+    if pool == 'thread':
+        executor = ThreadPoolExecutor(max_workers=concurrency)
+    elif pool == 'process':
+        executor = ProcessPoolExecutor(max_workers=concurrency)
+    else:
+        raise ValueError("unknown pool %r" % (pool,))
+
+    acks = AckCoalescer(chan)
+    stop = GracefulStop(chan, chan.stop_consuming, signals=signals)
+
+    def _on_done(delivery_tag, properties, body, future):
+        if future.cancelled():
+            # 停止时还没有开始处理的消息，放回队列
+            acks.complete(delivery_tag, False)
+            return
+        error = future.exception()
+        if error is None:
+            acks.complete(delivery_tag, True)
+            _record_consumed(queue, [properties], 'ack')
+            return
+
+        print('error processing message %d: %r' % (delivery_tag, error))
+        # 转移到重试队列成功时确认原消息，否则拒绝并放回队列
+        moved = _retry_failed(queue, [(properties, body, error)])
+        acks.complete(delivery_tag, moved)
+        if not moved:
+            _record_consumed(queue, [properties], 'reject')
+
+    def _callback(ch, method, properties, body):
+        if verbose:
+            print('_callback:', body, method)
+        acks.deliver(method.delivery_tag)
+        if stop.requested:
+            # 正在停止：不再提交新的消息，放回队列
+            acks.complete(method.delivery_tag, False)
+            return
+        future = executor.submit(
+            callback, _consumer_body(properties, body, decode, zero_copy,
+                                     picklable=pool == 'process'))
+        future.add_done_callback(partial(_on_done, method.delivery_tag,
+                                         properties, body))
+
+    chan.basic_consume(queue=queue, on_message_callback=_callback, auto_ack=False)
+    try:
+        with stop:
+            chan.start_consuming()
+    finally:
+        # 已提交但还没开始处理的消息(最多prefetch_count条)取消并放回队列，
+        # 只等待正在处理的消息完成，再把它们的确认发出去
+        executor.shutdown(wait=True, cancel_futures=True)
+        if chan.is_open:
+            chan.connection.process_data_events(time_limit=0)
+
+
+def consume_sharded(prefix, callback, handler=None, shards=None, **kw):
+    """为分片队列族prefix的每个分片启动一个消费进程，阻塞直到所有进程退出
+
+    handler 为每个进程中运行的消费函数(默认consume_items，也可以是handle_items)，
+    以 handler(queue_name, callback, **kw) 的方式调用；shards 指定只消费其中几个分片。
+    """
+    names = cfg.queues.shards[prefix].names
+    if shards is not None:
+        names = [names[i] for i in shards]
+
+    processes = [Process(target=handler or consume_items,
+                         args=(name, callback), kwargs=kw, name=name)
+                 for name in names]
+    for p in processes:
+        p.start()
+    for p in processes:
+        p.join()
 
 
 def empty_queue(queue):
     """清空指定队列中的所有消息"""
-    chan = connection_manager.get_channel()
+    chan = get_connection_manager().get_channel()
     chan.queue_purge(queue)
 
 
@@ -275,45 +1715,167 @@ def black_hole(queue):
 
 
 def add_kw(routing_key, **kw):
-    """允许您以结构化的方式传递数据"""
-    add_item(routing_key, pickle.dumps(kw))
+    """允许您以结构化的方式传递数据
 
+    序列化方式和压缩方式由 amqp_codec / amqp_compression 配置，并记录在消息头中，
+    消费者可以用 decode_body() 或 consume_items/handle_items 的 decode=True 自动解码。
+    """
+    body, headers = serializers.encode(
+        kw, codec=cfg.amqp_codec, compression=cfg.amqp_compression,
+        compress_threshold=cfg.amqp_compress_threshold)
+    return add_item(routing_key, body, headers=headers)
 
-def dedup_queue(queue, rk=None, limit=100 * 1000,
-                delivery_mode=DELIVERY_DURABLE):
-    """尝试通过删除队列中的重复消息来减小队列的大小
-    rk:  重新投递到队列的名称
-    delivery_mode: 交付模式，默认为 DELIVERY_DURABLE。
+
+def add_records(routing_key, records, codec=None, max_body_size=None,
+                max_records=0, headers=None, **kw):
+    """把大量小记录打包成少数几个消息发布，减少broker逐条处理消息的开销
+
+    records 为bytes的序列；codec 不为None时每条记录是一个对象，按codec逐条序列化。
+    每个消息体最多max_body_size字节(默认 amqp_record_body_size)、max_records条，
+    记录以长度前缀分帧(见 utils.framing)。其余参数与 add_items 相同，返回每个消息
+    体对应的Future列表。消费者用 decode=True 或 decode_body() 得到逐条记录的迭代器。
+    """
+    headers = dict(headers or {})
+    headers[framing.FRAMING_HEADER] = framing.FRAMING_U32
+    if codec is not None:
+        headers[serializers.CODEC_HEADER] = codec
+        records = (serializers.encode(record, codec=codec)[0]
+                   for record in records)
+    bodies = list(framing.pack_bodies(
+        records, max_body_size or cfg.amqp_record_body_size, max_records))
+    return add_items(routing_key, bodies, headers=headers, **kw)
+
+
+def decode_body(properties, body):
+    """按消息头中记录的序列化方式解码消息体，没有记录时原样返回
+
+    分帧的消息体(见add_records)返回逐条记录的迭代器，没有序列化的记录是消息体的
+    memoryview切片。
     """
-    chan = connection_manager.get_channel()
+    headers = properties.headers
+    if headers and framing.FRAMING_HEADER in headers:
+        records = framing.iter_records(body)
+        if serializers.CODEC_HEADER not in headers:
+            return records
+        return (serializers.decode(bytes(record), headers) for record in records)
+    return serializers.decode(body, headers)
 
-    if rk is None:
-        rk = queue
 
-    bodies = set()
+def _consumer_body(properties, body, decode, zero_copy, picklable=False):
+    """交给消费者回调的消息体
+
+    picklable=True(进程池)时分帧消息体的记录被读成列表，memoryview复制成bytes，
+    因为迭代器和memoryview都不能被pickle。
+    """
+    if decode:
+        decoded = decode_body(properties, body)
+        if picklable and properties.headers and \
+                framing.FRAMING_HEADER in properties.headers:
+            return [bytes(r) if isinstance(r, memoryview) else r
+                    for r in decoded]
+        return decoded
+    if zero_copy:
+        return memoryview(body)
+    return body
 
-    while True:
-        method, properties, body = chan.basic_get(queue)
-        if body is None:
-            break
 
-        if body not in bodies:
-            bodies.add(body)
-        limit -= 1
-        if limit <= 0:
-            break
-        elif limit % 1000 == 0:
-            print(limit)
+# 决定消息体格式的消息头：消息体相同但格式不同的消息不是重复的
+_FORMAT_HEADERS = (serializers.CODEC_HEADER, serializers.COMPRESSION_HEADER,
+                   framing.FRAMING_HEADER)
 
-    print("Grabbed %d unique bodies" % (len(bodies),))
 
-    if bodies:
-        for body in bodies:
-            _add_item(rk, body, delivery_mode=delivery_mode)
+def _dedup_key(properties, body):
+    headers = properties.headers or {}
+    fmt = '\0'.join(str(headers.get(h) or '') for h in _FORMAT_HEADERS)
+    return fmt.encode('utf-8') + b'\0' + bytes(body)
 
-        worker.join()
 
-        chan.basic_ack(0, multiple=True)
+def dedup_queue(queue, rk=None, limit=100 * 1000,
+                delivery_mode=DELIVERY_DURABLE, mode='fingerprint',
+                error_rate=0.001, batch_size=1000):
+    """尝试通过删除队列中的重复消息来减小队列的大小
+    rk:  重新投递到队列的名称
+    delivery_mode: 交付模式，默认为 DELIVERY_DURABLE。
+    mode: 判断重复的方式，'fingerprint' 只保存每条消息的64位摘要(FingerprintSet)；
+        'bloom' 使用误判率为error_rate的布隆过滤器，更省内存，但误判的消息会被丢掉
+    batch_size: 每处理这么多条消息，就把其中不重复的重新发布，等确认后再确认原消息
+
+    消息以流的方式处理，内存中只有过滤器和当前一批消息。只处理开始时队列中已有的
+    消息(最多limit条)，rk与queue相同时重新发布的消息不会被再次读到。
+    消息体和codec/压缩/分帧消息头都相同的才算重复，重新发布时保留原来的属性。
+    """
+    chan = get_connection_manager().get_channel()
+
+    if rk is None:
+        rk = queue
+
+    # 开始时队列中的消息数
+    message_count = chan.queue_declare(queue, passive=True).method.message_count
+    limit = min(limit, message_count)
+    if limit <= 0:
+        print("Grabbed 0 unique bodies")
+        return 0
+
+    if mode == 'fingerprint':
+        seen = FingerprintSet(limit)
+    elif mode == 'bloom':
+        seen = BloomFilter(limit, error_rate)
+    else:
+        raise ValueError("unknown dedup mode %r" % (mode,))
+
+    chan.basic_qos(prefetch_size=0, prefetch_count=batch_size * 2,
+                   global_qos=False)
+
+    def _flush(messages, last_tag):
+        if messages:
+            # 保留原来的属性：codec、压缩和分帧的消息头决定了消息体怎样解码
+            properties = []
+            for _, props in messages:
+                props = copy.copy(props)
+                props.delivery_mode = delivery_mode
+                properties.append(props)
+            _send_stat(rk, 'queue_put', len(messages))
+            get_connection_manager().get_publisher().publish_many(
+                cfg.amqp_exchange, rk, [body for body, _ in messages],
+                properties, mandatory=True, flush=False)
+            # 所有重新投递的消息都被broker确认后才能ack原消息
+            _wait_for_confirms()
+        chan.basic_ack(last_tag, multiple=True)
+
+    unique = []
+    last_tag = None
+    processed = 0
+    total_unique = 0
+    try:
+        for method, properties, body in chan.consume(queue,
+                                                     inactivity_timeout=1):
+            if method is None:
+                # 队列已经空了
+                break
+
+            if seen.add(_dedup_key(properties, body)):
+                unique.append((body, properties))
+            last_tag = method.delivery_tag
+            processed += 1
+
+            if processed % batch_size == 0:
+                total_unique += len(unique)
+                _flush(unique, last_tag)
+                unique, last_tag = [], None
+            if processed % 1000 == 0:
+                print(limit - processed)
+            if processed >= limit:
+                break
+
+        if last_tag is not None:
+            total_unique += len(unique)
+            _flush(unique, last_tag)
+    finally:
+        # 取消消费者，已预取但没有处理的消息放回队列
+        chan.cancel()
+
+    print("Grabbed %d unique bodies" % (total_unique,))
+    return total_unique
 
 
 config_data = {
@@ -323,24 +1885,158 @@ config_data = {
     'amqp_virtual_host': ' /',
     'amqp_logging': 'false',
     'shard_commentstree_queues': 'false',
-    'queues': declare_queues()
+    'amqp_confirm_window': 256,
+    'amqp_worker_batch_size': 1000,
+    'amqp_worker_batch_time': 0.05,
+    'amqp_worker_count': 4,
+    'amqp_worker_queue_size': 10000,
+    'amqp_lane_queue_sizes': {},
+    'amqp_overflow_policy': 'block',
+    'amqp_spill_dir': 'amqp_spill',
+    'amqp_close_timeout': 10,
+    'amqp_spill_segment_size': 64 * 1024 * 1024,
+    'amqp_spill_replay_rate': 1000,
+    'amqp_codec': 'pickle',
+    'amqp_compression': None,
+    'amqp_compress_threshold': 1024,
+    'amqp_record_body_size': 64 * 1024,
+    'amqp_heartbeat': 60,
+    'amqp_reconnect_base_delay': 0.5,
+    'amqp_reconnect_max_delay': 30,
+    'amqp_pool_size': 8,
+    'amqp_pool_max_channels': 4,
+    'commentstree_shard_count': 10,
+    # 消费失败后的重试延迟(毫秒)，以及进入死信队列前的最大处理次数
+    'amqp_retry_delays': '1000,10000,60000,300000',
+    'amqp_max_attempts': 5,
+    # 发布通道的限速(条/秒)，如 {'bulk': 2000}；以及路由键默认的发布通道
+    'amqp_lane_rates': {},
+    'amqp_routing_key_rates': {},
+    'amqp_routing_key_lanes': {'vote_comment_q': 'realtime'},
 }
+config_data['queues'] = declare_queues(config_data)
+
+
+def _make_worker():
+    # 令牌桶由所有发布线程共用，限制的是整个进程的发布速度
+    lane_limits = {lane: TokenBucket(rate)
+                   for lane, rate in cfg.amqp_lane_rates.items() if rate}
+    key_limits = {key: TokenBucket(rate)
+                  for key, rate in cfg.amqp_routing_key_rates.items() if rate}
+    return WorkerPool(cfg.amqp_worker_count,
+                      idle_fn=_after_batch,
+                      batch_size=cfg.amqp_worker_batch_size,
+                      batch_time=cfg.amqp_worker_batch_time,
+                      maxsize=cfg.amqp_worker_queue_size,
+                      lane_maxsize=cfg.amqp_lane_queue_sizes,
+                      overflow=cfg.amqp_overflow_policy,
+                      drop_fn=_drop_publish,
+                      spill_fn=_spill_publish if cfg.amqp_spill_dir else None,
+                      lane_limits=lane_limits,
+                      key_limits=key_limits,
+                      classify=_classify_publish,
+                      error_fn=_fail_publish,
+                      exit_fn=_close_thread_connection)
+
+
+def _make_pool():
+    return ConnectionPool(cfg.amqp_pool_size,
+                          max_channels=cfg.amqp_pool_max_channels)
+
+
+def _reset_singletons():
+    """丢弃发布线程、连接和连接池，下次使用时重新创建
+
+    fork出的子进程不能共用父进程的连接和磁盘日志的活动段，父进程的发布线程
+    也不会被复制过来。
+    """
+    global _worker, _connection_manager, _connection_pool, _spill_journal
+    _connection_manager = None
+    _connection_pool = None
+    _worker = None
+    # 父进程的活动段(以及它的文件锁)只属于父进程，子进程写入自己的新段
+    _spill_journal = None
+
 
-worker = Worker()
 cfg = Config(config_data)
-connection_manager = ConnectionManager()
+# 发布线程、连接和连接池在第一次使用时才创建，导入本模块没有副作用
+_worker = None
+_connection_manager = None
+_connection_pool = None
+_singletons_lock = Lock()
+os.register_at_fork(after_in_child=_reset_singletons)
+
+
+def _singleton(name, factory):
+    instance = globals()[name]
+    if instance is None:
+        with _singletons_lock:
+            instance = globals()[name]
+            if instance is None:
+                instance = globals()[name] = factory()
+    return instance
+
 
-# connection_manager.get_connection()
+def get_worker():
+    """发布线程池，第一次调用时启动发布线程"""
+    return _singleton('_worker', _make_worker)
 
-# worker.join()  # 阻塞当前线程
 
-for i in range(10):
-    add_item('vote_comment_q', f"message_000{i}", message_id=str(uuid.uuid4()))
+def get_connection_manager():
+    return _singleton('_connection_manager', ConnectionManager)
 
 
-#
-# for i in range(100):
-#     add_item('vote_comment_q', f"message_000{i}")
+def get_connection_pool():
+    return _singleton('_connection_pool', _make_pool)
+
+
+_lazy_globals = {
+    'worker': get_worker,
+    'connection_manager': get_connection_manager,
+    'connection_pool': get_connection_pool,
+}
+
+
+def __getattr__(name):
+    # 兼容 amqp.worker / amqp.connection_manager / amqp.connection_pool 的用法
+    if name not in _lazy_globals:
+        raise AttributeError("module %r has no attribute %r" % (__name__, name))
+    return _lazy_globals[name]()
+
+
+def flush(timeout=None):
+    """等待已经提交的消息全部被broker确认，返回是否在timeout秒内完成"""
+    if _worker is None:
+        return True
+    return _worker.flush(timeout)
+
+
+def close(timeout=None):
+    """停止发布线程：等待已提交的消息发出并被确认后，关闭发布线程和连接池的连接
+
+    timeout秒内没能发出的消息写入磁盘日志(amqp_spill_dir)，下次启动后重新发布；
+    没有配置日志目录时以 PublishDroppedError 结束。返回是否所有消息都已确认。
+    之后再调用 add_item 会重新启动发布线程。
+    """
+    global _worker, _connection_pool
+    with _singletons_lock:
+        worker, _worker = _worker, None
+        pool, _connection_pool = _connection_pool, None
+    done = worker.close(timeout) if worker is not None else True
+    if pool is not None:
+        pool.close()
+    if _connection_manager is not None:
+        _connection_manager.close()
+    return done
+
+
+def _close_at_exit():
+    # 发布线程是守护线程，进程退出前把队列中的消息发完
+    if _worker is not None and not close(cfg.amqp_close_timeout):
+        print('amqp: not all messages were confirmed before exit')
+
+
+atexit.register(_close_at_exit)
 
 
 def _run_changed(*args, **kwargs):
@@ -348,16 +2044,26 @@ def _run_changed(*args, **kwargs):
     pass
 
 
-#
-#
-queue = 'vote_comment_q'
-# # # 单个消费
-consume_items(queue, _run_changed)
+if __name__ == '__main__':
+    # get_connection_manager().get_connection()
+
+    for i in range(10):
+        add_item('vote_comment_q', f"message_000{i}", message_id=str(uuid.uuid4()))
+
+    # get_worker().join()  # 阻塞当前线程
+
+    #
+    # for i in range(100):
+    #     add_item('vote_comment_q', f"message_000{i}")
+
+    queue = 'vote_comment_q'
+    # 单个消费
+    consume_items(queue, _run_changed)
 
-# 批量消费
-# handle_items(queue, _run_changed, min_size=2,
-#              limit=10, drain=False, sleep_time=2)
+    # 批量消费
+    # handle_items(queue, _run_changed, min_size=2,
+    #              limit=10, drain=False, sleep_time=2)
 
-# empty_queue(queue)
+    # empty_queue(queue)
 
-# dedup_queue(queue)
+    # dedup_queue(queue)
@@ -0,0 +1,143 @@
+"""队列积压监控
+
+定期对cfg.queues(即 declare_queues() 声明的所有队列)做被动声明，取得每个队列的
+消息数和消费者数，作为gauge写入 stats.Stats：
+
+    amqp.<queue>.depth       队列中等待消费的消息数
+    amqp.<queue>.consumers   消费者数量
+
+发布/确认/拒绝的数量(amqp.<queue>.queue_put/ack/reject)和消息从发布到处理完的时间
+(amqp.<queue>.age)由amqp.py在发布和消费时记录，这里只负责定期flush。
+
+同时报告本进程每个发布通道(lane)的情况：
+
+    amqp.lane.<lane>.depth       在发布线程中排队的任务数
+    amqp.lane.<lane>.wait_ms     这段时间内任务的平均排队时间
+    amqp.lane.<lane>.published / throttled / dropped   这段时间内的次数
+
+    monitor = QueueMonitor(stats, interval=10)
+    monitor.start()
+    monitor.backlog('vote_comment_q')   # 最近一次采样的 (depth, consumers)
+
+连续stuck_samples次采样中队列长度不为0且没有减少时，认为队列卡住了，
+记录 amqp.<queue>.stuck 并打印警告。
+"""
+import time
+from threading import Thread
+
+import pika.exceptions
+
+import amqp
+
+
+class QueueMonitor(object):
+    def __init__(self, stats=None, interval=10, queues=None, stuck_samples=3):
+        self.stats = stats or amqp.cfg.stats
+        self.interval = interval
+        # 默认监控所有声明过的队列
+        self.queues = queues
+        self.stuck_samples = stuck_samples
+        # 队列名 -> (depth, consumers, 采样时间)
+        self.samples = {}
+        # 队列名 -> 长度没有减少的连续采样次数
+        self._not_draining = {}
+        # 上一次采样时发布通道的累计统计
+        self._lane_totals = {}
+        self.thread = None
+
+    def queue_names(self):
+        if self.queues is not None:
+            return list(self.queues)
+        return [queue.name for queue in amqp.cfg.queues]
+
+    def _sample_queue(self, name):
+        with amqp.get_connection_pool().channel() as chan:
+            method = chan.queue_declare(queue=name, passive=True).method
+        return method.message_count, method.consumer_count
+
+    def sample(self):
+        """采样一次所有队列，返回 {队列名: (depth, consumers)}"""
+        result = {}
+        for name in self.queue_names():
+            try:
+                depth, consumers = self._sample_queue(name)
+            except pika.exceptions.ChannelClosedByBroker as e:
+                # 队列不存在时被动声明会关闭通道，下一个队列会借到新的通道
+                print('amqp monitor: cannot sample %s (%r)' % (name, e))
+                if self.stats:
+                    self.stats.amqp_event(name, 'missing')
+                continue
+
+            self._check_stuck(name, depth)
+            self.samples[name] = (depth, consumers, time.time())
+            result[name] = (depth, consumers)
+            if self.stats:
+                self.stats.gauge('amqp.%s.depth' % name, depth)
+                self.stats.gauge('amqp.%s.consumers' % name, consumers)
+
+        self._report_lanes()
+        return result
+
+    def _report_lanes(self):
+        # 只读取已经存在的发布线程，只运行监控的进程不应该因此启动发布线程
+        worker = amqp._worker
+        if not self.stats or worker is None:
+            return
+        for lane, totals in worker.lane_stats().items():
+            last = self._lane_totals.get(lane) or dict.fromkeys(totals, 0)
+            self._lane_totals[lane] = totals
+            delta = {name: totals[name] - last[name] for name in totals
+                     if name != 'depth'}
+
+            prefix = 'amqp.lane.' + lane
+            self.stats.gauge(prefix + '.depth', totals['depth'])
+            if delta['items']:
+                self.stats.gauge(prefix + '.wait_ms',
+                                 int(delta['wait'] * 1000 / delta['items']))
+            counter = self.stats.get_counter(prefix)
+            counter.increment('published', delta=delta['cost'])
+            counter.increment('throttled', delta=delta['throttled'])
+            counter.increment('dropped', delta=delta['dropped'])
+
+    def _check_stuck(self, name, depth):
+        previous = self.samples.get(name)
+        if depth and previous is not None and depth >= previous[0]:
+            count = self._not_draining.get(name, 0) + 1
+        else:
+            count = 0
+        self._not_draining[name] = count
+
+        if count and count % self.stuck_samples == 0:
+            print('amqp monitor: %s has not drained for %d samples (depth %d)'
+                  % (name, count, depth))
+            if self.stats:
+                self.stats.amqp_event(name, 'stuck')
+
+    def backlog(self, name):
+        """最近一次采样的 (depth, consumers)，还没有采样过时返回None"""
+        sample = self.samples.get(name)
+        return sample[:2] if sample else None
+
+    def run(self):
+        while True:
+            start = time.time()
+            try:
+                self.sample()
+            except pika.exceptions.AMQPError as e:
+                print('amqp monitor: sampling failed (%r)' % (e,))
+            if self.stats:
+                self.stats.flush()
+            time.sleep(max(0, self.interval - (time.time() - start)))
+
+    def start(self):
+        """在后台线程中定期采样"""
+        if self.thread is None:
+            self.thread = Thread(target=self.run, name='amqp-monitor')
+            self.thread.daemon = True
+            self.thread.start()
+        return self.thread
+
+
+if __name__ == '__main__':
+    for name, (depth, consumers) in sorted(QueueMonitor().sample().items()):
+        print('%-30s depth=%-8d consumers=%d' % (name, depth, consumers))
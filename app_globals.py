@@ -8,11 +8,15 @@ class Globals(object):
         self.config.add_spec({
             ConfigValue.str: ['amqp_user', 'amqp_host', 'amqp_pass', 'amqp_virtual_host'],
             # ConfigValue.int: ['age'],
+            ConfigValue.int: ['commentstree_shard_count', 'author_query_shard_count',
+                              'subreddit_query_shard_count', 'domain_query_shard_count',
+                              'amqp_max_attempts'],
             # ConfigValue.float: ['height'],
             ConfigValue.bool: ['amqp_logging', 'shard_commentstree_queues', 'shard_author_query_queues',
                                'shard_subreddit_query_queues', 'shard_domain_query_queues'],
             # ConfigValue.set: ['fruits'],
             # ConfigValue.tuple: ['hardcache_categories'],
+            ConfigValue.tuple_of(int): ['amqp_retry_delays'],
             # ConfigValue.dict: ['address'],
             # ConfigValue.choice(red='red', blue='blue', green='green'): ['favorite_color'],
         })
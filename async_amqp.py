@@ -0,0 +1,387 @@
+"""基于asyncio的AMQP客户端
+
+与amqp.py中基于 pika.BlockingConnection 的接口相对应，但所有操作都运行在一个
+事件循环上(pika.adapters.asyncio_connection.AsyncioConnection)：
+
+    await add_item('vote_comment_q', body)
+    await add_items('vote_comment_q', bodies)
+    await consume_items('vote_comment_q', process, concurrency=100)
+    await handle_items('vote_comment_q', process_batch, limit=100)
+
+消费者的回调都是协程函数，同一个进程中可以同时处理很多条消息，适合缓存失效、
+通知这类以I/O为主的队列处理程序。
+"""
+import asyncio
+import socket
+import traceback
+from collections import OrderedDict
+
+import pika
+import pika.exceptions
+from pika.adapters.asyncio_connection import AsyncioConnection
+
+from amqp import (cfg, DELIVERY_DURABLE, _backoff_delay, _connection_parameters,
+                  _make_properties, _record_consumed, _retry_failed,
+                  _send_declarations, _send_stat, _stamp_headers)
+
+
+def _rpc(method, *a, **kw):
+    """调用pika异步通道上带callback参数的方法，返回等待其完成的Future"""
+    future = asyncio.get_running_loop().create_future()
+
+    def _done(result):
+        if not future.done():
+            future.set_result(result)
+
+    method(*a, callback=_done, **kw)
+    return future
+
+
+class AsyncClient(object):
+    """事件循环上的一个AMQP连接
+
+    发布使用一个开启了生产者确认模式的通道，未确认的消息按delivery tag记录，
+    最多window条；连接断开后重新连接，并重发未确认的消息。
+    每个消费者使用单独的通道，以便单独设置prefetch。
+    """
+
+    def __init__(self, window=None):
+        self.window = max(1, window or cfg.amqp_confirm_window)
+        self.connection = None
+        self.channel = None
+        self.next_tag = 1
+        # delivery_tag -> [future, exchange, routing_key, body, properties, returned]
+        self.outstanding = OrderedDict()
+        self._connect_lock = asyncio.Lock()
+        self._window = asyncio.Semaphore(self.window)
+
+    async def _connect(self):
+        loop = asyncio.get_running_loop()
+        attempt = 0
+        while True:
+            opened = loop.create_future()
+            AsyncioConnection(
+                _connection_parameters(),
+                on_open_callback=opened.set_result,
+                on_open_error_callback=lambda _conn, e: opened.set_exception(e),
+                on_close_callback=self._on_connection_closed,
+                custom_ioloop=loop)
+            try:
+                return await opened
+            except (socket.error, IOError,
+                    pika.exceptions.AMQPConnectionError) as e:
+                print('error connecting to amqp %s @ %s (%r)' %
+                      (cfg.amqp_user, cfg.amqp_host, e))
+                await asyncio.sleep(_backoff_delay(attempt))
+                attempt += 1
+
+    def _on_connection_closed(self, connection, reason):
+        if connection is self.connection:
+            self.connection = None
+            self.channel = None
+            if self.outstanding:
+                # 还有未确认的消息，立即重新连接并重发
+                asyncio.ensure_future(self.get_connection())
+
+    async def get_connection(self):
+        async with self._connect_lock:
+            if not self.connection or not self.connection.is_open:
+                self.connection = await self._connect()
+                self.channel = None
+                chan = await self.open_channel()
+                await self._init_queue(chan)
+                await self._init_publisher(chan)
+            elif not self.channel or not self.channel.is_open:
+                # 只有发布通道被broker关闭了，在原连接上重新打开
+                await self._init_publisher(await self.open_channel())
+        return self.connection
+
+    async def open_channel(self):
+        opened = asyncio.get_running_loop().create_future()
+        self.connection.channel(on_open_callback=opened.set_result)
+        return await opened
+
+    async def _init_queue(self, chan):
+        # 以nowait方式发出所有声明，再用一次同步调用等待broker处理完
+        _send_declarations(chan)
+        await _rpc(chan.exchange_declare, exchange=cfg.amqp_exchange,
+                   passive=True)
+
+    async def _init_publisher(self, chan):
+        await _rpc(chan.confirm_delivery, ack_nack_callback=self._on_confirm)
+        chan.add_on_return_callback(self._on_return)
+
+        # 新通道上delivery tag从1重新计数，旧通道上未确认的消息需要重发
+        pending = list(self.outstanding.values())
+        self.outstanding = OrderedDict()
+        self.channel = chan
+        self.next_tag = 1
+        for entry in pending:
+            self._publish(entry)
+
+    def _publish(self, entry):
+        future, exchange, routing_key, body, properties, _ = entry
+        entry[-1] = False
+        self.channel.basic_publish(exchange=exchange, routing_key=routing_key,
+                                   body=body, properties=properties,
+                                   mandatory=True)
+        self.outstanding[self.next_tag] = entry
+        self.next_tag += 1
+
+    def _on_confirm(self, frame):
+        method = frame.method
+        nack = isinstance(method, pika.spec.Basic.Nack)
+        if method.multiple:
+            tags = [tag for tag in self.outstanding if tag <= method.delivery_tag]
+        else:
+            tags = [method.delivery_tag]
+
+        for tag in tags:
+            entry = self.outstanding.pop(tag, None)
+            if entry is None:
+                continue
+            self._window.release()
+            future, body = entry[0], entry[3]
+            if future.done():
+                continue
+            if nack:
+                future.set_exception(pika.exceptions.NackError([body]))
+            elif entry[-1]:
+                future.set_exception(pika.exceptions.UnroutableError([body]))
+            else:
+                future.set_result(tag)
+
+    def _on_return(self, channel, method, properties, body):
+        # 退回的消息没有delivery tag，按发布顺序找到第一条匹配的未确认消息
+        for entry in self.outstanding.values():
+            if (not entry[-1] and entry[2] == method.routing_key
+                    and entry[3] == body):
+                entry[-1] = True
+                break
+
+    async def publish(self, exchange, routing_key, body, properties=None):
+        """发布一条消息，返回等待broker确认的Future"""
+        await self._window.acquire()
+        try:
+            while not self.channel or not self.channel.is_open:
+                await self.get_connection()
+        except BaseException:
+            self._window.release()
+            raise
+
+        future = asyncio.get_running_loop().create_future()
+        self._publish([future, exchange, routing_key, body, properties, False])
+        return future
+
+    async def close(self):
+        if self.connection and self.connection.is_open:
+            closed = asyncio.get_running_loop().create_future()
+            self.connection.add_on_close_callback(
+                lambda _conn, _reason: closed.done() or closed.set_result(None))
+            self.connection.close()
+            await closed
+        self.connection = None
+        self.channel = None
+
+
+_client = None
+
+
+def get_client():
+    """当前进程共用的AsyncClient"""
+    global _client
+    if _client is None:
+        _client = AsyncClient()
+    return _client
+
+
+async def add_item(routing_key, body, message_id=None,
+                   delivery_mode=DELIVERY_DURABLE, headers=None,
+                   exchange=None, send_stats=True):
+    """发布消息，broker确认后返回；无法路由时抛出 pika.exceptions.UnroutableError"""
+    if exchange is None:
+        exchange = cfg.amqp_exchange
+
+    future = await get_client().publish(
+        exchange, routing_key, body,
+        _make_properties(message_id, delivery_mode, _stamp_headers(headers)))
+    if send_stats:
+        _send_stat(routing_key, 'queue_put')
+    return await future
+
+
+async def add_items(routing_key, bodies, message_ids=None,
+                    delivery_mode=DELIVERY_DURABLE, headers=None,
+                    exchange=None, send_stats=True):
+    """批量发布消息，所有消息都被确认后返回
+
+    返回与bodies一一对应的结果列表，发布失败的消息对应的位置是异常对象。
+    """
+    bodies = list(bodies)
+    if message_ids is not None and len(message_ids) != len(bodies):
+        raise ValueError("message_ids must be the same length as bodies")
+    if exchange is None:
+        exchange = cfg.amqp_exchange
+
+    client = get_client()
+    headers = _stamp_headers(headers)
+    if message_ids is None:
+        # 所有消息共用一个属性对象
+        properties = [_make_properties(None, delivery_mode, headers)] * len(bodies)
+    else:
+        properties = [_make_properties(message_id, delivery_mode, headers)
+                      for message_id in message_ids]
+
+    futures = []
+    for body, props in zip(bodies, properties):
+        futures.append(await client.publish(exchange, routing_key, body, props))
+    if send_stats:
+        _send_stat(routing_key, 'queue_put', len(bodies))
+    return await asyncio.gather(*futures, return_exceptions=True)
+
+
+async def _consume(queue, prefetch_count, on_message):
+    """在新通道上消费queue，直到通道被关闭"""
+    client = get_client()
+    await client.get_connection()
+    chan = await client.open_channel()
+    await _rpc(chan.basic_qos, prefetch_size=0, prefetch_count=prefetch_count,
+               global_qos=False)
+
+    closed = asyncio.get_running_loop().create_future()
+    chan.add_on_close_callback(
+        lambda _chan, reason: closed.done() or closed.set_result(reason))
+    chan.basic_consume(queue=queue, on_message_callback=on_message,
+                       auto_ack=False)
+    return chan, closed
+
+
+async def _move_failed(queue, failures):
+    """在线程池中调用 amqp._retry_failed (使用阻塞连接池)，不阻塞事件循环"""
+    return await asyncio.get_running_loop().run_in_executor(
+        None, _retry_failed, queue, failures)
+
+
+async def _bisect_failures(callback, items, ch, error=None):
+    """与 amqp._bisect_failures 相同，callback为协程函数"""
+    if error is None:
+        try:
+            await callback(items, ch)
+            return []
+        except Exception as e:
+            error = e
+
+    if len(items) == 1:
+        return [(0, error)]
+
+    mid = len(items) // 2
+    left = await _bisect_failures(callback, items[:mid], ch)
+    right = await _bisect_failures(callback, items[mid:], ch)
+    return left + [(i + mid, e) for i, e in right]
+
+
+async def consume_items(queue, callback, concurrency=100, verbose=True):
+    """异步消费queue中的消息
+
+    callback 为协程函数 callback(body)，最多concurrency条消息同时处理
+    (通过prefetch限制broker推送的未确认消息数)。处理成功后确认消息，
+    出现异常则按队列的重试策略转移到重试队列或死信队列。通道关闭后返回关闭的原因。
+    """
+    tasks = set()
+
+    async def _process(ch, method, properties, body):
+        try:
+            await callback(body)
+        except Exception as e:
+            traceback.print_exc()
+            if await _move_failed(queue, [(properties, body, e)]):
+                ch.basic_ack(delivery_tag=method.delivery_tag)
+            else:
+                ch.basic_reject(delivery_tag=method.delivery_tag, requeue=True)
+                _record_consumed(queue, [properties], 'reject')
+        else:
+            ch.basic_ack(delivery_tag=method.delivery_tag)
+            _record_consumed(queue, [properties], 'ack')
+
+    def _on_message(ch, method, properties, body):
+        task = asyncio.ensure_future(_process(ch, method, properties, body))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+
+    chan, closed = await _consume(queue, concurrency, _on_message)
+    try:
+        return await closed
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+async def handle_items(queue, callback, ack=True, limit=1, max_wait=0.1,
+                       concurrency=10):
+    """异步地批量处理queue中的消息
+
+    每凑够limit条，或者第一条消息到达max_wait秒后，调用协程函数
+    callback(items, chan)，items为 (method, properties, body) 列表；
+    最多concurrency批同时处理。处理成功后确认这一批消息；出现异常时二分找出
+    单独处理也会失败的消息，按队列的重试策略转移，其余的消息正常确认。
+    """
+    if limit < 1:
+        raise ValueError("limit must be at least 1")
+
+    loop = asyncio.get_running_loop()
+    tasks = set()
+    batch = []
+    timer = None
+
+    async def _process(ch, items):
+        try:
+            await callback(items, ch)
+            failures = []
+        except Exception as e:
+            traceback.print_exc()
+            failures = await _bisect_failures(callback, items, ch, error=e)
+
+        failed = {i for i, _ in failures}
+        succeeded = [props for i, (_, props, _) in enumerate(items)
+                     if i not in failed]
+        _record_consumed(queue, succeeded, 'ack' if ack else 'handled')
+        moved = failures and await _move_failed(
+            queue, [(items[i][1], items[i][2], e) for i, e in failures])
+        if failures and not moved:
+            _record_consumed(queue, [items[i][1] for i in failed], 'reject')
+
+        # 多批并发处理，完成的顺序不确定，逐条确认
+        for i, (method, _, _) in enumerate(items):
+            if i in failed and not moved:
+                ch.basic_reject(delivery_tag=method.delivery_tag, requeue=True)
+            elif ack or i in failed:
+                ch.basic_ack(delivery_tag=method.delivery_tag)
+
+    def _flush():
+        nonlocal batch, timer
+        if timer:
+            timer.cancel()
+            timer = None
+        if not batch:
+            return
+        items, batch = batch, []
+        task = asyncio.ensure_future(_process(chan, items))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+
+    def _on_message(ch, method, properties, body):
+        nonlocal timer
+        batch.append((method, properties, body))
+        if len(batch) >= limit:
+            _flush()
+        elif timer is None:
+            timer = loop.call_later(max_wait, _flush)
+
+    chan, closed = await _consume(queue, limit * concurrency, _on_message)
+    try:
+        return await closed
+    finally:
+        if timer:
+            timer.cancel()
+        for task in tasks:
+            task.cancel()
@@ -0,0 +1,220 @@
+"""amqp模块发布和消费路径的吞吐量(msgs/sec)和延迟(p50/p99)
+
+broker用进程内的替身代替(见fake_broker.py)，不需要RabbitMQ；--rtt 模拟网络往返时间。
+
+    add_item / add_items   从调用到broker确认(Future完成)的时间
+    handle_items           一个线程持续发布，消费者按批处理；从发布到callback的时间
+    consume_items          同上，逐条处理(inline以及 --concurrency 个线程并发)
+    dedup_queue            队列中预先放入一半重复的消息，只测吞吐量
+    add_records            小记录打包成分帧的消息体发布，再用handle_items逐条读出(记录/秒)
+
+    python -m benchmarks.bench_amqp
+    python -m benchmarks.bench_amqp --count 50000 --rtt 0.001 --size 512
+"""
+import argparse
+import contextlib
+import io
+import struct
+import time
+from concurrent.futures import wait as wait_futures
+from functools import partial
+from threading import Lock, Thread
+
+import amqp
+from benchmarks.fake_broker import FakeBroker
+
+QUEUE = 'vote_comment_q'
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0
+    i = min(len(sorted_values) - 1, int(round(p / 100.0 * (len(sorted_values) - 1))))
+    return sorted_values[i]
+
+
+def report(name, count, elapsed, latencies=None):
+    line = '%-26s %10.0f msgs/sec' % (name, count / elapsed)
+    if latencies:
+        latencies = sorted(latencies)
+        line += '   p50 %7.2fms   p99 %7.2fms' % (
+            percentile(latencies, 50) * 1000, percentile(latencies, 99) * 1000)
+    print(line)
+
+
+def make_body(i, size):
+    # 发布时间和序号放在消息头部，便于消费端计算延迟
+    head = struct.pack('!dI', time.time(), i)
+    return head + b'x' * max(0, size - len(head))
+
+
+def body_time(body):
+    return struct.unpack_from('!d', body)[0]
+
+
+def reset(broker):
+    amqp.get_connection_manager().get_channel()
+    broker.queue_purge(QUEUE)
+
+
+def producer(broker, count, size):
+    """直接在broker上发布，不经过amqp的发布线程，避免与被测的消费端争用"""
+    def _run():
+        for i in range(count):
+            broker.publish(amqp.cfg.amqp_exchange, QUEUE, make_body(i, size),
+                           None)
+    thread = Thread(target=_run)
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+def bench_add_item(broker, count, size):
+    reset(broker)
+    latencies = []
+
+    def _done(start, future):
+        latencies.append(time.time() - start)
+
+    start = time.time()
+    futures = []
+    for i in range(count):
+        future = amqp.add_item(QUEUE, make_body(i, size), send_stats=False)
+        future.add_done_callback(partial(_done, time.time()))
+        futures.append(future)
+    wait_futures(futures)
+    elapsed = time.time() - start
+    assert all(f.exception() is None for f in futures)
+    assert broker.depth(QUEUE) == count
+    report('add_item', count, elapsed, latencies)
+
+
+def bench_add_items(broker, count, size, batch):
+    reset(broker)
+    latencies = []
+
+    def _done(start, n, future):
+        # 同一批的消息一起被确认
+        latencies.extend([time.time() - start] * n)
+
+    start = time.time()
+    futures = []
+    for offset in range(0, count, batch):
+        bodies = [make_body(i, size)
+                  for i in range(offset, min(count, offset + batch))]
+        batch_futures = amqp.add_items(QUEUE, bodies, send_stats=False)
+        batch_futures[-1].add_done_callback(
+            partial(_done, time.time(), len(bodies)))
+        futures.extend(batch_futures)
+    wait_futures(futures)
+    elapsed = time.time() - start
+    assert all(f.exception() is None for f in futures)
+    assert broker.depth(QUEUE) == count
+    report('add_items batch=%d' % batch, count, elapsed, latencies)
+
+
+def bench_handle_items(broker, count, size, limit):
+    reset(broker)
+    latencies = []
+
+    def _process(items, chan):
+        now = time.time()
+        latencies.extend(now - body_time(body) for _, _, body in items)
+
+    start = time.time()
+    thread = producer(broker, count, size)
+    while len(latencies) < count:
+        amqp.handle_items(QUEUE, _process, limit=limit, drain=True,
+                          max_wait=0.01)
+    elapsed = time.time() - start
+    thread.join()
+    report('handle_items limit=%d' % limit, count, elapsed, latencies)
+
+
+def bench_consume_items(broker, count, size, concurrency):
+    reset(broker)
+    latencies = []
+    lock = Lock()
+    chan = amqp.get_connection_manager().get_channel()
+
+    def _process(body):
+        with lock:
+            latencies.append(time.time() - body_time(body))
+            if len(latencies) == count:
+                # 可能在线程池中：在连接线程上停止消费
+                chan.connection.add_callback_threadsafe(chan.stop_consuming)
+
+    start = time.time()
+    thread = producer(broker, count, size)
+    amqp.consume_items(QUEUE, _process, verbose=False, concurrency=concurrency)
+    elapsed = time.time() - start
+    thread.join()
+    name = 'consume_items' if not concurrency else \
+        'consume_items threads=%d' % concurrency
+    report(name, count, elapsed, latencies)
+
+
+def bench_dedup_queue(broker, count, size):
+    reset(broker)
+    for i in range(count):
+        # 一半的消息与前一条重复
+        broker.publish('', QUEUE, b'%d' % (i // 2) + b'x' * size, None)
+
+    start = time.time()
+    with contextlib.redirect_stdout(io.StringIO()):
+        unique = amqp.dedup_queue(QUEUE)
+    elapsed = time.time() - start
+    assert unique == (count + 1) // 2, unique
+    report('dedup_queue', count, elapsed)
+
+
+def bench_add_records(broker, count, size, body_size):
+    reset(broker)
+    records = [make_body(i, size) for i in range(count)]
+
+    start = time.time()
+    futures = amqp.add_records(QUEUE, records, max_body_size=body_size,
+                               send_stats=False)
+    wait_futures(futures)
+    elapsed = time.time() - start
+    assert all(f.exception() is None for f in futures)
+    report('add_records body=%d' % body_size, count, elapsed)
+
+    received = [0]
+
+    def _process(items, chan):
+        for _, _, records in items:
+            # 记录是消息体的memoryview切片
+            received[0] += sum(1 for _ in records)
+
+    start = time.time()
+    amqp.handle_items(QUEUE, _process, limit=10, drain=True, decode=True)
+    elapsed = time.time() - start
+    assert received[0] == count, received[0]
+    report('handle_items records', count, elapsed)
+
+
+def run(count, rtt, size, batch, limit, concurrency):
+    broker = FakeBroker(rtt=rtt)
+    with broker.install():
+        bench_add_item(broker, count, size)
+        bench_add_items(broker, count, size, batch)
+        bench_handle_items(broker, count, size, limit)
+        bench_consume_items(broker, count, size, 0)
+        if concurrency:
+            bench_consume_items(broker, count, size, concurrency)
+        bench_dedup_queue(broker, count, size)
+        bench_add_records(broker, count, size, 64 * 1024)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--count', type=int, default=20000)
+    parser.add_argument('--rtt', type=float, default=0.0005)
+    parser.add_argument('--size', type=int, default=128)
+    parser.add_argument('--batch', type=int, default=100)
+    parser.add_argument('--limit', type=int, default=100)
+    parser.add_argument('--concurrency', type=int, default=8)
+    args = parser.parse_args()
+    run(args.count, args.rtt, args.size, args.batch, args.limit,
+        args.concurrency)
@@ -0,0 +1,91 @@
+"""热点键过期时的缓存击穿：计算次数和读取延迟(p50/p99)
+
+--threads 个线程在 --duration 秒内不停读取同一个键，键每 --ttl 秒过期一次，
+每次计算耗时 --compute 秒(模拟数据库查询)。比较：
+
+    naive              get，未命中时计算再set (每次过期所有线程一起计算)
+    get_or_compute     同一时间只有一个线程计算，其他线程等待结果
+    xfetch             加上提前过期(beta=1)
+    stale              加上 stale_ttl，过期后返回旧值并在后台计算
+
+    python -m benchmarks.bench_cache
+    python -m benchmarks.bench_cache --threads 64 --compute 0.05
+"""
+import argparse
+import time
+from threading import Lock, Thread
+
+from cache import LocalCache
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0
+    i = min(len(sorted_values) - 1, int(round(p / 100.0 * (len(sorted_values) - 1))))
+    return sorted_values[i]
+
+
+def naive_get(cache, key, fn, ttl):
+    value = cache.get(key)
+    if value is None:
+        value = fn()
+        cache.set(key, value, time=ttl)
+    return value
+
+
+def run_case(name, get, threads, duration, compute):
+    cache = LocalCache()
+    computations = [0]
+    lock = Lock()
+    latencies = []
+
+    def _compute():
+        with lock:
+            computations[0] += 1
+        time.sleep(compute)
+        return 'value'
+
+    def _reader():
+        local = []
+        end = time.time() + duration
+        while time.time() < end:
+            start = time.time()
+            get(cache, 'hot', _compute)
+            local.append(time.time() - start)
+            time.sleep(0.001)
+        with lock:
+            latencies.extend(local)
+
+    workers = [Thread(target=_reader) for _ in range(threads)]
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+
+    latencies.sort()
+    print('%-16s %8d computations %10d reads   p50 %7.2fms   p99 %7.2fms' % (
+        name, computations[0], len(latencies),
+        percentile(latencies, 50) * 1000, percentile(latencies, 99) * 1000))
+
+
+def run(threads, duration, ttl, compute):
+    cases = [
+        ('naive', lambda c, k, fn: naive_get(c, k, fn, ttl)),
+        ('get_or_compute',
+         lambda c, k, fn: c.get_or_compute(k, fn, ttl=ttl, beta=0)),
+        ('xfetch', lambda c, k, fn: c.get_or_compute(k, fn, ttl=ttl)),
+        ('stale', lambda c, k, fn: c.get_or_compute(k, fn, ttl=ttl, beta=0,
+                                                    stale_ttl=ttl)),
+    ]
+    for name, get in cases:
+        run_case(name, get, threads, duration, compute)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--threads', type=int, default=32)
+    parser.add_argument('--duration', type=float, default=3)
+    parser.add_argument('--ttl', type=int, default=1)
+    parser.add_argument('--compute', type=float, default=0.02)
+    args = parser.parse_args()
+    run(args.threads, args.duration, args.ttl, args.compute)
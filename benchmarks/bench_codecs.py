@@ -0,0 +1,70 @@
+"""对比add_kw各种序列化/压缩方式的消息大小和编解码速度
+
+负载模仿投票和评论队列中的消息。
+
+    python -m benchmarks.bench_codecs
+"""
+import random
+import time
+
+from utils import serializers
+
+
+def vote_payload(i):
+    return dict(user_id=random.randint(1, 10 ** 8),
+                thing_fullname='t1_%x' % (i + 10 ** 9),
+                direction=random.choice((1, 0, -1)),
+                date=time.time(),
+                ip='10.%d.%d.%d' % (i % 256, (i >> 8) % 256, (i >> 16) % 256),
+                event_data={'context': 'comments', 'valid': True})
+
+
+def comment_payload(i):
+    words = ['reddit', 'comment', 'vote', 'queue', 'message', 'thread', 'the']
+    return dict(comment_id='t1_%x' % (i + 10 ** 9),
+                link_id='t3_%x' % (i // 10 + 10 ** 8),
+                author_id=random.randint(1, 10 ** 8),
+                parent_id=None if i % 3 else 't1_%x' % (i + 10 ** 9 - 1),
+                body=' '.join(random.choice(words)
+                              for _ in range(random.randint(10, 400))),
+                date=time.time())
+
+
+def bench(payloads, codec, compression, rounds=5):
+    encoded = [serializers.encode(p, codec=codec, compression=compression)
+               for p in payloads]
+    size = sum(len(body) for body, _ in encoded) / len(encoded)
+
+    start = time.time()
+    for _ in range(rounds):
+        for p in payloads:
+            serializers.encode(p, codec=codec, compression=compression)
+    encode_us = (time.time() - start) / (rounds * len(payloads)) * 1e6
+
+    start = time.time()
+    for _ in range(rounds):
+        for body, headers in encoded:
+            serializers.decode(body, headers)
+    decode_us = (time.time() - start) / (rounds * len(payloads)) * 1e6
+    return size, encode_us, decode_us
+
+
+if __name__ == '__main__':
+    random.seed(0)
+    payloads = {
+        'vote': [vote_payload(i) for i in range(5000)],
+        'comment': [comment_payload(i) for i in range(5000)],
+    }
+    codecs = [c for c in ('pickle', 'json', 'msgpack')
+              if c in serializers._serializers]
+    compressions = [None] + sorted(serializers._compressors)
+
+    for kind, items in payloads.items():
+        print('%s payloads' % kind)
+        print('  %-8s %-6s %10s %12s %12s' % ('codec', 'comp', 'bytes',
+                                              'encode(us)', 'decode(us)'))
+        for codec in codecs:
+            for compression in compressions:
+                size, enc, dec = bench(items, codec, compression)
+                print('  %-8s %-6s %10.1f %12.2f %12.2f'
+                      % (codec, compression or '-', size, enc, dec))
@@ -0,0 +1,52 @@
+"""对比逐条确认、流水线确认和批量发布几种方式的吞吐量
+
+broker用进程内的替身代替(见fake_broker.py)：每条消息在发布一个往返时间(rtt)之后
+才会被确认，同一段时间内发布的消息合并为一个multiple确认。
+
+    python -m benchmarks.bench_publish
+"""
+import time
+
+from amqp import ConfirmPublisher, ConnectionManager
+from benchmarks.fake_broker import FakeBroker
+
+
+def bench_publish(window, count, rtt):
+    with FakeBroker(rtt).install():
+        publisher = ConfirmPublisher(ConnectionManager(), window=window)
+        start = time.time()
+        futures = [publisher.publish('reddit_exchange', 'vote_comment_q',
+                                     b'message_%d' % i, flush=False)
+                   for i in range(count)]
+        publisher.wait_for_confirms()
+        elapsed = time.time() - start
+    assert all(f.done() and f.exception() is None for f in futures)
+    return count / elapsed
+
+
+def bench_publish_many(window, count, rtt):
+    bodies = [b'message_%d' % i for i in range(count)]
+    with FakeBroker(rtt).install():
+        publisher = ConfirmPublisher(ConnectionManager(), window=window)
+        start = time.time()
+        futures = publisher.publish_many('reddit_exchange', 'vote_comment_q',
+                                         bodies, flush=False)
+        publisher.wait_for_confirms()
+        elapsed = time.time() - start
+    assert all(f.done() and f.exception() is None for f in futures)
+    return count / elapsed
+
+
+if __name__ == '__main__':
+    count = 20000
+    rtt = 0.0005
+    for window in (1, 16, 256, 1024):
+        if window == 1:
+            # 逐条确认太慢，少发一些
+            rate = bench_publish(window, count // 20, rtt)
+        else:
+            rate = bench_publish(window, count, rtt)
+        print('publish      window=%-5d %10.0f msgs/sec' % (window, rate))
+    for window in (256, 1024):
+        rate = bench_publish_many(window, count, rtt)
+        print('publish_many window=%-5d %10.0f msgs/sec' % (window, rate))
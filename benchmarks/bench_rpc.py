@@ -0,0 +1,116 @@
+"""测量RPC往返延迟(p50/p99)和吞吐量
+
+默认需要本地的RabbitMQ(连接参数见amqp.py的config_data)；--fake 使用进程内的
+broker替身(见fake_broker.py，--rtt 模拟网络往返时间)。在同一个进程中启动一个
+回显服务端，多个调用线程通过同一个RpcClient并发调用。--warmup 秒内服务端没有
+回复(如broker没有运行)时退出：
+
+    python -m benchmarks.bench_rpc
+    python -m benchmarks.bench_rpc --fake --rtt 0.0005
+    python -m benchmarks.bench_rpc --callers 64 --duration 20 --work-ms 5
+    python -m benchmarks.bench_rpc --same   # 所有调用参数相同，测试合并效果
+"""
+import argparse
+import contextlib
+import sys
+import time
+from threading import Thread
+
+from benchmarks.fake_broker import FakeBroker
+from rpc import RpcClient, RpcError, RpcServer
+
+QUEUE = 'bench_rpc_q'
+
+
+def make_handler(work_ms):
+    def handler(request):
+        if work_ms:
+            time.sleep(work_ms / 1000.0)
+        return request
+    return handler
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0
+    i = min(len(sorted_values) - 1, int(round(p / 100.0 * (len(sorted_values) - 1))))
+    return sorted_values[i]
+
+
+def run(callers, duration, work_ms, concurrency, same, timeout, warmup):
+    server = RpcServer(QUEUE, make_handler(work_ms), concurrency=concurrency)
+    server_thread = Thread(target=server.serve)
+    server_thread.daemon = True
+    server_thread.start()
+
+    client = RpcClient(QUEUE, timeout=timeout)
+    # 预热：等服务端声明好队列、连接建立
+    give_up = time.time() + warmup
+    while True:
+        try:
+            client.call({'warmup': True}, timeout=min(timeout, warmup))
+            break
+        except RpcError:
+            if time.time() >= give_up:
+                server.stop()
+                sys.exit('no reply from the rpc server within %ss '
+                         '(is the broker running? use --fake to run without '
+                         'one)' % warmup)
+            time.sleep(0.1)
+
+    latencies = [[] for _ in range(callers)]
+    errors = [0] * callers
+    stop_at = time.time() + duration
+
+    def caller(i):
+        n = 0
+        while time.time() < stop_at:
+            request = {'n': 0} if same else {'caller': i, 'n': n}
+            n += 1
+            start = time.time()
+            try:
+                client.call(request)
+            except RpcError:
+                errors[i] += 1
+                continue
+            latencies[i].append(time.time() - start)
+
+    threads = [Thread(target=caller, args=(i,)) for i in range(callers)]
+    start = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.time() - start
+
+    client.close()
+    server.stop()
+    server_thread.join()
+
+    values = sorted(v for per_caller in latencies for v in per_caller)
+    print('callers=%d concurrency=%d work=%dms same=%s'
+          % (callers, concurrency, work_ms, same))
+    print('  calls      %10d  (%d errors)' % (len(values), sum(errors)))
+    print('  throughput %10.0f calls/sec' % (len(values) / elapsed))
+    for p in (50, 90, 99):
+        print('  p%-9d %10.2f ms' % (p, percentile(values, p) * 1000))
+    print('  max        %10.2f ms' % ((values[-1] if values else 0) * 1000))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--callers', type=int, default=16)
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--work-ms', type=int, default=0)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--timeout', type=float, default=5)
+    parser.add_argument('--same', action='store_true')
+    parser.add_argument('--warmup', type=float, default=30)
+    parser.add_argument('--fake', action='store_true')
+    parser.add_argument('--rtt', type=float, default=0.0005)
+    args = parser.parse_args()
+    broker = FakeBroker(rtt=args.rtt).install() if args.fake else \
+        contextlib.nullcontext()
+    with broker:
+        run(args.callers, args.duration, args.work_ms, args.concurrency,
+            args.same, args.timeout, args.warmup)
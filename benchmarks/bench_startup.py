@@ -0,0 +1,91 @@
+"""测量导入每个模块的启动时间
+
+每个模块在一个新的解释器中导入，报告导入耗时(减去空解释器的启动时间)、导入后
+还在运行的线程数(非守护线程会让进程无法退出)以及导入失败的原因(如缺少依赖)。
+超过 --timeout 秒没有返回的模块记为hang。
+
+    python -m benchmarks.bench_startup
+    python -m benchmarks.bench_startup amqp rpc --repeat 5
+"""
+import argparse
+import glob
+import os
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PROBE = """
+import threading, time
+start = time.perf_counter()
+import %s
+elapsed = time.perf_counter() - start
+threads = [t for t in threading.enumerate() if t is not threading.main_thread()]
+print(elapsed, len(threads), sum(1 for t in threads if not t.daemon))
+"""
+
+
+def all_modules():
+    names = [os.path.splitext(os.path.basename(path))[0]
+             for path in glob.glob(os.path.join(ROOT, '*.py'))]
+    names += ['utils.' + os.path.splitext(os.path.basename(path))[0]
+              for path in glob.glob(os.path.join(ROOT, 'utils', '*.py'))]
+    return sorted(names)
+
+
+def run_probe(code, timeout):
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    start = time.perf_counter()
+    proc = subprocess.run([sys.executable, '-c', code], cwd=ROOT, env=env,
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                          timeout=timeout)
+    return proc, time.perf_counter() - start
+
+
+def bench_import(module, repeat, timeout, baseline):
+    """返回 (import耗时, 进程耗时, 线程数, 非守护线程数)，失败时抛出RuntimeError"""
+    best = None
+    for _ in range(repeat):
+        try:
+            proc, wall = run_probe(PROBE % module, timeout)
+        except subprocess.TimeoutExpired:
+            raise RuntimeError('hang (> %ss)' % timeout)
+        if proc.returncode != 0:
+            lines = proc.stderr.decode('utf-8', 'replace').strip().splitlines()
+            raise RuntimeError(lines[-1] if lines else
+                               'exit code %d' % proc.returncode)
+        elapsed, threads, non_daemon = proc.stdout.split()[-3:]
+        result = (float(elapsed), max(0.0, wall - baseline), int(threads),
+                  int(non_daemon))
+        if best is None or result[1] < best[1]:
+            best = result
+    return best
+
+
+def run(modules, repeat, timeout):
+    baseline = min(run_probe('pass', timeout)[1] for _ in range(repeat))
+    print('interpreter startup %8.1fms' % (baseline * 1000))
+    print('%-26s %10s %10s %8s' % ('module', 'import', 'process', 'threads'))
+    total = 0
+    for module in modules:
+        try:
+            elapsed, wall, threads, non_daemon = bench_import(
+                module, repeat, timeout, baseline)
+        except RuntimeError as e:
+            print('%-26s %s' % (module, e))
+            continue
+        total += elapsed
+        flag = '  (%d non-daemon)' % non_daemon if non_daemon else ''
+        print('%-26s %8.1fms %8.1fms %8d%s' % (module, elapsed * 1000,
+                                               wall * 1000, threads, flag))
+    print('%-26s %8.1fms' % ('total', total * 1000))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('modules', nargs='*')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--timeout', type=float, default=30)
+    args = parser.parse_args()
+    run(args.modules or all_modules(), args.repeat, args.timeout)
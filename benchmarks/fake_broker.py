@@ -0,0 +1,771 @@
+"""进程内的broker替身
+
+实现amqp.py(以及rpc.py、amqp_monitor.py)用到的 pika.BlockingConnection /
+BlockingChannel 接口子集，不需要真的RabbitMQ就可以跑这些代码，用于基准测试和回归测试：
+
+    broker = FakeBroker(rtt=0.0005)
+    with broker.install():
+        amqp.add_item('vote_comment_q', b'...')
+        amqp.get_worker().join()
+        amqp.handle_items('vote_comment_q', process, limit=100, drain=True)
+
+install() 期间 pika.BlockingConnection 被替换为连接到这个替身，amqp模块的连接、
+连接池和拓扑缓存都会重置。
+
+支持：exchange_declare / queue_declare(含passive、x-message-ttl、死信交换机) /
+queue_bind / queue_purge，basic_publish(mandatory、生产者确认，包括在底层 _impl 通道上
+的异步确认)，basic_get，basic_consume / consume，basic_qos(prefetch_count)，
+basic_ack / basic_reject / basic_nack (含multiple)，direct reply-to，
+用 stop() / start() 模拟broker不可用。
+不支持：事务、非direct类型的交换机、按消息大小的prefetch。
+
+rtt 模拟网络往返时间：同步调用等待一个rtt，生产者确认在发布一个rtt之后才到达。
+"""
+import itertools
+import threading
+import time
+from collections import deque
+
+import pika
+import pika.exceptions
+import pika.frame
+import pika.spec
+
+import amqp
+
+REPLY_TO = 'amq.rabbitmq.reply-to'
+
+
+class _Message(object):
+    __slots__ = ('exchange', 'routing_key', 'body', 'properties', 'redelivered',
+                 'expires')
+
+    def __init__(self, exchange, routing_key, body, properties, expires=None):
+        self.exchange = exchange
+        self.routing_key = routing_key
+        self.body = body
+        self.properties = properties or pika.BasicProperties()
+        self.redelivered = False
+        self.expires = expires
+
+
+class _Queue(object):
+    def __init__(self, name, durable, exclusive, auto_delete, arguments):
+        self.name = name
+        self.durable = durable
+        self.exclusive = exclusive
+        self.auto_delete = auto_delete
+        self.arguments = arguments or {}
+        self.messages = deque()
+        # 消费者按轮询顺序排列
+        self.consumers = deque()
+
+    def ttl(self):
+        return self.arguments.get('x-message-ttl')
+
+
+class _Consumer(object):
+    def __init__(self, channel, queue, tag, callback, auto_ack):
+        self.channel = channel
+        self.queue = queue
+        self.tag = tag
+        # callback为None时消息进入通道的consume()缓冲区
+        self.callback = callback
+        self.auto_ack = auto_ack
+
+
+class FakeBroker(object):
+    def __init__(self, rtt=0.0):
+        self.rtt = rtt
+        self.lock = threading.RLock()
+        # 默认交换机按队列名投递
+        self.exchanges = {'': 'direct'}
+        self.queues = {}
+        # (exchange, routing_key) -> 队列名集合
+        self.bindings = {}
+        self.connections = []
+        self._saved = None
+        self.published = 0
+        self.delivered = 0
+        self.down = False
+
+    # ---- 安装到pika/amqp ----
+
+    def connect(self, parameters=None):
+        if self.down:
+            raise pika.exceptions.AMQPConnectionError('broker is down')
+        connection = FakeConnection(self)
+        with self.lock:
+            self.connections.append(connection)
+        return connection
+
+    def install(self):
+        """用这个替身代替 pika.BlockingConnection，返回可以用在with中的self"""
+        self._saved = pika.BlockingConnection
+        pika.BlockingConnection = self.connect
+        self._reset_amqp()
+        return self
+
+    def uninstall(self):
+        if self._saved is not None:
+            pika.BlockingConnection = self._saved
+            self._saved = None
+        for connection in list(self.connections):
+            connection.close()
+        self._reset_amqp()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.uninstall()
+
+    @staticmethod
+    def _reset_amqp():
+        if amqp._worker is not None:
+            amqp._worker.join()
+        if amqp._connection_pool is not None:
+            amqp._connection_pool.close()
+        amqp._reset_singletons()
+        amqp._declared_topology.clear()
+        amqp.broker_available.set()
+
+    # ---- 故障 ----
+
+    def stop(self):
+        """模拟broker不可用：关闭所有连接(未确认的消息不会再被确认)，新的连接失败"""
+        self.down = True
+        for connection in list(self.connections):
+            connection.close()
+
+    def start(self):
+        self.down = False
+
+    # ---- 拓扑 ----
+
+    def exchange_declare(self, exchange, exchange_type='direct', passive=False):
+        with self.lock:
+            if exchange in self.exchanges:
+                return
+            if passive:
+                raise pika.exceptions.ChannelClosedByBroker(
+                    404, "NOT_FOUND - no exchange '%s'" % exchange)
+            self.exchanges[exchange] = exchange_type
+
+    def queue_declare(self, queue, passive=False, durable=False,
+                      exclusive=False, auto_delete=False, arguments=None):
+        with self.lock:
+            q = self.queues.get(queue)
+            if q is None:
+                if passive:
+                    raise pika.exceptions.ChannelClosedByBroker(
+                        404, "NOT_FOUND - no queue '%s'" % queue)
+                q = self.queues[queue] = _Queue(queue, durable, exclusive,
+                                                auto_delete, arguments)
+            self._expire(q)
+            return len(q.messages), len(q.consumers)
+
+    def queue_bind(self, queue, exchange, routing_key):
+        with self.lock:
+            if queue not in self.queues:
+                raise pika.exceptions.ChannelClosedByBroker(
+                    404, "NOT_FOUND - no queue '%s'" % queue)
+            if exchange not in self.exchanges:
+                raise pika.exceptions.ChannelClosedByBroker(
+                    404, "NOT_FOUND - no exchange '%s'" % exchange)
+            self.bindings.setdefault((exchange, routing_key), set()).add(queue)
+
+    def queue_purge(self, queue):
+        with self.lock:
+            q = self.queues[queue]
+            count = len(q.messages)
+            q.messages.clear()
+            return count
+
+    def depth(self, queue):
+        """队列中等待投递的消息数"""
+        with self.lock:
+            q = self.queues[queue]
+            self._expire(q)
+            return len(q.messages)
+
+    # ---- 消息 ----
+
+    def route(self, exchange, routing_key):
+        if exchange == '':
+            return [routing_key] if routing_key in self.queues else []
+        if exchange not in self.exchanges:
+            raise pika.exceptions.ChannelClosedByBroker(
+                404, "NOT_FOUND - no exchange '%s'" % exchange)
+        return sorted(self.bindings.get((exchange, routing_key), ()))
+
+    def publish(self, exchange, routing_key, body, properties, now=None):
+        """投递一条消息，返回路由到的队列数"""
+        now = time.time() if now is None else now
+        with self.lock:
+            self.published += 1
+            if exchange == '' and routing_key == REPLY_TO:
+                return 0
+            if exchange == '' and routing_key.startswith(REPLY_TO + '.'):
+                return self._reply(routing_key, body, properties)
+
+            queues = self.route(exchange, routing_key)
+            for name in queues:
+                self._enqueue(self.queues[name],
+                              _Message(exchange, routing_key, body, properties),
+                              now)
+            return len(queues)
+
+    def _enqueue(self, q, message, now):
+        expires = None
+        if q.ttl() is not None:
+            expires = now + q.ttl() / 1000.0
+        if message.properties.expiration:
+            per_message = now + int(message.properties.expiration) / 1000.0
+            expires = per_message if expires is None else min(expires, per_message)
+        message.expires = expires
+        q.messages.append(message)
+        self._dispatch(q)
+
+    def _expire(self, q):
+        """过期的消息按死信交换机转发或者丢弃(与RabbitMQ一样只检查队头)"""
+        now = time.time()
+        while q.messages and q.messages[0].expires is not None \
+                and q.messages[0].expires <= now:
+            message = q.messages.popleft()
+            dlx = q.arguments.get('x-dead-letter-exchange')
+            if dlx is None:
+                continue
+            routing_key = q.arguments.get('x-dead-letter-routing-key',
+                                          message.routing_key)
+            properties = message.properties
+            # 与RabbitMQ一样，死信不再带有原来的过期时间
+            if properties.expiration:
+                properties = pika.BasicProperties(**dict(
+                    properties.__dict__, expiration=None))
+            for name in self.route(dlx, routing_key):
+                self._enqueue(self.queues[name],
+                              _Message(dlx, routing_key, message.body,
+                                       properties),
+                              now)
+
+    def _reply(self, routing_key, body, properties):
+        # direct reply-to：routing key 中带着客户端通道的编号
+        channel = FakeChannel.by_reply_key.get(routing_key)
+        if channel is None or not channel.is_open:
+            return 0
+        consumer = channel.reply_consumer
+        message = _Message('', REPLY_TO, body, properties)
+        channel.deliver(consumer, message, 0)
+        return 1
+
+    def _dispatch(self, q):
+        """在prefetch允许的范围内，把队头的消息轮流投递给消费者"""
+        self._expire(q)
+        blocked = 0
+        while q.messages and q.consumers and blocked < len(q.consumers):
+            consumer = q.consumers[0]
+            q.consumers.rotate(-1)
+            channel = consumer.channel
+            if not consumer.auto_ack and channel.prefetch_count and \
+                    len(channel.unacked) >= channel.prefetch_count:
+                blocked += 1
+                continue
+            blocked = 0
+            message = q.messages.popleft()
+            self.delivered += 1
+            tag = channel.next_delivery_tag()
+            if not consumer.auto_ack:
+                channel.unacked[tag] = (q, message)
+            channel.deliver(consumer, message, tag)
+
+    def dispatch_all(self):
+        with self.lock:
+            for q in list(self.queues.values()):
+                if q.messages and q.consumers:
+                    self._dispatch(q)
+
+    def requeue(self, items):
+        """把 (queue, message) 放回各自队列的队头，标记为重新投递"""
+        with self.lock:
+            touched = set()
+            for q, message in reversed(items):
+                message.redelivered = True
+                q.messages.appendleft(message)
+                touched.add(q)
+            for q in touched:
+                self._dispatch(q)
+
+    def get(self, channel, queue, auto_ack):
+        with self.lock:
+            q = self.queues.get(queue)
+            if q is None:
+                raise pika.exceptions.ChannelClosedByBroker(
+                    404, "NOT_FOUND - no queue '%s'" % queue)
+            self._expire(q)
+            if not q.messages:
+                return None, 0
+            message = q.messages.popleft()
+            self.delivered += 1
+            tag = channel.next_delivery_tag()
+            if not auto_ack:
+                channel.unacked[tag] = (q, message)
+            return (tag, message), len(q.messages)
+
+
+class FakeConnection(object):
+    """替代 pika.BlockingConnection
+
+    broker投递的消息、生产者确认、add_callback_threadsafe 的回调都放进事件队列，
+    只在调用 process_data_events 的线程中执行，与pika一样。
+    """
+
+    def __init__(self, broker):
+        self.broker = broker
+        self.is_open = True
+        self.is_closed = False
+        self.cond = threading.Condition()
+        # (到期时间, 函数)，按到期时间的先后加入
+        self.events = deque()
+        self.channels = []
+        self._numbers = itertools.count(1)
+
+    def channel(self):
+        self._check_open()
+        channel = FakeChannel(self, next(self._numbers))
+        self.channels.append(channel)
+        return channel
+
+    def _check_open(self):
+        if not self.is_open:
+            raise pika.exceptions.ConnectionWrongStateError(
+                'Connection is closed')
+
+    def add_event(self, fn, due=0):
+        with self.cond:
+            self.events.append((due, fn))
+            self.cond.notify()
+
+    def add_callback_threadsafe(self, callback):
+        self._check_open()
+        self.add_event(callback)
+
+    def process_data_events(self, time_limit=0):
+        self._check_open()
+        deadline = time.time() + (time_limit or 0)
+        while True:
+            with self.cond:
+                now = time.time()
+                ready = []
+                while self.events and self.events[0][0] <= now:
+                    ready.append(self.events.popleft()[1])
+                if not ready:
+                    if now >= deadline:
+                        return
+                    wait = deadline - now
+                    if self.events:
+                        wait = min(wait, self.events[0][0] - now)
+                    self.cond.wait(wait)
+                    continue
+
+            for fn in ready:
+                fn()
+            return
+
+    def sleep(self, duration):
+        self.process_data_events(time_limit=duration)
+
+    def close(self):
+        if not self.is_open:
+            return
+        for channel in list(self.channels):
+            channel.close()
+        self.is_open = False
+        self.is_closed = True
+        with self.broker.lock:
+            if self in self.broker.connections:
+                self.broker.connections.remove(self)
+
+
+class _AsyncChannel(object):
+    """FakeChannel._impl：底层异步通道的接口，调用不等待broker回复"""
+
+    def __init__(self, channel):
+        self.channel = channel
+
+    def exchange_declare(self, exchange, exchange_type='direct', passive=False,
+                         durable=False, auto_delete=False, internal=False,
+                         arguments=None, callback=None):
+        self.channel._nowait(self.channel.broker.exchange_declare, exchange,
+                             exchange_type, passive)
+
+    def queue_declare(self, queue, passive=False, durable=False,
+                      exclusive=False, auto_delete=False, arguments=None,
+                      callback=None):
+        self.channel._nowait(self.channel.broker.queue_declare, queue, passive,
+                             durable, exclusive, auto_delete, arguments)
+
+    def queue_bind(self, queue, exchange, routing_key=None, arguments=None,
+                   callback=None):
+        self.channel._nowait(self.channel.broker.queue_bind, queue, exchange,
+                             routing_key)
+
+    def confirm_delivery(self, ack_nack_callback, callback=None):
+        self.channel.on_confirm = ack_nack_callback
+        self.channel.confirming = True
+
+    def add_on_return_callback(self, callback):
+        self.channel.on_return = callback
+
+    def basic_publish(self, exchange, routing_key, body, properties=None,
+                      mandatory=False):
+        self.channel._publish(exchange, routing_key, body, properties,
+                              mandatory)
+
+
+class FakeChannel(object):
+    """替代 pika.BlockingChannel"""
+
+    # direct reply-to 的 routing key -> 通道
+    by_reply_key = {}
+
+    def __init__(self, connection, number):
+        self.connection = connection
+        self.broker = connection.broker
+        self.channel_number = number
+        self.is_open = True
+        self.closed_error = None
+        self._impl = _AsyncChannel(self)
+        self._delivery_confirmation = False
+        self.confirming = False
+        self.on_confirm = None
+        self.on_return = None
+        self.publish_tag = 0
+        # 尚未发给客户端的确认：[到期时间, 最大的delivery tag]
+        self.pending_ack = None
+        self._delivery_tags = itertools.count(1)
+        self.unacked = {}
+        # 已经投递给回调消费者、还没有调用回调的消息：delivery tag -> consumer tag
+        self.undispatched = {}
+        self.prefetch_count = 0
+        self.consumers = {}
+        self.reply_consumer = None
+        self.reply_key = None
+        # consume() 的缓冲区和消费者
+        self.buffered = deque()
+        self.generator_consumer = None
+        self.consuming = False
+
+    def next_delivery_tag(self):
+        return next(self._delivery_tags)
+
+    # ---- 状态 ----
+
+    def _check_open(self):
+        if self.closed_error is not None:
+            raise self.closed_error
+        if not self.is_open:
+            raise pika.exceptions.ChannelWrongStateError('Channel is closed')
+
+    def _fail(self, error):
+        """broker关闭通道：之后的同步调用抛出这个异常"""
+        self.closed_error = error
+        self._close()
+
+    def _nowait(self, fn, *args):
+        self._check_open()
+        try:
+            fn(*args)
+        except pika.exceptions.ChannelClosedByBroker as e:
+            self._fail(e)
+
+    def _sync(self, fn, *args):
+        self._check_open()
+        if self.broker.rtt:
+            time.sleep(self.broker.rtt)
+        try:
+            return fn(*args)
+        except pika.exceptions.ChannelClosedByBroker as e:
+            self._fail(e)
+            raise
+
+    def _close(self):
+        if not self.is_open:
+            return
+        self.is_open = False
+        with self.broker.lock:
+            for consumer in list(self.consumers.values()):
+                # direct reply-to 的消费者没有队列
+                if consumer.queue is not None \
+                        and consumer in consumer.queue.consumers:
+                    consumer.queue.consumers.remove(consumer)
+            self.consumers = {}
+            if self.reply_key:
+                self.by_reply_key.pop(self.reply_key, None)
+        # 未确认的消息放回队列
+        unacked, self.unacked = self.unacked, {}
+        self.broker.requeue(list(unacked.values()))
+
+    def close(self):
+        self._close()
+        if self in self.connection.channels:
+            self.connection.channels.remove(self)
+
+    # ---- 拓扑 ----
+
+    def exchange_declare(self, exchange, exchange_type='direct', passive=False,
+                         durable=False, auto_delete=False, internal=False,
+                         arguments=None):
+        self._sync(self.broker.exchange_declare, exchange, exchange_type,
+                   passive)
+        return pika.frame.Method(self.channel_number,
+                                 pika.spec.Exchange.DeclareOk())
+
+    def queue_declare(self, queue, passive=False, durable=False,
+                      exclusive=False, auto_delete=False, arguments=None):
+        count, consumers = self._sync(self.broker.queue_declare, queue, passive,
+                                      durable, exclusive, auto_delete,
+                                      arguments)
+        return pika.frame.Method(self.channel_number, pika.spec.Queue.DeclareOk(
+            queue=queue, message_count=count, consumer_count=consumers))
+
+    def queue_bind(self, queue, exchange, routing_key=None, arguments=None):
+        self._sync(self.broker.queue_bind, queue, exchange, routing_key)
+        return pika.frame.Method(self.channel_number, pika.spec.Queue.BindOk())
+
+    def queue_purge(self, queue):
+        count = self._sync(self.broker.queue_purge, queue)
+        return pika.frame.Method(self.channel_number,
+                                 pika.spec.Queue.PurgeOk(message_count=count))
+
+    def basic_qos(self, prefetch_size=0, prefetch_count=0, global_qos=False):
+        self._sync(lambda: None)
+        self.prefetch_count = prefetch_count
+        self.broker.dispatch_all()
+
+    # ---- 发布 ----
+
+    def confirm_delivery(self):
+        self._sync(lambda: None)
+        self._delivery_confirmation = True
+
+    def _publish(self, exchange, routing_key, body, properties, mandatory):
+        self._check_open()
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        if exchange == '' and routing_key == REPLY_TO and self.reply_key:
+            routing_key = self.reply_key
+        if properties is not None and properties.reply_to == REPLY_TO:
+            if self.reply_key is None:
+                raise pika.exceptions.ChannelClosedByBroker(
+                    406, 'PRECONDITION_FAILED - reply consumer not set up')
+            properties = pika.BasicProperties(**dict(
+                properties.__dict__, reply_to=self.reply_key))
+        try:
+            routed = self.broker.publish(exchange, routing_key, body,
+                                         properties)
+        except pika.exceptions.ChannelClosedByBroker as e:
+            self._fail(e)
+            return 0
+
+        if self.confirming:
+            self.publish_tag += 1
+            if mandatory and not routed:
+                # Basic.Return 先于对应的 Basic.Ack 到达
+                method = pika.spec.Basic.Return(312, 'NO_ROUTE', exchange,
+                                                routing_key)
+                self.pending_ack = None
+                self.connection.add_event(
+                    lambda: self.on_return and self.on_return(
+                        self, method, properties, body))
+            self._queue_ack(self.publish_tag)
+        return routed
+
+    def _queue_ack(self, tag):
+        # 与RabbitMQ一样，同一段时间内的确认合并为一个 multiple ack
+        with self.broker.lock:
+            if self.pending_ack is not None:
+                self.pending_ack[1] = tag
+                return
+            pending = self.pending_ack = [time.time() + self.broker.rtt, tag]
+
+        def _ack():
+            with self.broker.lock:
+                if self.pending_ack is pending:
+                    self.pending_ack = None
+            if self.on_confirm and self.is_open:
+                self.on_confirm(pika.frame.Method(
+                    self.channel_number,
+                    pika.spec.Basic.Ack(delivery_tag=pending[1], multiple=True)))
+
+        self.connection.add_event(_ack, due=pending[0])
+
+    def basic_publish(self, exchange, routing_key, body, properties=None,
+                      mandatory=False):
+        self._check_open()
+        if not self._delivery_confirmation:
+            self._publish(exchange, routing_key, body, properties, mandatory)
+            return
+        if self.broker.rtt:
+            time.sleep(self.broker.rtt)
+        routed = self._publish(exchange, routing_key, body, properties,
+                               mandatory)
+        self._check_open()
+        if mandatory and not routed:
+            raise pika.exceptions.UnroutableError([body])
+
+    # ---- 消费 ----
+
+    def deliver(self, consumer, message, tag):
+        """由broker调用(持有broker锁)，消息在连接线程上交给消费者"""
+        method = pika.spec.Basic.Deliver(consumer.tag, tag, message.redelivered,
+                                         message.exchange, message.routing_key)
+        if consumer.callback is None:
+            def _buffer():
+                self.buffered.append((method, message.properties, message.body))
+            self.connection.add_event(_buffer)
+            return
+
+        if not consumer.auto_ack:
+            self.undispatched[tag] = consumer.tag
+
+        def _call():
+            if self.undispatched.pop(tag, None) is None and not consumer.auto_ack:
+                # 消费者已经取消，消息已经放回队列
+                return
+            if self.is_open and consumer.tag in self.consumers:
+                consumer.callback(self, method, message.properties,
+                                  message.body)
+        self.connection.add_event(_call)
+
+    def basic_consume(self, queue, on_message_callback, auto_ack=False,
+                      exclusive=False, consumer_tag=None, arguments=None):
+        self._check_open()
+        tag = consumer_tag or 'ctag%d.%d' % (self.channel_number,
+                                             len(self.consumers) + 1)
+        if queue == REPLY_TO:
+            self.reply_key = '%s.%x.%d' % (REPLY_TO, id(self), self.channel_number)
+            self.reply_consumer = _Consumer(self, None, tag,
+                                            on_message_callback, True)
+            self.consumers[tag] = self.reply_consumer
+            self.by_reply_key[self.reply_key] = self
+            return tag
+
+        with self.broker.lock:
+            q = self.broker.queues.get(queue)
+            if q is None:
+                self._fail(pika.exceptions.ChannelClosedByBroker(
+                    404, "NOT_FOUND - no queue '%s'" % queue))
+                raise self.closed_error
+            consumer = _Consumer(self, q, tag, on_message_callback, auto_ack)
+            self.consumers[tag] = consumer
+            q.consumers.append(consumer)
+            self.broker._dispatch(q)
+        return tag
+
+    def basic_cancel(self, consumer_tag):
+        self._check_open()
+        with self.broker.lock:
+            consumer = self.consumers.pop(consumer_tag, None)
+            if consumer is not None and consumer.queue is not None \
+                    and consumer in consumer.queue.consumers:
+                consumer.queue.consumers.remove(consumer)
+            # 与pika一样，已经收到但还没交给回调的消息被nack并放回队列
+            tags = [t for t, c in self.undispatched.items() if c == consumer_tag]
+            for tag in tags:
+                del self.undispatched[tag]
+        self._requeue_tags(tags)
+        return []
+
+    def start_consuming(self):
+        self.consuming = True
+        while self.consuming and self.consumers and self.is_open:
+            self.connection.process_data_events(time_limit=1)
+        self._check_open()
+
+    def stop_consuming(self, consumer_tag=None):
+        self.consuming = False
+        for tag in list(self.consumers):
+            self.basic_cancel(tag)
+
+    def consume(self, queue, auto_ack=False, exclusive=False, arguments=None,
+                inactivity_timeout=None):
+        if self.generator_consumer is None:
+            tag = self.basic_consume(queue, None, auto_ack=auto_ack)
+            self.generator_consumer = tag
+        while True:
+            if self.buffered:
+                yield self.buffered.popleft()
+                continue
+            deadline = None if inactivity_timeout is None \
+                else time.time() + inactivity_timeout
+            while not self.buffered:
+                remaining = 1 if deadline is None else deadline - time.time()
+                if remaining <= 0:
+                    break
+                self.connection.process_data_events(time_limit=remaining)
+                self._check_open()
+            if not self.buffered:
+                yield None, None, None
+
+    def cancel(self):
+        """取消consume()的消费者，已缓冲但还没有取走的消息放回队列"""
+        if self.generator_consumer is None:
+            return 0
+        self.basic_cancel(self.generator_consumer)
+        self.generator_consumer = None
+        # 已经在事件队列中的投递先放进缓冲区
+        self.connection.process_data_events(time_limit=0)
+        buffered, self.buffered = self.buffered, deque()
+        tags = [method.delivery_tag for method, _, _ in buffered]
+        self._requeue_tags(tags)
+        return len(tags)
+
+    def basic_get(self, queue, auto_ack=False):
+        result, remaining = self._sync(self.broker.get, self, queue, auto_ack)
+        if result is None:
+            return None, None, None
+        tag, message = result
+        method = pika.spec.Basic.GetOk(tag, message.redelivered,
+                                       message.exchange, message.routing_key,
+                                       remaining)
+        return method, message.properties, message.body
+
+    # ---- 确认 ----
+
+    def _tags(self, delivery_tag, multiple):
+        if multiple:
+            return sorted(t for t in self.unacked
+                          if delivery_tag == 0 or t <= delivery_tag)
+        if delivery_tag not in self.unacked:
+            self._fail(pika.exceptions.ChannelClosedByBroker(
+                406, 'PRECONDITION_FAILED - unknown delivery tag %d'
+                     % delivery_tag))
+            raise self.closed_error
+        return [delivery_tag]
+
+    def _requeue_tags(self, tags):
+        with self.broker.lock:
+            items = [self.unacked.pop(t) for t in tags if t in self.unacked]
+        self.broker.requeue(items)
+
+    def basic_ack(self, delivery_tag=0, multiple=False):
+        self._check_open()
+        with self.broker.lock:
+            for tag in self._tags(delivery_tag, multiple):
+                self.unacked.pop(tag)
+            self.broker.dispatch_all()
+
+    def basic_nack(self, delivery_tag=0, multiple=False, requeue=True):
+        self._check_open()
+        with self.broker.lock:
+            tags = self._tags(delivery_tag, multiple)
+            if requeue:
+                self._requeue_tags(tags)
+            else:
+                for tag in tags:
+                    self.unacked.pop(tag)
+            self.broker.dispatch_all()
+
+    def basic_reject(self, delivery_tag, requeue=True):
+        self.basic_nack(delivery_tag, multiple=False, requeue=requeue)
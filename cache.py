@@ -1,8 +1,75 @@
+import math
+import pickle
+import random
+import sys
+import time as _time
+import traceback
+from collections import OrderedDict
+from collections.abc import MutableMapping
+from concurrent.futures import Future
+from threading import Lock, RLock, Thread
+
 from utils._utils import prefix_keys
+
+try:
+    import pylibmc
+except ImportError:
+    pylibmc = None
+
+
+class NoneResult(object):
+    """负缓存的标记：这个键在最底层的缓存中也不存在
+
+    用类本身作为标记，经过pickle后仍然是同一个对象，可以存入memcached。
+    """
+
+
+class _Computed(object):
+    """get_or_compute 保存的值：计算结果、计算用时(秒)和逻辑上的过期时间戳(0为不过期)"""
+    __slots__ = ('value', 'delta', 'expires')
+
+    def __init__(self, value, delta, expires):
+        self.value = value
+        self.delta = delta
+        self.expires = expires
+
+    def __getstate__(self):
+        return (self.value, self.delta, self.expires)
+
+    def __setstate__(self, state):
+        self.value, self.delta, self.expires = state
+
+
+# 正在计算的键：(缓存对象的id, key) -> Future，保证每个进程中一个键同时只计算一次
+_flights = {}
+_flights_lock = Lock()
+
+
+def _join_flight(flight_key):
+    """返回 (future, 是否由调用方负责计算)"""
+    with _flights_lock:
+        future = _flights.get(flight_key)
+        if future is not None:
+            return future, False
+        future = _flights[flight_key] = Future()
+        return future, True
+
+
+def _finish_flight(flight_key, future, value=None, error=None):
+    with _flights_lock:
+        _flights.pop(flight_key, None)
+    if error is not None:
+        future.set_exception(error)
+    else:
+        future.set_result(value)
+
+
 class CacheUtils(object):
     # Caches that never expire entries should set this to true, so that
     # CacheChain can properly count hits and misses.
     permanent = False
+    # 在CacheChain的统计中这一层的名字
+    stat_name = 'cache'
 
     def incr_multi(self, keys, delta=1, prefix=''):
         for k in keys:
@@ -12,19 +79,84 @@ class CacheUtils(object):
                 pass
 
     def add_multi(self, keys, prefix='', time=0):
-        for k,v in keys.iteritems():
+        for k,v in keys.items():
             self.add(prefix+str(k), v, time = time)
 
     def get_multi(self, keys, prefix='', **kw):
         return prefix_keys(keys, prefix, lambda k: self.simple_get_multi(k, **kw))
 
+    def get_or_compute(self, key, fn, ttl=0, beta=1.0, stale_ttl=0,
+                       timeout=None):
+        """读取key，不存在或已过期时调用fn()计算并缓存ttl秒
+
+        - 同一个进程中一个键同时只有一个线程在计算，其他线程等待它的结果
+          (最多timeout秒，fn抛出的异常同样传给等待的线程)。
+        - beta>0时按XFetch提前过期：越接近过期、计算越慢，越可能有一个调用方提前
+          重新计算，其他调用方继续读到旧值。beta=0时关闭。
+        - stale_ttl>0时，过期后stale_ttl秒内仍然返回旧值，同时在后台重新计算。
+
+        值以_Computed的形式保存，这些键只应该通过get_or_compute读取。
+        """
+        now = _time.time()
+        entry = self.get(key)
+        if isinstance(entry, _Computed):
+            if not entry.expires:
+                return entry.value
+            if now < entry.expires:
+                early = beta and entry.delta and (
+                    now - entry.delta * beta * math.log(1.0 - random.random())
+                    >= entry.expires)
+                if not early:
+                    return entry.value
+                # 提前重新计算：正在计算时直接返回旧值
+                future, leader = _join_flight((id(self), key))
+                if not leader:
+                    return entry.value
+                return self._compute(key, fn, ttl, stale_ttl, future)
+            if now < entry.expires + stale_ttl:
+                future, leader = _join_flight((id(self), key))
+                if leader:
+                    t = Thread(target=self._compute,
+                               args=(key, fn, ttl, stale_ttl, future, True))
+                    t.daemon = True
+                    t.start()
+                return entry.value
+
+        future, leader = _join_flight((id(self), key))
+        if not leader:
+            return future.result(timeout)
+        return self._compute(key, fn, ttl, stale_ttl, future)
+
+    def _compute(self, key, fn, ttl, stale_ttl, future, background=False):
+        start = _time.time()
+        try:
+            value = fn()
+        except Exception as e:
+            _finish_flight((id(self), key), future, error=e)
+            if background:
+                # 后台刷新失败时继续使用旧值，直到stale_ttl用完
+                traceback.print_exc()
+                return None
+            raise
+
+        now = _time.time()
+        try:
+            entry = _Computed(value, now - start, now + ttl if ttl else 0)
+            self.set(key, entry, time=ttl + stale_ttl if ttl else 0)
+        finally:
+            _finish_flight((id(self), key), future, value)
+        return value
+
 
 
 class HardCache(CacheUtils):
     backend = None
     permanent = True
+    stat_name = 'hardcache'
 
     def __init__(self, gc):
+        # 数据库相关的模块只在真正使用HardCache时才导入
+        from hardcachebackend import HardCacheBackend
         self.backend = HardCacheBackend(gc)
 
     def _split_key(self, key):
@@ -43,26 +175,42 @@ class HardCache(CacheUtils):
         category, ids = self._split_key(key)
         self.backend.set(category, ids, val, time)
 
-    def simple_get_multi(self, keys):
-        results = {}
+    def _bundles(self, keys, prefix=''):
+        """按category分组：{category: [(ids, 原来的key), ...]}"""
         category_bundles = {}
         for key in keys:
-            category, ids = self._split_key(key)
-            category_bundles.setdefault(category, []).append(ids)
+            category, ids = self._split_key(prefix + str(key))
+            category_bundles.setdefault(category, []).append((ids, key))
+        return category_bundles
 
-        for category in category_bundles:
-            idses = category_bundles[category]
-            chunks = in_chunks(idses, size=50)
-            for chunk in chunks:
-                new_results = self.backend.get_multi(category, chunk)
-                results.update(new_results)
-
-        return results
+    def simple_get_multi(self, keys):
+        # 所有category一起按chunk批量查询
+        return self.backend.get_many(dict(
+            (category, [ids for ids, _ in items])
+            for category, items in self._bundles(keys).items()))
 
     def set_multi(self, keys, prefix='', time=0):
-        for k,v in keys.iteritems():
-            if v != NoneResult:
-                self.set(prefix+str(k), v, time=time)
+        keys = dict((k, v) for k, v in keys.items() if v != NoneResult)
+        self.backend.set_multi(dict(
+            (category, dict((ids, keys[k]) for ids, k in items))
+            for category, items in self._bundles(keys, prefix).items()),
+            time=time)
+
+    def add_multi(self, keys, prefix='', time=0):
+        return self.backend.add_multi(dict(
+            (category, dict((ids, keys[k]) for ids, k in items))
+            for category, items in self._bundles(keys, prefix).items()),
+            time=time)
+
+    def delete_multi(self, keys, prefix=''):
+        self.backend.delete_multi(dict(
+            (category, [ids for ids, _ in items])
+            for category, items in self._bundles(keys, prefix).items()))
+
+    def incr_multi(self, keys, delta=1, prefix=''):
+        return self.backend.incr_multi(dict(
+            (category, dict((ids, delta) for ids, _ in items))
+            for category, items in self._bundles(keys, prefix).items()))
 
     def get(self, key, default=None):
         category, ids = self._split_key(key)
@@ -86,72 +234,254 @@ class HardCache(CacheUtils):
 
 
 
-class LocalCache(dict, CacheUtils):
-    def __init__(self, *a, **kw):
-        return dict.__init__(self, *a, **kw)
+# memcached的约定：超过30天的过期时间是绝对的unix时间戳，否则是相对的秒数
+MAX_RELATIVE_TIME = 60 * 60 * 24 * 30
+
+
+def _expiration(time, now=None):
+    """把set/add的time参数换算成过期的时间戳，0表示永不过期"""
+    if not time:
+        return 0
+    if time > MAX_RELATIVE_TIME:
+        return time
+    return (now or _time.time()) + time
+
+
+def _approx_size(obj, depth=2):
+    """估计对象占用的内存(字节)，容器和对象的属性只往下计算depth层"""
+    size = sys.getsizeof(obj)
+    if isinstance(obj, _Computed):
+        # get_or_compute 的包装不算一层
+        return size + _approx_size(obj.value, depth)
+    if depth <= 0 or isinstance(obj, (str, bytes, bytearray, int, float)):
+        return size
+    if isinstance(obj, dict):
+        for k, v in obj.items():
+            size += _approx_size(k, depth - 1) + _approx_size(v, depth - 1)
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        for item in obj:
+            size += _approx_size(item, depth - 1)
+    else:
+        # 普通对象：getsizeof不包括 __dict__ 和 __slots__ 中的属性值
+        attrs = getattr(obj, '__dict__', None)
+        if isinstance(attrs, dict):
+            size += _approx_size(attrs, depth)
+        for cls in type(obj).__mro__:
+            slots = cls.__dict__.get('__slots__', ())
+            for name in (slots,) if isinstance(slots, str) else slots:
+                if name not in ('__dict__', '__weakref__') and hasattr(obj, name):
+                    size += _approx_size(getattr(obj, name), depth - 1)
+    return size
+
+
+class LocalCache(MutableMapping, CacheUtils):
+    """进程内的缓存，有条数和内存上限，按LRU淘汰
+
+    set/add等方法的time参数与memcached相同：0为永不过期，不超过30天时是相对的
+    秒数，否则是绝对的时间戳；过期的条目在读取、淘汰、迭代或len()时删除。
+    max_entries 和 max_bytes (按 _approx_size 估计的键和值的大小)为0时不限制。
+    hits / misses / evictions / expirations 记录了命中、未命中、因为超过上限被淘汰
+    以及过期被删除的次数(见counters())。
+
+    条目保存在内部的OrderedDict中；作为映射使用(迭代、pop、copy等)时同样经过
+    过期检查和内存统计，迭代的是当时的键的快照。
+    """
+    stat_name = 'local'
+
+    def __init__(self, *a, max_entries=100000, max_bytes=64 * 1024 * 1024,
+                 **kw):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        # key -> 过期时间戳, key -> 估计的字节数
+        self._expires = {}
+        self._sizes = {}
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self._lock = RLock()
+        self._data = OrderedDict()
+        self.update(*a, **kw)
 
     def _check_key(self, key):
         if not isinstance(key, str):
             raise TypeError('Key is not a string: %r' % (key,))
 
+    def _remove(self, key):
+        del self._data[key]
+        self._expires.pop(key, None)
+        self.bytes -= self._sizes.pop(key, 0)
+
+    def _expired(self, key, now=None):
+        expires = self._expires.get(key)
+        return bool(expires) and expires <= (now or _time.time())
+
+    def _lookup(self, key, count=True):
+        """返回 (是否存在, 值)，过期的条目被删除；存在时移到LRU的最新端"""
+        with self._lock:
+            if key in self._data:
+                if not self._expired(key):
+                    self._data.move_to_end(key)
+                    if count:
+                        self.hits += 1
+                    return True, self._data[key]
+                self._remove(key)
+                self.expirations += 1
+            if count:
+                self.misses += 1
+            return False, None
+
+    def _store(self, key, val, expires):
+        size = _approx_size(key) + _approx_size(val)
+        with self._lock:
+            if self.max_bytes and size > self.max_bytes:
+                # 单独一条就超过内存上限的值不缓存
+                if key in self._data:
+                    self._remove(key)
+                self.evictions += 1
+                return
+            if key in self._data:
+                self.bytes -= self._sizes[key]
+            self._data[key] = val
+            self._data.move_to_end(key)
+            self._sizes[key] = size
+            self.bytes += size
+            if expires:
+                self._expires[key] = expires
+            else:
+                self._expires.pop(key, None)
+            self._evict()
+
+    def _evict(self):
+        while self._data and (
+                (self.max_entries and len(self._data) > self.max_entries) or
+                (self.max_bytes and self.bytes > self.max_bytes)):
+            key = next(iter(self._data))
+            if self._expired(key):
+                self.expirations += 1
+            else:
+                self.evictions += 1
+            self._remove(key)
+
+    def __getitem__(self, key):
+        found, val = self._lookup(key, count=False)
+        if not found:
+            raise KeyError(key)
+        return val
+
+    def __setitem__(self, key, val):
+        self._store(key, val, 0)
+
+    def __delitem__(self, key):
+        with self._lock:
+            if not self._lookup(key, count=False)[0]:
+                raise KeyError(key)
+            self._remove(key)
+
+    def __contains__(self, key):
+        return self._lookup(key, count=False)[0]
+
+    def _purge(self):
+        """删除所有已过期的条目"""
+        now = _time.time()
+        with self._lock:
+            for key in [k for k, expires in self._expires.items()
+                        if expires <= now]:
+                self._remove(key)
+                self.expirations += 1
+
+    def __iter__(self):
+        with self._lock:
+            self._purge()
+            keys = list(self._data)
+        return iter(keys)
+
+    def __len__(self):
+        # 与迭代一致，不计算已过期的条目
+        with self._lock:
+            self._purge()
+            return len(self._data)
+
+    def copy(self):
+        """同样上限的新缓存，保留条目的LRU顺序和过期时间"""
+        with self._lock:
+            new = self.__class__(max_entries=self.max_entries,
+                                 max_bytes=self.max_bytes)
+            for key in self:
+                new._store(key, self._data[key], self._expires.get(key, 0))
+            return new
+
     def get(self, key, default=None):
-        r = dict.get(self, key)
-        if r is None: return default
+        found, r = self._lookup(key)
+        if not found or r is None:
+            return default
         return r
 
     def simple_get_multi(self, keys):
         out = {}
         for k in keys:
-            try:
-                out[k] = self[k]
-            except KeyError:
-                pass
-        print("out",out)
+            found, r = self._lookup(k)
+            if found:
+                out[k] = r
         return out
 
-    def set(self, key, val, time = 0):
-        # time is ignored on localcache
+    def set(self, key, val, time=0):
         self._check_key(key)
-        self[key] = val
+        self._store(key, val, _expiration(time))
 
     def set_multi(self, keys, prefix='', time=0):
-        for k,v in keys.iteritems():
+        for k, v in keys.items():
             self.set(prefix+str(k), v, time=time)
 
-    def add(self, key, val, time = 0):
+    def add(self, key, val, time=0):
         self._check_key(key)
-        was = key in self
-        self.setdefault(key, val)
-        return not was
+        with self._lock:
+            if key in self:
+                return False
+            self._store(key, val, _expiration(time))
+            return True
 
     def delete(self, key):
-        if key in self:
-            del self[key]
+        with self._lock:
+            if key in self._data:
+                self._remove(key)
 
     def delete_multi(self, keys):
         for key in keys:
-            if key in self:
-                del self[key]
+            self.delete(key)
+
+    def _update(self, key, fn):
+        # 修改已有的值，保留原来的过期时间(与memcached一样)
+        with self._lock:
+            found, val = self._lookup(key, count=False)
+            if found:
+                self._store(key, fn(val), self._expires.get(key, 0))
+                return self[key]
 
     def incr(self, key, delta=1, time=0):
-        if key in self:
-            self[key] = int(self[key]) + delta
+        return self._update(key, lambda val: int(val) + delta)
 
     def decr(self, key, amt=1):
-        if key in self:
-            self[key] = int(self[key]) - amt
+        return self._update(key, lambda val: int(val) - amt)
+
+    def append(self, key, val, time=0):
+        self._update(key, lambda old: str(old) + val)
 
-    def append(self, key, val, time = 0):
-        if key in self:
-            self[key] = str(self[key]) + val
+    def prepend(self, key, val, time=0):
+        self._update(key, lambda old: val + str(old))
 
-    def prepend(self, key, val, time = 0):
-        if key in self:
-            self[key] = val + str(self[key])
+    def replace(self, key, val, time=0):
+        with self._lock:
+            if key in self:
+                self._store(key, val, _expiration(time))
 
-    def replace(self, key, val, time = 0):
-        if key in self:
-            self[key] = val
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._expires.clear()
+            self._sizes.clear()
+            self.bytes = 0
 
     def flush_all(self):
         self.clear()
@@ -159,32 +489,335 @@ class LocalCache(dict, CacheUtils):
     def reset(self):
         self.clear()
 
+    def counters(self):
+        return dict(hits=self.hits, misses=self.misses,
+                    evictions=self.evictions, expirations=self.expirations,
+                    entries=len(self), bytes=self.bytes)
+
     def __repr__(self):
         return "<LocalCache(%d)>" % (len(self),)
 
 
-# 示例1：定义一个映射函数map_fn
-def map_fn(key):
-    return f"mapped_{key}"
+def _check_memcache_key(key):
+    if not isinstance(key, str):
+        raise TypeError('Key is not a string: %r' % (key,))
+    if len(key) > 250 or any(c in key for c in ' \t\r\n\x00'):
+        raise ValueError('Invalid memcache key: %r' % (key,))
+
+
+class InProcessMemcache(CacheUtils):
+    """进程内的memcached替身，用于测试和基准测试
+
+    与memcached的语义相同：值以pickle保存(读出的是副本)，time的含义与LocalCache
+    相同，incr/decr只对已有的整数值有效。latency 模拟每次调用的网络往返时间(秒)。
+    """
+    stat_name = 'memcache'
+
+    def __init__(self, latency=0):
+        self.latency = latency
+        # key -> (pickle后的值, 过期时间戳)
+        self._data = {}
+        self._lock = RLock()
+
+    def _wait(self):
+        if self.latency:
+            _time.sleep(self.latency)
+
+    def _get(self, key):
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        value, expires = entry
+        if expires and expires <= _time.time():
+            del self._data[key]
+            return None
+        return entry
 
-# 示例2：定义一个处理函数call_fn
-def call_fn(keys):
-    return {key: key * 2 for key in keys}
+    def get(self, key, default=None):
+        self._wait()
+        with self._lock:
+            entry = self._get(key)
+        return pickle.loads(entry[0]) if entry else default
+
+    def simple_get_multi(self, keys):
+        self._wait()
+        out = {}
+        with self._lock:
+            for key in keys:
+                entry = self._get(key)
+                if entry:
+                    out[key] = entry[0]
+        return dict((k, pickle.loads(v)) for k, v in out.items())
+
+    def _set(self, key, val, time):
+        _check_memcache_key(key)
+        self._data[key] = (pickle.dumps(val, pickle.HIGHEST_PROTOCOL),
+                           _expiration(time))
+
+    def set(self, key, val, time=0):
+        self._wait()
+        with self._lock:
+            self._set(key, val, time)
+        return True
+
+    def set_multi(self, keys, prefix='', time=0):
+        self._wait()
+        with self._lock:
+            for k, v in keys.items():
+                self._set(prefix + str(k), v, time)
+        return []
+
+    def add(self, key, val, time=0):
+        self._wait()
+        with self._lock:
+            if self._get(key):
+                return False
+            self._set(key, val, time)
+            return True
+
+    def replace(self, key, val, time=0):
+        self._wait()
+        with self._lock:
+            if not self._get(key):
+                return False
+            self._set(key, val, time)
+            return True
+
+    def delete(self, key, time=0):
+        self._wait()
+        with self._lock:
+            return self._data.pop(key, None) is not None
+
+    def delete_multi(self, keys, prefix=''):
+        self._wait()
+        with self._lock:
+            for key in keys:
+                self._data.pop(prefix + str(key), None)
+        return True
+
+    def incr(self, key, delta=1, time=0):
+        self._wait()
+        with self._lock:
+            entry = self._get(key)
+            if not entry:
+                return None
+            value = int(pickle.loads(entry[0])) + delta
+            self._data[key] = (pickle.dumps(value), entry[1])
+            return value
+
+    def decr(self, key, amt=1):
+        return self.incr(key, -amt)
+
+    def flush_all(self):
+        with self._lock:
+            self._data.clear()
+
+
+class CMemcache(CacheUtils):
+    """memcached集群(通过pylibmc)，每个线程从连接池中借用客户端"""
+    stat_name = 'memcache'
+
+    def __init__(self, servers, num_clients=16, binary=True, behaviors=None):
+        if pylibmc is None:
+            raise ImportError("CMemcache requires pylibmc")
+        client = pylibmc.Client(servers, binary=binary)
+        client.behaviors.update(behaviors or {"tcp_nodelay": True,
+                                              "ketama": True})
+        self.clients = pylibmc.ClientPool(client, num_clients)
+
+    def get(self, key, default=None):
+        with self.clients.reserve() as mc:
+            ret = mc.get(key)
+        return default if ret is None else ret
 
-# 示例3：定义一个键的列表
-keys = [1, 2, 3, 4]
+    def simple_get_multi(self, keys):
+        with self.clients.reserve() as mc:
+            return mc.get_multi(list(keys))
+
+    def set(self, key, val, time=0):
+        with self.clients.reserve() as mc:
+            return mc.set(key, val, time=time)
+
+    def set_multi(self, keys, prefix='', time=0):
+        new_keys = dict((prefix + str(k), v) for k, v in keys.items())
+        with self.clients.reserve() as mc:
+            return mc.set_multi(new_keys, time=time)
+
+    def add(self, key, val, time=0):
+        with self.clients.reserve() as mc:
+            return mc.add(key, val, time=time)
+
+    def replace(self, key, val, time=0):
+        with self.clients.reserve() as mc:
+            try:
+                return mc.replace(key, val, time=time)
+            except pylibmc.NotFound:
+                return False
+
+    def delete(self, key, time=0):
+        with self.clients.reserve() as mc:
+            return mc.delete(key)
+
+    def delete_multi(self, keys, prefix=''):
+        with self.clients.reserve() as mc:
+            return mc.delete_multi([prefix + str(k) for k in keys])
 
-# 示例4：调用prefix_keys函数
-result = prefix_keys(keys, "prefix_", call_fn)
+    def incr(self, key, delta=1, time=0):
+        with self.clients.reserve() as mc:
+            try:
+                return mc.incr(key, delta)
+            except pylibmc.NotFound:
+                return None
 
-print(call_fn(keys))
-# 示例5：输出结果
-print(result)
-local_cache = LocalCache()
-local_cache.update(a=12)
-local_cache.update(b=13)
-local_cache.incr("a")
-local_cache.prepend("a", 14)
-print(local_cache.simple_get_multi(("a", "b")))
-print(local_cache["c"])
+    def decr(self, key, amt=1):
+        with self.clients.reserve() as mc:
+            try:
+                return mc.decr(key, amt)
+            except pylibmc.NotFound:
+                return None
 
+    def flush_all(self):
+        with self.clients.reserve() as mc:
+            mc.flush_all()
+
+
+class CacheChain(CacheUtils):
+    """多层的读穿透缓存，如 LocalCache -> memcached -> HardCache
+
+    读取时从上到下逐层查找，在下层命中的值回填到它上面的各层(backfill_time秒后
+    过期，下层中值的过期时间是不知道的，所以应该保持较短；0为永不过期)；写入和删除
+    作用于所有层。cache_negative_results为True时，所有层都没有的键以NoneResult缓存
+    在除最底层以外的各层(negative_time秒)，之后的读取不会再落到最底层；在下层找到的
+    NoneResult同样只回填negative_time秒。
+
+    传入stats(stats.Stats)时，每次读取通过 cache_count_multi 报告每一层的命中/未命中
+    数(<层名>.hit / <层名>.miss)，以及整个链的结果(chain.hit / chain.miss，在permanent
+    的层中才找到的也算作未命中)。stat_subname 不为None时加在名字前面。
+    """
+
+    def __init__(self, caches, cache_negative_results=False, negative_time=60,
+                 backfill_time=30, stats=None):
+        self.caches = list(caches)
+        self.cache_negative_results = cache_negative_results
+        self.negative_time = negative_time
+        self.backfill_time = backfill_time
+        self.stats = stats
+
+    def _make_set_fn(fn_name):
+        def fn(self, *a, **kw):
+            ret = None
+            for c in self.caches:
+                ret = getattr(c, fn_name)(*a, **kw)
+            return ret
+        fn.__name__ = fn_name
+        return fn
+
+    set = _make_set_fn('set')
+    set_multi = _make_set_fn('set_multi')
+    # 作用于每一层，返回值是最底层的结果
+    add = _make_set_fn('add')
+    replace = _make_set_fn('replace')
+    incr = _make_set_fn('incr')
+    decr = _make_set_fn('decr')
+    delete = _make_set_fn('delete')
+    delete_multi = _make_set_fn('delete_multi')
+    flush_all = _make_set_fn('flush_all')
+    del _make_set_fn
+
+    def _caches(self, allow_local):
+        return [c for c in self.caches
+                if allow_local or not isinstance(c, LocalCache)]
+
+    def _report(self, data, stat_subname):
+        if not self.stats or not data:
+            return
+        if stat_subname:
+            data = dict(('%s.%s' % (stat_subname, k), v)
+                        for k, v in data.items())
+        self.stats.cache_count_multi(data)
+
+    def get(self, key, default=None, allow_local=True, stat_subname=None):
+        return self.simple_get_multi([key], allow_local=allow_local,
+                                     stat_subname=stat_subname).get(key, default)
+
+    def get_multi(self, keys, prefix='', allow_local=True, stat_subname=None):
+        return prefix_keys(keys, prefix, lambda ks: self.simple_get_multi(
+            ks, allow_local=allow_local, stat_subname=stat_subname))
+
+    def simple_get_multi(self, keys, allow_local=True, stat_subname=None):
+        caches = self._caches(allow_local)
+        need = set(keys)
+        out = {}
+        data = {}
+        # 在非permanent的层中命中的键数，permanent层命中的算作整个链未命中
+        hits = 0
+        for i, c in enumerate(caches):
+            if not need:
+                break
+            found = c.simple_get_multi(list(need))
+            for outcome, count in (('hit', len(found)),
+                                   ('miss', len(need) - len(found))):
+                name = '%s.%s' % (c.stat_name, outcome)
+                data[name] = data.get(name, 0) + count
+            if not found:
+                continue
+            if not c.permanent:
+                hits += len(found)
+            # 回填上面的各层，负缓存的结果按negative_time回填
+            values = dict((k, v) for k, v in found.items()
+                          if v is not NoneResult)
+            negative = dict((k, v) for k, v in found.items()
+                            if v is NoneResult)
+            for upper in caches[:i]:
+                if values:
+                    upper.set_multi(values, time=self.backfill_time)
+                if negative:
+                    upper.set_multi(negative, time=self.negative_time)
+            out.update(found)
+            need.difference_update(found)
+
+        if need and self.cache_negative_results:
+            negative = dict((key, NoneResult) for key in need)
+            for c in caches[:-1]:
+                c.set_multi(negative, time=self.negative_time)
+
+        data['chain.hit'] = hits
+        data['chain.miss'] = len(set(keys)) - hits
+        self._report(data, stat_subname)
+        return dict((k, v) for k, v in out.items() if v is not NoneResult)
+
+    def reset(self):
+        """清空进程内的各层(如每个请求开始时)"""
+        for c in self.caches:
+            if isinstance(c, LocalCache):
+                c.reset()
+
+    def __repr__(self):
+        return '<%s %r>' % (self.__class__.__name__, self.caches)
+
+
+if __name__ == '__main__':
+    # 示例1：定义一个映射函数map_fn
+    def map_fn(key):
+        return f"mapped_{key}"
+
+    # 示例2：定义一个处理函数call_fn
+    def call_fn(keys):
+        return {key: key * 2 for key in keys}
+
+    # 示例3：定义一个键的列表
+    keys = [1, 2, 3, 4]
+
+    # 示例4：调用prefix_keys函数
+    result = prefix_keys(keys, "prefix_", call_fn)
+
+    print(call_fn(keys))
+    # 示例5：输出结果
+    print(result)
+    local_cache = LocalCache()
+    local_cache.update(a=12)
+    local_cache.update(b=13)
+    local_cache.incr("a")
+    local_cache.prepend("a", 14)
+    print(local_cache.simple_get_multi(("a", "b")))
+    print(local_cache["c"])
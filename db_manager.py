@@ -6,6 +6,7 @@ import socket
 import sqlalchemy
 import time
 import traceback
+from threading import Lock
 
 
 logger = logging.getLogger('dm_manager')
@@ -56,6 +57,9 @@ class db_manager:
         self._things = {}
         self._relations = {}
         self._engines = {}
+        # db_name -> (g_override, params) for engines not created yet
+        self._engine_params = {}
+        self._engines_lock = Lock()
         self.avoid_master_reads = {}
         self.dead = {}
 
@@ -71,14 +75,28 @@ class db_manager:
         self.avoid_master_reads[name] = avoid_master
 
     def setup_db(self, db_name, g_override=None, **params):
-        engine = get_engine(db_name, g_override=g_override, **params)
-        self._engines[db_name] = engine
+        # the engine (and its first connection) is only created when the
+        # database is first used, so importing and configuring is cheap for
+        # scripts that never touch most of the databases
+        with self._engines_lock:
+            self._engines.pop(db_name, None)
+            self._engine_params[db_name] = (g_override, params)
+
+    def _create_engine(self, db_name):
+        with self._engines_lock:
+            engine = self._engines.get(db_name)
+            if engine is not None:
+                return engine
+            g_override, params = self._engine_params[db_name]
+            engine = get_engine(db_name, g_override=g_override, **params)
+            self._engines[db_name] = engine
 
         if db_name not in ("email", "authorize", "hc", "traffic"):
             # test_engine creates a connection to the database, for some less
             # important and less used databases we will skip this and only
             # create the connection if it's needed
             self.test_engine(engine, g_override)
+        return engine
 
     def things_iter(self):
         for name, engines in self._things.iteritems():
@@ -117,10 +135,14 @@ class db_manager:
             return False
 
     def get_engine(self, name):
-        return self._engines[name]
+        engine = self._engines.get(name)
+        if engine is None:
+            engine = self._create_engine(name)
+        return engine
 
     def get_engines(self, names):
-        return [self._engines[name] for name in names if name in self._engines]
+        return [self.get_engine(name) for name in names
+                if name in self._engine_params]
 
     def get_read_table(self, tables):
         if len(tables) == 1:
@@ -129,37 +151,37 @@ class db_manager:
 
 
 
-# 创建 db_manager 实例
-db_manager_instance = db_manager()
+if __name__ == '__main__':
+    # 创建 db_manager 实例
+    db_manager_instance = db_manager()
 
-# 配置数据库连接信息
-db_manager_instance.setup_db(
-    "rytd",
-    db_host="localhost",
-    db_user="postgres",
-    db_pass="liu*963.",
-    db_port="5432",
-    pool_size=5,
-    max_overflow=5
-)
-
-# 添加事物
-# db_manager_instance.add_thing("users", [db_manager_instance.get_engine("my_db")])
+    # 配置数据库连接信息
+    db_manager_instance.setup_db(
+        "rytd",
+        db_host="localhost",
+        db_user="postgres",
+        db_pass="liu*963.",
+        db_port="5432",
+        pool_size=5,
+        max_overflow=5
+    )
 
-# 添加关系
-# db_manager_instance.add_relation("user_posts", "users", "posts",
-#     [db_manager_instance.get_engine("my_db")]
-# )
+    # 添加事物
+    # db_manager_instance.add_thing("users", [db_manager_instance.get_engine("my_db")])
 
-# 获取数据库引擎
-engine = db_manager_instance.get_engine("rytd")
+    # 添加关系
+    # db_manager_instance.add_relation("user_posts", "users", "posts",
+    #     [db_manager_instance.get_engine("my_db")]
+    # )
 
-# 测试数据库连接
-if db_manager_instance.test_engine(engine):
-    print("Database connection is alive.")
-else:
-    print("Database connection is dead.")
+    # 获取数据库引擎
+    engine = db_manager_instance.get_engine("rytd")
 
-# 标记数据库连接为死亡
-# db_manager_instance.mark_dead(engine)
+    # 测试数据库连接
+    if db_manager_instance.test_engine(engine):
+        print("Database connection is alive.")
+    else:
+        print("Database connection is dead.")
 
+    # 标记数据库连接为死亡
+    # db_manager_instance.mark_dead(engine)
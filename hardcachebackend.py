@@ -1,11 +1,41 @@
-import tdb_lite
+import logging
+import random
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from threading import Event, Lock, Thread
+
 import sqlalchemy as sa
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+from cache import MAX_RELATIVE_TIME
+from tdb_lite import tdb_lite
+from utils.utils import in_chunks
+
+# time=0(永不过期)的行使用的过期时间
+NEVER = datetime(9999, 1, 1, tzinfo=timezone.utc)
+
+logger = logging.getLogger('hardcache')
+
 
 class HardCacheBackend(object):
     def __init__(self, gc):
         self.tdb = tdb_lite(gc)
         self.profile_categories = {}
-        TZ = gc.display_tz
+        self.tz = getattr(gc, 'display_tz', None) or timezone.utc
+        # 批量操作每条SQL最多处理的行数，以及同时执行的SQL数
+        self.chunk_size = int(getattr(gc, 'hardcache_chunk_size', 500))
+        self.concurrency = int(getattr(gc, 'hardcache_concurrency', 4))
+        # 线程在第一次提交任务时才启动；在这里创建，多个线程同时调用_run时不会各建一个
+        self._executor = None
+        if self.concurrency > 1:
+            self._executor = ThreadPoolExecutor(
+                max_workers=self.concurrency, thread_name_prefix='hardcache')
+        # 清理过期行：start_sweeper()之后每sweep_interval秒一轮，每次删除sweep_batch行
+        self.sweep_interval = float(getattr(gc, 'hardcache_sweep_interval', 300))
+        self.sweep_batch = int(getattr(gc, 'hardcache_sweep_batch', 1000))
+        self._sweeper = None
+        self._sweeper_lock = Lock()
+        self._sweeper_stop = Event()
 
         def _table(metadata):
             """用于创建一个数据库表。该表具有category、ids、value、kind和expiration等列。这个函数在循环中处理一个列表中的项目，根据分隔符将项目拆分为不同的部分，并根据这些部分创建一个数据库表。最后，它将一个字典映射关系添加到该函数的实例中。"""
@@ -49,6 +79,282 @@ class HardCacheBackend(object):
             engines_by_enginename[enginename] = table
 
         self.mapping = {}
-        for category, enginenames in enginenames_by_category.iteritems():
+        for category, enginenames in enginenames_by_category.items():
             self.mapping[category] = [ engines_by_enginename[e]
                                        for e in enginenames]
+
+    def engine_by_category(self, category, type="master"):
+        """category对应的表：第一个是主库，其余的是只读的从库"""
+        if category not in self.mapping:
+            category = '*'
+        tables = self.mapping[category]
+        if type == 'master' or len(tables) == 1:
+            return tables[0]
+        elif type == 'readslave':
+            return random.choice(tables[1:])
+        else:
+            raise ValueError("unknown engine type %r" % type)
+
+    def _expiration(self, time):
+        if not time:
+            return NEVER
+        if time > MAX_RELATIVE_TIME:
+            return datetime.fromtimestamp(time, self.tz)
+        return datetime.now(self.tz) + timedelta(seconds=time)
+
+    def _row(self, category, ids, val, expiration):
+        value, kind = self.tdb.py2db(val, True)
+        if not isinstance(value, str):
+            value = str(value)
+        return dict(category=category, ids=str(ids), value=value, kind=kind,
+                    expiration=expiration)
+
+    def _run(self, jobs):
+        """执行 [(table, statement_fn, chunk), ...]，每个chunk一个事务
+
+        不同的chunk(包括不同库上的)最多同时执行concurrency个，返回每个
+        statement的结果行(列表)，顺序与jobs相同。
+        """
+        def _execute(job):
+            table, statement_fn, chunk = job
+            engine = table.metadata.info['engine']
+            with engine.begin() as conn:
+                result = conn.execute(statement_fn(table, chunk))
+                return result.fetchall() if result.returns_rows else []
+
+        if len(jobs) <= 1 or self._executor is None:
+            return [_execute(job) for job in jobs]
+        return list(self._executor.map(_execute, jobs))
+
+    def _jobs(self, bundles, statement_fn, type="master"):
+        """按category对应的表和chunk_size把 {category: items} 拆成jobs"""
+        by_table = {}
+        for category, items in bundles.items():
+            table = self.engine_by_category(category, type)
+            by_table.setdefault(table, []).extend(
+                (category, item) for item in items)
+        return [(table, statement_fn, chunk)
+                for table, items in by_table.items()
+                for chunk in in_chunks(items, size=self.chunk_size)]
+
+    def _match(self, table, chunk):
+        """WHERE (category, ids) IN (...)"""
+        return sa.tuple_(table.c.category, table.c.ids).in_(
+            [(category, str(ids)) for category, ids in chunk])
+
+    def get_many(self, bundles):
+        """{category: [ids, ...]} -> {"category-ids": value}，不返回过期的行"""
+        now = datetime.now(self.tz)
+
+        def _select(table, chunk):
+            return sa.select(table.c.category, table.c.ids, table.c.value,
+                             table.c.kind).where(
+                self._match(table, chunk), table.c.expiration > now)
+
+        results = {}
+        for rows in self._run(self._jobs(bundles, _select, "readslave")):
+            for row in rows:
+                results["%s-%s" % (row.category, row.ids)] = \
+                    self.tdb.db2py(row.value, row.kind)
+        return results
+
+    def get_multi(self, category, idses):
+        return self.get_many({category: idses})
+
+    def set_multi(self, bundles, time=0):
+        """{category: {ids: value}}，已存在的行被覆盖
+
+        每个chunk是一条 INSERT ... ON CONFLICT (category, ids) DO UPDATE。
+        """
+        expiration = self._expiration(time)
+
+        def _upsert(table, chunk):
+            stmt = pg_insert(table).values(
+                [self._row(category, ids, val, expiration)
+                 for category, (ids, val) in chunk])
+            return stmt.on_conflict_do_update(
+                index_elements=[table.c.category, table.c.ids],
+                set_=dict(value=stmt.excluded.value, kind=stmt.excluded.kind,
+                          expiration=stmt.excluded.expiration))
+
+        self._run(self._jobs(
+            dict((category, list(values.items()))
+                 for category, values in bundles.items()), _upsert))
+
+    def add_multi(self, bundles, time=0):
+        """{category: {ids: value}}，只写入不存在(或已过期)的行
+
+        返回没有写入的键 ["category-ids", ...]。
+        """
+        expiration = self._expiration(time)
+        now = datetime.now(self.tz)
+
+        def _add(table, chunk):
+            stmt = pg_insert(table).values(
+                [self._row(category, ids, val, expiration)
+                 for category, (ids, val) in chunk])
+            # 过期的行还没有被清理时也可以覆盖
+            return stmt.on_conflict_do_update(
+                index_elements=[table.c.category, table.c.ids],
+                set_=dict(value=stmt.excluded.value, kind=stmt.excluded.kind,
+                          expiration=stmt.excluded.expiration),
+                where=table.c.expiration <= now,
+            ).returning(table.c.category, table.c.ids)
+
+        added = set()
+        for rows in self._run(self._jobs(
+                dict((category, list(values.items()))
+                     for category, values in bundles.items()), _add)):
+            added.update((row.category, row.ids) for row in rows)
+        return ["%s-%s" % (category, ids)
+                for category, values in bundles.items()
+                for ids in values if (category, str(ids)) not in added]
+
+    def delete_multi(self, bundles):
+        """{category: [ids, ...]}"""
+        def _delete(table, chunk):
+            return table.delete().where(self._match(table, chunk))
+
+        self._run(self._jobs(bundles, _delete))
+
+    def incr_multi(self, bundles):
+        """{category: {ids: delta}}，返回 {"category-ids": 新的值}
+
+        每个chunk是一条 UPDATE ... FROM (VALUES ...)，不存在、已过期或不是
+        整数的键被跳过。
+        """
+        now = datetime.now(self.tz)
+
+        def _incr(table, chunk):
+            deltas = sa.values(sa.column('category', sa.String),
+                               sa.column('ids', sa.String),
+                               sa.column('delta', sa.BigInteger),
+                               name='deltas').data(
+                [(category, str(ids), delta)
+                 for category, (ids, delta) in chunk])
+            return table.update().where(
+                table.c.category == deltas.c.category,
+                table.c.ids == deltas.c.ids,
+                table.c.kind == 'num',
+                table.c.value.op('~')(r'^-?[0-9]+$'),
+                table.c.expiration > now,
+            ).values(
+                value=sa.cast(sa.cast(table.c.value, sa.BigInteger) +
+                              deltas.c.delta, sa.String),
+            ).returning(table.c.category, table.c.ids, table.c.value)
+
+        results = {}
+        for rows in self._run(self._jobs(
+                dict((category, list(deltas.items()))
+                     for category, deltas in bundles.items()), _incr)):
+            for row in rows:
+                results["%s-%s" % (row.category, row.ids)] = int(row.value)
+        return results
+
+    def _execute(self, table, statement):
+        engine = table.metadata.info['engine']
+        with engine.begin() as conn:
+            return conn.execute(statement).fetchall()
+
+    def get(self, category, ids, force_write_table=False):
+        table = self.engine_by_category(
+            category, "master" if force_write_table else "readslave")
+        rows = self._execute(table, sa.select(table.c.value, table.c.kind).where(
+            table.c.category == category, table.c.ids == str(ids),
+            table.c.expiration > datetime.now(self.tz)).limit(1))
+        if not rows:
+            return None
+        return self.tdb.db2py(rows[0].value, rows[0].kind)
+
+    def set(self, category, ids, val, time=0):
+        self.set_multi({category: {ids: val}}, time=time)
+
+    def add(self, category, ids, val, time=0):
+        """写入不存在(或已过期)的键并返回val，键已存在时返回已有的值"""
+        if self.add_multi({category: {ids: val}}, time=time):
+            return self.get(category, ids, force_write_table=True)
+        return val
+
+    def incr(self, category, ids, delta=1, time=0):
+        """原子地给整数值加上delta，返回新的值；time不为0时同时更新过期时间"""
+        table = self.engine_by_category(category)
+        now = datetime.now(self.tz)
+        values = dict(value=sa.cast(sa.cast(table.c.value, sa.BigInteger) +
+                                    delta, sa.String))
+        if time:
+            values['expiration'] = self._expiration(time)
+        rows = self._execute(table, table.update().where(
+            table.c.category == category,
+            table.c.ids == str(ids),
+            table.c.kind == 'num',
+            table.c.value.op('~')(r'^-?[0-9]+$'),
+            table.c.expiration > now,
+        ).values(**values).returning(table.c.value))
+        if not rows:
+            raise ValueError("[%s][%s] can't be incr()ed -- it's not set "
+                             "or not an integer" % (category, ids))
+        return int(rows[0].value)
+
+    def delete(self, category, ids):
+        self.delete_multi({category: [ids]})
+
+    def clean_expired(self, batch_size=None, limit=0):
+        """删除所有主库上已过期的行，返回删除的行数
+
+        每批最多batch_size行、一个事务：按expiration索引找到最早过期的行，
+        SKIP LOCKED 跳过其他进程正在清理或更新的行，避免长时间的锁和大事务。
+        limit不为0时最多删除limit行。
+        """
+        batch_size = batch_size or self.sweep_batch
+        masters = set(tables[0] for tables in self.mapping.values())
+        deleted = 0
+        for table in masters:
+            while not limit or deleted < limit:
+                n = batch_size if not limit else min(batch_size,
+                                                     limit - deleted)
+                expired = sa.select(table.c.category, table.c.ids).where(
+                    table.c.expiration <= datetime.now(self.tz),
+                ).order_by(table.c.expiration).limit(n).with_for_update(
+                    skip_locked=True)
+                rows = self._execute(table, table.delete().where(
+                    sa.tuple_(table.c.category, table.c.ids).in_(expired),
+                ).returning(table.c.ids))
+                deleted += len(rows)
+                if len(rows) < n or self._sweeper_stop.is_set():
+                    break
+        return deleted
+
+    def _sweep(self):
+        while not self._sweeper_stop.wait(self.sweep_interval):
+            try:
+                deleted = self.clean_expired()
+                if deleted:
+                    logger.info("hardcache: deleted %d expired rows", deleted)
+            except Exception:
+                # 数据库暂时不可用时下一轮再试
+                logger.exception("hardcache: clean_expired failed")
+
+    def start_sweeper(self, interval=None):
+        """在后台线程中定期调用clean_expired()
+
+        不会自动启动：所有进程共用同一批主库，只需要在一个进程中(如一个专门的
+        后台任务)启动，或者由定时任务直接调用clean_expired()。
+        """
+        if interval is not None:
+            self.sweep_interval = interval
+        if self.sweep_interval <= 0:
+            raise ValueError("sweep interval must be positive")
+        with self._sweeper_lock:
+            if self._sweeper is not None and self._sweeper.is_alive():
+                return
+            self._sweeper_stop.clear()
+            self._sweeper = Thread(target=self._sweep, name='hardcache-sweeper')
+            self._sweeper.daemon = True
+            self._sweeper.start()
+
+    def stop_sweeper(self, timeout=None):
+        self._sweeper_stop.set()
+        with self._sweeper_lock:
+            if self._sweeper is not None:
+                self._sweeper.join(timeout)
+                self._sweeper = None
@@ -42,12 +42,13 @@ def profile(fn):
     return _fn
 
 
-# 使用装饰器
-@profile
-def my_function():
-    # 在这里编写需要性能分析的代码
-    for i in range(10000):
-        _ = [j for j in range(i)]
-
-# 调用函数，触发性能分析
-my_function()
\ No newline at end of file
+if __name__ == '__main__':
+    # 使用装饰器
+    @profile
+    def my_function():
+        # 在这里编写需要性能分析的代码
+        for i in range(10000):
+            _ = [j for j in range(i)]
+
+    # 调用函数，触发性能分析
+    my_function()
@@ -0,0 +1,389 @@
+"""基于AMQP的RPC
+
+服务端从一个队列中取请求，交给线程池/进程池中的handler并发处理，再把结果发回
+请求中的reply_to：
+
+    server = RpcServer('rpc_queue', fib, concurrency=8, pool='process')
+    server.serve()
+
+客户端使用RabbitMQ的direct reply-to(不需要声明回复队列)，按correlation_id把回复
+对应到等待中的Future，每次调用可以有自己的超时时间：
+
+    client = RpcClient('rpc_queue')
+    client.call(30, timeout=5)                 # 阻塞等待结果
+    future = client.call_async(30, timeout=5)  # concurrent.futures.Future
+
+相同的请求(消息体和编码相同)正在处理时，服务端和客户端都不会重复处理/发送，而是
+等同一个结果；服务端还可以把结果缓存memo_ttl秒。
+
+请求和结果按 utils.serializers 编码，编码方式记录在消息头中；codec为None时
+请求和结果都是原始的字节串(结果为str时按utf-8编码)。
+"""
+import heapq
+import time
+import uuid
+from collections import deque, OrderedDict
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from functools import partial
+from threading import Event, Lock, Thread
+
+import pika
+import pika.exceptions
+
+import amqp
+from utils import serializers
+
+# RabbitMQ的direct reply-to伪队列
+REPLY_TO = 'amq.rabbitmq.reply-to'
+# 服务端处理出错时，回复的消息头中记录异常
+ERROR_HEADER = 'x-rpc-error'
+# 客户端不再等待回复的时间(毫秒时间戳)，服务端跳过已经过期的请求
+DEADLINE_HEADER = 'x-rpc-deadline'
+
+
+class RpcError(Exception):
+    """服务端处理请求时出错，或者等待回复时连接断开"""
+
+
+class RpcTimeout(RpcError):
+    """超时时间内没有收到回复"""
+
+
+def _encode(obj, codec):
+    if codec is None:
+        if isinstance(obj, str):
+            obj = obj.encode('utf-8')
+        return obj, {}
+    return serializers.encode(obj, codec=codec)
+
+
+def _request_key(body, headers):
+    """判断两个请求是否相同：消息体和编码方式都相同"""
+    return (body, headers.get(serializers.CODEC_HEADER),
+            headers.get(serializers.COMPRESSION_HEADER))
+
+
+class RpcServer(object):
+    """RPC服务端
+
+    handler(request) 返回结果，在有concurrency个worker的线程池/进程池中执行
+    (进程池要求handler可以被pickle)。连接上的操作都在调用serve()的线程中进行，
+    worker完成后通过 add_callback_threadsafe 把回复交回这个线程发送并确认请求。
+    """
+
+    def __init__(self, queue, handler, concurrency=8, pool='thread',
+                 prefetch_count=None, coalesce=True, memo_ttl=0,
+                 memo_size=10000, codec='json'):
+        if pool == 'thread':
+            self.executor = ThreadPoolExecutor(max_workers=concurrency)
+        elif pool == 'process':
+            self.executor = ProcessPoolExecutor(max_workers=concurrency)
+        else:
+            raise ValueError("unknown pool %r" % (pool,))
+
+        self.queue = queue
+        self.handler = handler
+        self.prefetch_count = prefetch_count or concurrency * 2
+        self.coalesce = coalesce
+        self.memo_ttl = memo_ttl
+        self.memo_size = memo_size
+        # 请求没有记录编码方式时，回复使用的编码
+        self.codec = codec
+        # 以下只在连接线程上访问
+        # 请求key -> 等待这个结果的 [(reply_to, correlation_id, delivery_tag)]
+        self.inflight = {}
+        # 请求key -> (过期时间, body, headers)，按使用顺序排列
+        self.memo = OrderedDict()
+        self.connection = None
+        self.channel = None
+        self.stopping = False
+
+    def _memo_get(self, key):
+        entry = self.memo.get(key)
+        if entry is None:
+            return None
+        if entry[0] < time.time():
+            del self.memo[key]
+            return None
+        self.memo.move_to_end(key)
+        return entry[1:]
+
+    def _memo_set(self, key, body, headers):
+        self.memo[key] = (time.time() + self.memo_ttl, body, headers)
+        self.memo.move_to_end(key)
+        while len(self.memo) > self.memo_size:
+            self.memo.popitem(last=False)
+
+    def _on_request(self, ch, method, properties, body):
+        headers = properties.headers or {}
+        waiter = (properties.reply_to, properties.correlation_id,
+                  method.delivery_tag)
+
+        deadline = headers.get(DEADLINE_HEADER)
+        if deadline is not None and deadline < time.time() * 1000:
+            # 客户端已经不再等待这个结果
+            ch.basic_ack(delivery_tag=method.delivery_tag)
+            return
+
+        key = _request_key(body, headers)
+        cached = self._memo_get(key) if self.memo_ttl else None
+        if cached is not None:
+            self._reply(waiter, *cached)
+            return
+
+        if not self.coalesce:
+            # 不合并时每个请求单独处理
+            key = (key, method.delivery_tag)
+        elif key in self.inflight:
+            self.inflight[key].append(waiter)
+            return
+        self.inflight[key] = [waiter]
+
+        codec = headers.get(serializers.CODEC_HEADER) or self.codec
+        future = Future()
+        try:
+            request = serializers.decode(body, headers)
+        except Exception as e:
+            future.set_exception(e)
+            self._finish(key, codec, future)
+            return
+
+        future = self.executor.submit(self.handler, request)
+        future.add_done_callback(
+            partial(self._on_done, self.connection, key, codec))
+
+    def _on_done(self, connection, key, codec, future):
+        # 在worker线程中执行，回到连接线程发送回复
+        try:
+            connection.add_callback_threadsafe(
+                partial(self._finish, key, codec, future))
+        except pika.exceptions.AMQPError:
+            # 连接已经断开，请求没有被确认，broker会重新投递
+            pass
+
+    def _finish(self, key, codec, future):
+        error = future.exception()
+        if error is None:
+            try:
+                body, headers = _encode(future.result(), codec)
+            except Exception as e:
+                error = e
+        if error is not None:
+            print('rpc %s: error handling request (%r)' % (self.queue, error))
+            body, headers = b'', {ERROR_HEADER: repr(error)[:500]}
+        elif self.memo_ttl:
+            # 不合并时key带有delivery tag，缓存只按请求key
+            self._memo_set(key if self.coalesce else key[0], body, headers)
+
+        for waiter in self.inflight.pop(key, ()):
+            self._reply(waiter, body, headers)
+
+    def _reply(self, waiter, body, headers):
+        reply_to, correlation_id, delivery_tag = waiter
+        if reply_to:
+            self.channel.basic_publish(
+                exchange='', routing_key=reply_to, body=body,
+                properties=pika.BasicProperties(correlation_id=correlation_id,
+                                                headers=headers))
+        self.channel.basic_ack(delivery_tag=delivery_tag)
+
+    def serve(self):
+        """处理请求直到stop()；连接断开后重新连接"""
+        self.stopping = False
+        while not self.stopping:
+            self.inflight = {}
+            self.connection = amqp._connect()
+            self.channel = self.connection.channel()
+            self.channel.queue_declare(queue=self.queue)
+            self.channel.basic_qos(prefetch_count=self.prefetch_count)
+            self.channel.basic_consume(queue=self.queue,
+                                       on_message_callback=self._on_request)
+            if self.stopping:
+                # stop()在连接建立期间被调用，它安排的stop_consuming可能已经
+                # 在start_consuming之前执行过了
+                break
+            try:
+                self.channel.start_consuming()
+            except pika.exceptions.AMQPConnectionError as e:
+                print('rpc %s: connection lost (%r), reconnecting'
+                      % (self.queue, e))
+                self.connection = self.channel = None
+
+        if self.connection is not None and self.connection.is_open:
+            self.connection.close()
+        self.executor.shutdown(wait=True)
+
+    def stop(self):
+        """可以在其他线程中调用，让serve()返回
+
+        serve()还没有连上或者正在重新连接时，它会在连接建立后检查stopping并返回。
+        """
+        self.stopping = True
+        connection, channel = self.connection, self.channel
+        if connection is None or channel is None:
+            return
+        try:
+            connection.add_callback_threadsafe(channel.stop_consuming)
+        except pika.exceptions.AMQPError:
+            # 连接已经断开，serve()正在重新连接
+            pass
+
+
+class RpcClient(object):
+    """RPC客户端，可以被多个线程同时使用
+
+    连接由客户端的一个后台线程独占：调用方线程只把请求放入待发送队列并唤醒它，
+    由它发布请求、接收回复、检查超时。Future的回调在这个后台线程中执行。
+    """
+
+    def __init__(self, queue, timeout=5.0, codec='json', coalesce=True):
+        self.queue = queue
+        self.timeout = timeout
+        self.codec = codec
+        self.coalesce = coalesce
+        self.lock = Lock()
+        # correlation_id -> (future, 请求key)
+        self.pending = {}
+        # 请求key -> future，相同的请求正在等待回复时直接共用
+        self.inflight = {}
+        # 待发送的 (correlation_id, body, headers, deadline)
+        self.outbox = deque()
+        # 只在后台线程上访问：(deadline, correlation_id) 堆
+        self.deadlines = []
+        self.connection = None
+        self.channel = None
+        self.closed = Event()
+        self.thread = Thread(target=self._run, name='rpc-client-' + queue)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def call_async(self, request, timeout=None):
+        """发送请求，返回在收到回复(或者超时、出错)时完成的Future"""
+        if self.closed.is_set():
+            raise RpcError("client is closed")
+        timeout = self.timeout if timeout is None else timeout
+        body, headers = _encode(request, self.codec)
+        key = _request_key(body, headers)
+
+        with self.lock:
+            if self.coalesce and key in self.inflight:
+                return self.inflight[key]
+            future = Future()
+            correlation_id = uuid.uuid4().hex
+            self.pending[correlation_id] = (future, key)
+            if self.coalesce:
+                self.inflight[key] = future
+
+        self.outbox.append((correlation_id, body, headers,
+                            time.time() + timeout))
+        self._wake()
+        return future
+
+    def call(self, request, timeout=None):
+        """发送请求并等待结果；超时抛出RpcTimeout，服务端出错抛出RpcError"""
+        timeout = self.timeout if timeout is None else timeout
+        future = self.call_async(request, timeout)
+        try:
+            # 超时由后台线程处理，这里多等一会儿只是防止后台线程出问题时永远阻塞
+            return future.result(timeout + 1)
+        except FutureTimeoutError:
+            raise RpcTimeout("no reply within %.3fs" % timeout)
+
+    def _wake(self):
+        connection = self.connection
+        if connection is not None:
+            try:
+                connection.add_callback_threadsafe(amqp._noop)
+            except pika.exceptions.AMQPError:
+                pass
+
+    def _pop(self, correlation_id):
+        with self.lock:
+            entry = self.pending.pop(correlation_id, None)
+            if entry is not None and self.inflight.get(entry[1]) is entry[0]:
+                del self.inflight[entry[1]]
+        return entry
+
+    def _on_reply(self, ch, method, properties, body):
+        entry = self._pop(properties.correlation_id)
+        if entry is None:
+            # 已经超时的请求的回复
+            return
+        future = entry[0]
+        headers = properties.headers or {}
+        if ERROR_HEADER in headers:
+            future.set_exception(RpcError(headers[ERROR_HEADER]))
+            return
+        try:
+            result = serializers.decode(body, headers)
+        except Exception as e:
+            future.set_exception(e)
+        else:
+            future.set_result(result)
+
+    def _send_outbox(self):
+        while self.outbox:
+            correlation_id, body, headers, deadline = self.outbox.popleft()
+            remaining = deadline - time.time()
+            if remaining <= 0 or correlation_id not in self.pending:
+                heapq.heappush(self.deadlines, (deadline, correlation_id))
+                continue
+
+            headers = dict(headers)
+            headers[DEADLINE_HEADER] = int(deadline * 1000)
+            properties = pika.BasicProperties(
+                reply_to=REPLY_TO, correlation_id=correlation_id,
+                headers=headers,
+                # 客户端不再等待时，请求在队列中过期，不再占用服务端
+                expiration=str(max(1, int(remaining * 1000))))
+            self.channel.basic_publish(exchange='', routing_key=self.queue,
+                                       body=body, properties=properties)
+            heapq.heappush(self.deadlines, (deadline, correlation_id))
+
+    def _expire(self):
+        now = time.time()
+        while self.deadlines and self.deadlines[0][0] <= now:
+            _, correlation_id = heapq.heappop(self.deadlines)
+            entry = self._pop(correlation_id)
+            if entry is not None:
+                entry[0].set_exception(RpcTimeout("no reply from %s" % self.queue))
+
+    def _fail_all(self, error):
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            self.inflight = {}
+        self.deadlines = []
+        for future, _ in pending.values():
+            future.set_exception(error)
+
+    def _run(self):
+        while not self.closed.is_set():
+            try:
+                self.connection = amqp._connect()
+                self.channel = self.connection.channel()
+                # direct reply-to 要求自动确认
+                self.channel.basic_consume(queue=REPLY_TO,
+                                           on_message_callback=self._on_reply,
+                                           auto_ack=True)
+                while not self.closed.is_set():
+                    self._send_outbox()
+                    self._expire()
+                    wait = 1.0
+                    if self.deadlines:
+                        wait = min(wait, max(0, self.deadlines[0][0] - time.time()))
+                    self.connection.process_data_events(time_limit=wait)
+            except pika.exceptions.AMQPError as e:
+                print('rpc client %s: connection lost (%r)' % (self.queue, e))
+                # 旧连接上的请求收不到回复了
+                self._fail_all(RpcError("connection lost: %r" % (e,)))
+                self.connection = None
+
+        self._fail_all(RpcError("client is closed"))
+        if self.connection and self.connection.is_open:
+            self.connection.close()
+
+    def close(self):
+        self.closed.set()
+        self._wake()
+        self.thread.join()
@@ -2,14 +2,12 @@
 # @Time    : 2023/11/17 14:43
 # @Comment :
 # !/usr/bin/env python
-import pika
+"""计算斐波那契数的RPC服务
 
-connection = pika.BlockingConnection(
-    pika.ConnectionParameters(host='localhost'))
-
-channel = connection.channel()
-
-channel.queue_declare(queue='rpc_queue')
+请求和回复都是字符串形式的数字，与 RabbitMQ 教程中的客户端兼容。计算在进程池中
+进行，相同的n正在计算时不会重复计算，结果缓存60秒。
+"""
+from rpc import RpcServer
 
 
 def fib(n):
@@ -21,22 +19,15 @@ def fib(n):
         return fib(n - 1) + fib(n - 2)
 
 
-def on_request(ch, method, props, body):
+def on_request(body):
     n = int(body)
 
     print(f" [.] fib({n})")
-    response = fib(n)
-
-    ch.basic_publish(exchange='',
-                     routing_key=props.reply_to,
-                     properties=pika.BasicProperties(correlation_id= \
-                                                         props.correlation_id),
-                     body=str(response))
-    ch.basic_ack(delivery_tag=method.delivery_tag)
-
+    return str(fib(n))
 
-channel.basic_qos(prefetch_count=1)
-channel.basic_consume(queue='rpc_queue', on_message_callback=on_request)
 
-print(" [x] Awaiting RPC requests")
-channel.start_consuming()
+if __name__ == '__main__':
+    server = RpcServer('rpc_queue', on_request, concurrency=4, pool='process',
+                       memo_ttl=60, codec=None)
+    print(" [x] Awaiting RPC requests")
+    server.serve()
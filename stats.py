@@ -208,6 +208,22 @@ class CountingStatBuffer:
             yield k, str(v) + '|c'
 
 
+class GaugeStatBuffer:
+    """Dictionary of keys to the most recently sampled value."""
+    """用于记录瞬时值(如队列长度)的类，同一个键只保留最后一次的值。"""
+
+    def __init__(self):
+        self.data = {}
+
+    def record(self, key, value):
+        self.data[key] = value
+
+    def flush(self):
+        data, self.data = self.data, {}
+        for k, v in data.items():
+            yield k, str(v) + '|g'
+
+
 class StringCountBuffer:
     """Dictionary of keys to counts of various values."""
     """用于存储和管理各种字符串值计数的类。"""
@@ -251,6 +267,7 @@ class StatsdClient:
         self.timing_stats = TimingStatBuffer()  # 用于存储和管理时间统计信息的类。它累积不同键的时间值和计数。
         self.counting_stats = CountingStatBuffer()
         self.string_counts = StringCountBuffer()
+        self.gauges = GaugeStatBuffer()
         self.connect(addr)
 
     def connect(self, addr):
@@ -263,6 +280,7 @@ class StatsdClient:
         data = list(self.timing_stats.flush())
         data.extend(self.counting_stats.flush())
         data.extend(self.string_counts.flush())
+        data.extend(self.gauges.flush())
         self.conn.send(self._data_iterator(data))
 
 
@@ -351,7 +369,7 @@ class Stats:
             sample_rate = self.CACHE_SAMPLE_RATE
         counter = self.get_counter('cache')
         if counter and random.random() < sample_rate:
-            for name, delta in data.iteritems():
+            for name, delta in data.items():
                 counter.increment(name, delta=delta)
 
     def amqp_processor(self, queue_name):
@@ -379,6 +397,22 @@ class Stats:
 
         return decorator
 
+    def amqp_event(self, queue_name, name, delta=1):
+        """记录队列上的事件数(如 queue_put / ack / reject)，statsd据此计算速率"""
+        counter = self.get_counter('amqp.' + queue_name)
+        if counter:
+            counter.increment(name, delta=delta)
+
+    def amqp_message_age(self, queue_name, published_at, now=None):
+        """记录一条消息从发布到被处理完经过的时间"""
+        if now is None:
+            now = time.time()
+        key = 'amqp.%s.age' % queue_name
+        self.client.timing_stats.record(key, published_at, now)
+
+    def gauge(self, name, value):
+        self.client.gauges.record(name, value)
+
     def flush(self):
         self.client.flush()
 
@@ -20,16 +20,19 @@
 # Inc. All Rights Reserved.
 ###############################################################################
 
+import pickle
+
 import sqlalchemy as sa
-import cPickle as pickle
 
 class tdb_lite(object):
     def __init__(self, gc):
         self.gc = gc
 
     def make_metadata(self, engine):
-        metadata = sa.MetaData(engine)
-        metadata.bind.echo = self.gc.sqlprinting
+        # SQLAlchemy 2 no longer binds metadata to an engine, so keep it in
+        # info for create_table and callers that need to execute statements
+        metadata = sa.MetaData(info={'engine': engine})
+        engine.echo = getattr(self.gc, 'sqlprinting', False)
         return metadata
 
     def index_str(self, table, name, on, where = None):
@@ -42,27 +45,30 @@ class tdb_lite(object):
 
     def create_table(self, table, index_commands=None):
         t = table
-        if self.gc.db_create_tables:
+        if getattr(self.gc, 'db_create_tables', False):
+            engine = t.metadata.info['engine']
             #@@hackish?
-            if not t.bind.has_table(t.name):
-                t.create(checkfirst = False)
-                if index_commands:
-                    for i in index_commands:
-                        t.bind.execute(i)
+            if not sa.inspect(engine).has_table(t.name):
+                with engine.begin() as conn:
+                    t.create(conn, checkfirst = False)
+                    if index_commands:
+                        for i in index_commands:
+                            conn.execute(sa.text(i))
 
     def py2db(self, val, return_kind=False):
         if isinstance(val, bool):
             val = 't' if val else 'f'
             kind = 'bool'
-        elif isinstance(val, (str, unicode)):
+        elif isinstance(val, str):
             kind = 'str'
-        elif isinstance(val, (int, float, long)):
+        elif isinstance(val, (int, float)):
             kind = 'num'
         elif val is None:
             kind = 'none'
         else:
             kind = 'pickle'
-            val = pickle.dumps(val)
+            # protocol 0 is ascii, as the rows written by python 2 were
+            val = pickle.dumps(val, 0).decode('latin-1')
 
         if return_kind:
             return (val, kind)
@@ -71,7 +77,7 @@ class tdb_lite(object):
 
     def db2py(self, val, kind):
         if kind == 'bool':
-            val = True if val is 't' else False
+            val = True if val == 't' else False
         elif kind == 'num':
             try:
                 val = int(val)
@@ -80,6 +86,6 @@ class tdb_lite(object):
         elif kind == 'none':
             val = None
         elif kind == 'pickle':
-            val = pickle.loads(val)
+            val = pickle.loads(val.encode('latin-1'))
 
         return val
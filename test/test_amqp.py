@@ -0,0 +1,171 @@
+"""amqp.py 的回归测试，broker使用 benchmarks/fake_broker.py 中的进程内替身
+
+    python -m pytest test/
+"""
+import os
+import pickle
+import time
+
+import pika.exceptions
+import pytest
+
+import amqp
+from benchmarks.fake_broker import FakeBroker
+from utils.journal import Journal
+
+QUEUE = 'vote_comment_q'
+
+
+@pytest.fixture
+def broker(tmp_path, monkeypatch):
+    monkeypatch.setattr(amqp.cfg, 'amqp_spill_dir', str(tmp_path / 'spill'))
+    monkeypatch.setattr(amqp.cfg, 'amqp_reconnect_base_delay', 0.01)
+    monkeypatch.setattr(amqp.cfg, 'amqp_reconnect_max_delay', 0.05)
+    monkeypatch.setattr(amqp, '_spill_journal', None)
+    broker = FakeBroker()
+    with broker.install():
+        yield broker
+
+
+def wait_until(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline, 'timed out'
+        time.sleep(0.01)
+
+
+def spilled_bodies(path):
+    """磁盘日志中所有记录的消息内容"""
+    bodies = []
+    for name in sorted(os.listdir(path)):
+        if not name.endswith('.log'):
+            continue
+        for data in Journal.read_segment(os.path.join(path, name)):
+            bodies.extend(pickle.loads(data)['bodies'])
+    return bodies
+
+
+def queued_bodies(broker, queue):
+    with broker.lock:
+        return [message.body for message in broker.queues[queue].messages]
+
+
+def test_publish_is_confirmed(broker):
+    sent = [b'm%d' % i for i in range(20)]
+    futures = [amqp.add_item(QUEUE, body) for body in sent[:10]]
+    futures += amqp.add_items(QUEUE, sent[10:])
+    results = [f.result(timeout=5) for f in futures]
+    assert all(isinstance(tag, int) for tag in results)
+    assert queued_bodies(broker, QUEUE) == sent
+
+
+def test_unroutable_publish_fails(broker):
+    future = amqp.add_item('no_such_queue', b'lost')
+    with pytest.raises(pika.exceptions.UnroutableError):
+        future.result(timeout=5)
+
+
+def test_handle_items_bisects_and_retries_failures(broker):
+    sent = [b'm%d' % i for i in range(10)]
+    sent[3] = b'bad'
+    amqp.add_items(QUEUE, sent)
+    amqp.get_worker().flush()
+
+    calls = []
+    handled = []
+
+    def callback(items, chan):
+        bodies = [body for _, _, body in items]
+        calls.append(bodies)
+        if b'bad' in bodies:
+            raise ValueError('bad message')
+        handled.extend(bodies)
+
+    amqp.handle_items(QUEUE, callback, limit=len(sent), drain=True)
+
+    # 整批失败后二分：其他消息都处理且只处理一次，只有坏消息进入重试队列
+    assert calls[0] == sent
+    assert sorted(handled) == sorted(set(sent) - {b'bad'})
+    assert broker.depth(QUEUE) == 0
+
+    q = amqp.cfg.queues.get(QUEUE)
+    retry_queue = q.retry_queue_name(q.retry.delay_for(1))
+    with broker.lock:
+        retried = list(broker.queues[retry_queue].messages)
+    assert [m.body for m in retried] == [b'bad']
+    assert retried[0].properties.headers[amqp.ATTEMPTS_HEADER] == 1
+
+
+def test_dedup_queue(broker):
+    sent = [b'm%d' % (i % 5) for i in range(20)]
+    amqp.add_items(QUEUE, sent)
+    amqp.get_worker().flush()
+
+    assert amqp.dedup_queue(QUEUE) == 5
+    assert sorted(queued_bodies(broker, QUEUE)) == sorted(set(sent))
+
+
+def test_publish_during_outage_is_spilled_and_replayed(broker):
+    broker.stop()
+    first = amqp.add_item(QUEUE, b'first')
+    # 发布线程连接失败后，新的消息直接写入磁盘，不再进入发布队列
+    wait_until(lambda: not amqp.broker_available.is_set())
+    sent = [b'm%d' % i for i in range(10)]
+    futures = amqp.add_items(QUEUE, sent)
+    assert [f.result(timeout=1) for f in futures] == [amqp.Spilled] * len(sent)
+    assert spilled_bodies(amqp.cfg.amqp_spill_dir) == sent
+
+    # 重新连上后发出积压的消息，并重新发布磁盘日志
+    broker.start()
+    assert first.result(timeout=5) is not amqp.Spilled
+    wait_until(lambda: broker.depth(QUEUE) == len(sent) + 1)
+    wait_until(lambda: not spilled_bodies(amqp.cfg.amqp_spill_dir))
+
+
+def test_close_with_broker_down_loses_nothing(broker, monkeypatch):
+    # 确认在发布之后才到达，broker停止时这批消息已经发出但没有被确认
+    broker.rtt = 0.2
+    pool = amqp.get_worker()
+    sent = [b'a%d' % i for i in range(50)]
+    futures = amqp.add_items(QUEUE, sent)
+    wait_until(lambda: broker.published >= len(sent))
+    broker.stop()
+
+    # 发布线程卡在重连中：这些消息留在队列里，或者直接写入磁盘
+    late = [b'b%d' % i for i in range(10)]
+    futures += [amqp.add_item(QUEUE, body) for body in late]
+    sent += late
+
+    assert not amqp.close(timeout=0.5)
+    assert all(f.done() and f.exception() is None for f in futures)
+
+    # 每条消息要么已被broker确认，要么在磁盘日志中
+    confirmed = set(body for body, f in zip(sent, futures)
+                    if f.result() is not amqp.Spilled)
+    spilled = set(spilled_bodies(amqp.cfg.amqp_spill_dir))
+    assert spilled == set(sent) - confirmed
+
+    # 让卡住的发布线程重新连上后退出，不再重新发布磁盘日志
+    monkeypatch.setattr(amqp.cfg, 'amqp_spill_dir', '')
+    amqp._spilled.clear()
+    broker.start()
+    for w in pool.workers:
+        w.t.join(5)
+        assert not w.t.is_alive()
+
+
+def test_handle_items_without_ack_leaves_acks_to_callback(broker):
+    sent = [b'm%d' % i for i in range(10)]
+    amqp.add_items(QUEUE, sent)
+    amqp.get_worker().flush()
+
+    # callback在handle_items返回之后才确认
+    handled = []
+    amqp.handle_items(QUEUE, lambda items, chan: handled.extend(items),
+                      ack=False, limit=len(sent), drain=True)
+    assert [body for _, _, body in handled] == sent
+
+    chan = amqp.get_connection_manager().get_channel()
+    for method, _, _ in handled:
+        chan.basic_ack(method.delivery_tag)
+    assert broker.depth(QUEUE) == 0
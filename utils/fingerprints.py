@@ -0,0 +1,114 @@
+__all__ = ["FingerprintSet", "BloomFilter"]
+
+import hashlib
+import math
+from array import array
+
+
+def _digest(data, size=8):
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    return int.from_bytes(hashlib.blake2b(data, digest_size=size).digest(),
+                          'little')
+
+
+class FingerprintSet(object):
+    """只保存64位摘要的集合
+
+    用开放寻址的 array('Q') 存放摘要，每个元素固定占8字节，与原始数据的大小无关；
+    两条不同的数据摘要相同的概率可以忽略不计。
+    """
+
+    MAX_LOAD = 0.7
+
+    def __init__(self, capacity=1024):
+        size = 1
+        while size * self.MAX_LOAD < capacity:
+            size *= 2
+        self.table = array('Q', bytes(8 * size))
+        self.mask = size - 1
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def _insert(self, fp):
+        i = fp & self.mask
+        while True:
+            slot = self.table[i]
+            if slot == 0:
+                self.table[i] = fp
+                self.count += 1
+                return True
+            if slot == fp:
+                return False
+            i = (i + 1) & self.mask
+
+    def _grow(self):
+        old = self.table
+        self.table = array('Q', bytes(16 * len(old)))
+        self.mask = len(self.table) - 1
+        self.count = 0
+        for fp in old:
+            if fp:
+                self._insert(fp)
+
+    def add(self, data):
+        """加入data，之前没有出现过时返回True"""
+        # 0表示空位
+        fp = _digest(data) or 1
+        if self.count + 1 > len(self.table) * self.MAX_LOAD:
+            self._grow()
+        return self._insert(fp)
+
+    def __contains__(self, data):
+        fp = _digest(data) or 1
+        i = fp & self.mask
+        while True:
+            slot = self.table[i]
+            if slot == 0:
+                return False
+            if slot == fp:
+                return True
+            i = (i + 1) & self.mask
+
+
+class BloomFilter(object):
+    """布隆过滤器
+
+    按预计元素数capacity和误判率error_rate分配位数组，内存占用约为
+    每个元素 -log2(error_rate) / ln(2) 位。误判时会把没出现过的数据当成重复的。
+    """
+
+    def __init__(self, capacity, error_rate=0.001):
+        capacity = max(1, capacity)
+        bits = -capacity * math.log(error_rate) / (math.log(2) ** 2)
+        self.size = max(8, int(math.ceil(bits)))
+        self.hashes = max(1, int(round(self.size / capacity * math.log(2))))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def _positions(self, data):
+        # 双重哈希：由一个128位摘要的两半生成k个位置
+        h = _digest(data, size=16)
+        h1, h2 = h & 0xFFFFFFFFFFFFFFFF, h >> 64
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, data):
+        """加入data，之前(可能)没有出现过时返回True"""
+        new = False
+        for pos in self._positions(data):
+            byte, bit = pos >> 3, 1 << (pos & 7)
+            if not self.bits[byte] & bit:
+                self.bits[byte] |= bit
+                new = True
+        if new:
+            self.count += 1
+        return new
+
+    def __contains__(self, data):
+        return all(self.bits[pos >> 3] & (1 << (pos & 7))
+                   for pos in self._positions(data))
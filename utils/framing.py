@@ -0,0 +1,72 @@
+__all__ = ["FRAMING_HEADER", "FRAMING_U32", "pack_records", "pack_bodies",
+           "iter_records", "count_records"]
+
+import struct
+
+# 消息头中记录分帧格式的字段；u32: 每条记录前是4字节大端序的长度
+FRAMING_HEADER = 'x-framing'
+FRAMING_U32 = 'u32'
+
+_LENGTH = struct.Struct('!I')
+MAX_RECORD_SIZE = 2 ** 32 - 1
+
+
+def pack_records(records):
+    """把多条记录(bytes)按长度前缀打包成一个消息体"""
+    parts = []
+    for record in records:
+        if len(record) > MAX_RECORD_SIZE:
+            raise ValueError("record too large (%d bytes)" % len(record))
+        parts.append(_LENGTH.pack(len(record)))
+        parts.append(record)
+    return b''.join(parts)
+
+
+def pack_bodies(records, max_body_size=64 * 1024, max_records=0):
+    """把记录打包成若干个消息体，每个不超过max_body_size字节、max_records条(0为不限制)
+
+    单条记录本身超过max_body_size时单独成为一个消息体。
+    """
+    batch = []
+    size = 0
+    for record in records:
+        framed = _LENGTH.size + len(record)
+        if batch and (size + framed > max_body_size or
+                      (max_records and len(batch) >= max_records)):
+            yield pack_records(batch)
+            batch, size = [], 0
+        batch.append(record)
+        size += framed
+    if batch:
+        yield pack_records(batch)
+
+
+def iter_records(body):
+    """逐条取出消息体中的记录，返回的是body的memoryview切片，不复制数据"""
+    view = memoryview(body)
+    offset = 0
+    end = len(view)
+    while offset < end:
+        if offset + _LENGTH.size > end:
+            raise ValueError("truncated record length at offset %d" % offset)
+        length, = _LENGTH.unpack_from(view, offset)
+        offset += _LENGTH.size
+        if offset + length > end:
+            raise ValueError("truncated record at offset %d (%d bytes, %d left)"
+                             % (offset, length, end - offset))
+        yield view[offset:offset + length]
+        offset += length
+
+
+def count_records(body):
+    """消息体中的记录数，只读取长度前缀"""
+    view = memoryview(body)
+    offset = 0
+    count = 0
+    while offset + _LENGTH.size <= len(view):
+        length, = _LENGTH.unpack_from(view, offset)
+        offset += _LENGTH.size + length
+        count += 1
+    if offset != len(view):
+        raise ValueError("truncated framed body")
+    return count
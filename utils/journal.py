@@ -0,0 +1,170 @@
+__all__ = ["Journal"]
+
+import fcntl
+import mmap
+import os
+import struct
+import tempfile
+import zlib
+from threading import Lock
+
+# 每条记录: 4字节长度 + 4字节crc32 + 数据，定长头部便于mmap后按偏移量顺序读取
+_HEADER = struct.Struct('>II')
+
+
+class Journal(object):
+    """只追加写的磁盘日志，按大小切分为多个段文件
+
+    写入总是追加到当前的活动段，活动段超过segment_size后封存，再开启新段。
+    读取只针对已封存的段，读完并处理好后由调用方删除。
+
+    同一个目录可以由多个进程共用：活动段在写入期间持有文件锁(flock)，
+    其他进程不会把它当作已封存的段；读取方用 claim() 锁住段后再读取和删除。
+    """
+
+    def __init__(self, path, prefix='journal', segment_size=64 * 1024 * 1024,
+                 fsync=False):
+        self.path = path
+        self.prefix = prefix
+        self.segment_size = segment_size
+        self.fsync = fsync
+        self.lock = Lock()
+        self.active = None
+        self.active_path = None
+
+        if not os.path.isdir(path):
+            os.makedirs(path, exist_ok=True)
+
+    def _segment_numbers(self):
+        numbers = []
+        for name in os.listdir(self.path):
+            head, _, tail = name.rpartition('.log')
+            if tail or not head.startswith(self.prefix + '.'):
+                continue
+            try:
+                numbers.append(int(head[len(self.prefix) + 1:]))
+            except ValueError:
+                pass
+        return sorted(numbers)
+
+    def _segment_path(self, number):
+        return os.path.join(self.path, '%s.%010d.log' % (self.prefix, number))
+
+    def _open_segment(self):
+        """新建一个活动段，返回 (文件, 路径)
+
+        先在临时文件上加锁，再用link取得一个没有被其他进程使用的编号，
+        这样段文件一出现就已经被锁住，不会被别的进程当作已封存的段读取。
+        新段的编号在现有的最大编号之后。
+        """
+        fd, tmp_path = tempfile.mkstemp(prefix='.%s.' % self.prefix,
+                                        suffix='.tmp', dir=self.path)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            while True:
+                numbers = self._segment_numbers()
+                path = self._segment_path(numbers[-1] + 1 if numbers else 0)
+                try:
+                    os.link(tmp_path, path)
+                    break
+                except FileExistsError:
+                    continue
+        except BaseException:
+            os.close(fd)
+            raise
+        finally:
+            os.unlink(tmp_path)
+        return os.fdopen(fd, 'ab'), path
+
+    def append(self, data):
+        """追加一条记录"""
+        record = _HEADER.pack(len(data), zlib.crc32(data)) + data
+        with self.lock:
+            if self.active is None:
+                self.active, self.active_path = self._open_segment()
+
+            self.active.write(record)
+            self.active.flush()
+            if self.fsync:
+                os.fsync(self.active.fileno())
+
+            if self.active.tell() >= self.segment_size:
+                self._seal()
+
+    def _seal(self):
+        if self.active is not None:
+            self.active.close()
+            self.active = None
+            self.active_path = None
+
+    def rotate(self):
+        """封存当前的活动段，之后的写入进入新段"""
+        with self.lock:
+            self._seal()
+
+    def sealed_segments(self):
+        """按写入顺序返回已封存的段文件，不包括任何进程正在写入或读取的段"""
+        with self.lock:
+            active = self.active_path
+        paths = []
+        for number in self._segment_numbers():
+            path = self._segment_path(number)
+            if path == active:
+                continue
+            segment = self.claim(path)
+            if segment is not None:
+                segment.close()
+                paths.append(path)
+        return paths
+
+    def claim(self, path):
+        """锁住一个已封存的段，返回持有锁的文件(读取和删除后关闭)
+
+        段正被其他进程写入或读取、或者已经被删除时返回None。
+        """
+        try:
+            f = open(path, 'rb')
+        except FileNotFoundError:
+            return None
+        try:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            # 等到锁时段可能已经被另一个读取方处理并删除了
+            if os.stat(path).st_ino != os.fstat(f.fileno()).st_ino:
+                raise FileNotFoundError(path)
+        except OSError:
+            f.close()
+            return None
+        return f
+
+    def __bool__(self):
+        return bool(self._segment_numbers())
+
+    @staticmethod
+    def read_segment(path):
+        """依次返回段文件中的记录
+
+        遇到被截断或校验失败的记录(如写入时进程崩溃)就停止读取该段。
+        """
+        with open(path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        try:
+            offset = 0
+            end = len(buf)
+            while offset + _HEADER.size <= end:
+                length, crc = _HEADER.unpack_from(buf, offset)
+                offset += _HEADER.size
+                if offset + length > end:
+                    break
+                data = buf[offset:offset + length]
+                if zlib.crc32(data) != crc:
+                    break
+                offset += length
+                yield data
+        finally:
+            buf.close()
+
+    def remove(self, path):
+        os.remove(path)
@@ -0,0 +1,226 @@
+__all__ = ["TokenBucket", "LaneQueue"]
+
+import time
+from collections import deque
+from queue import Empty, Full
+from threading import Condition, Lock
+
+
+class TokenBucket(object):
+    """令牌桶限速
+
+    每秒产生rate个令牌，最多积累burst个(默认为一秒的量)。可以被多个线程共用。
+    """
+
+    def __init__(self, rate, burst=None):
+        if rate <= 0:
+            raise ValueError("rate must be positive")
+        self.rate = float(rate)
+        self.burst = float(burst or rate)
+        self.tokens = self.burst
+        self.last = time.time()
+        self.lock = Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    def take(self, cost=1):
+        """取出cost个令牌，返回0；令牌不够时不取，返回还需要等待的秒数
+
+        cost大于burst时只要求桶是满的，取出后令牌数为负，之后的请求相应地多等待，
+        长期的平均速度仍然是rate。
+        """
+        with self.lock:
+            self._refill(time.time())
+            need = min(cost, self.burst)
+            if self.tokens >= need:
+                self.tokens -= cost
+                return 0
+            return (need - self.tokens) / self.rate
+
+    def refund(self, cost=1):
+        with self.lock:
+            self.tokens = min(self.burst, self.tokens + cost)
+
+
+class LaneQueue(object):
+    """按优先级分为多个通道(lane)的队列，接口与 queue.Queue 相同
+
+    lanes按优先级从高到低排列，get()总是先取优先级高的通道中最早的任务，同一个
+    通道内先进先出。通道或键(如路由键)可以设置令牌桶：队头任务的令牌不够时，
+    这个通道暂时跳过，优先级低的通道仍然可以被取出。maxsize 限制的是每个通道的
+    任务数(lane_maxsize可以为个别通道单独设置)，一个通道满了只会阻塞往这个通道
+    放入任务的调用方，大批量的低优先级任务不会占用高优先级通道的容量。
+
+    close()之后get()不再等待：没有可以取出的任务时立即抛出Empty。
+    """
+
+    def __init__(self, lanes, maxsize=0, lane_limits=None, key_limits=None,
+                 lane_maxsize=None):
+        self.lanes = list(lanes)
+        self.maxsize = maxsize
+        # 没有指定lane时使用中间的通道
+        self.default_lane = self.lanes[len(self.lanes) // 2]
+        # lane -> 最大任务数(0为不限制)
+        self.lane_maxsize = {lane: (lane_maxsize or {}).get(lane, maxsize)
+                             for lane in self.lanes}
+        # lane -> TokenBucket, key -> TokenBucket
+        self.lane_limits = lane_limits or {}
+        self.key_limits = key_limits or {}
+        # lane -> deque of (item, key, cost, 入队时间)
+        self.queues = {lane: deque() for lane in self.lanes}
+        self.size = 0
+        self.unfinished = 0
+        self.closed = False
+        self.mutex = Lock()
+        self.not_empty = Condition(self.mutex)
+        self.not_full = {lane: Condition(self.mutex) for lane in self.lanes}
+        self.all_done = Condition(self.mutex)
+        # 每个通道的统计：取出的任务数、代价(消息数)之和、排队时间之和、
+        # 被限速的次数、被丢弃的任务数
+        self.stats = {lane: {'items': 0, 'cost': 0, 'wait': 0.0, 'throttled': 0,
+                             'dropped': 0}
+                      for lane in self.lanes}
+
+    def qsize(self, lane=None):
+        with self.mutex:
+            if lane is None:
+                return self.size
+            return len(self.queues[lane])
+
+    def put(self, item, block=True, timeout=None, lane=None, key=None, cost=1):
+        if lane is None:
+            lane = self.default_lane
+        elif lane not in self.queues:
+            raise ValueError("unknown lane %r" % (lane,))
+
+        maxsize = self.lane_maxsize[lane]
+        with self.mutex:
+            if maxsize > 0:
+                deadline = None if timeout is None else time.time() + timeout
+                while len(self.queues[lane]) >= maxsize:
+                    if not block:
+                        raise Full
+                    remaining = None if deadline is None else deadline - time.time()
+                    if remaining is not None and remaining <= 0:
+                        raise Full
+                    self.not_full[lane].wait(remaining)
+
+            self.queues[lane].append((item, key, cost, time.time()))
+            self.size += 1
+            self.unfinished += 1
+            self.not_empty.notify()
+
+    def put_nowait(self, item, **kw):
+        return self.put(item, block=False, **kw)
+
+    def _take(self, lane, key, cost):
+        """取出通道和键的令牌，返回0或者还需要等待的秒数"""
+        lane_bucket = self.lane_limits.get(lane)
+        key_bucket = self.key_limits.get(key) if key is not None else None
+        delay = lane_bucket.take(cost) if lane_bucket else 0
+        if delay or not key_bucket:
+            return delay
+        delay = key_bucket.take(cost)
+        if delay and lane_bucket:
+            lane_bucket.refund(cost)
+        return delay
+
+    def _pop(self, lane):
+        item, key, cost, enqueued = self.queues[lane].popleft()
+        self.size -= 1
+        stats = self.stats[lane]
+        stats['items'] += 1
+        stats['cost'] += cost
+        stats['wait'] += time.time() - enqueued
+        self.not_full[lane].notify()
+        return item
+
+    def get(self, block=True, timeout=None):
+        with self.not_empty:
+            deadline = None if timeout is None else time.time() + timeout
+            while True:
+                wait = None
+                for lane in self.lanes:
+                    q = self.queues[lane]
+                    if not q:
+                        continue
+                    _, key, cost, _ = q[0]
+                    delay = self._take(lane, key, cost)
+                    if not delay:
+                        return self._pop(lane)
+                    self.stats[lane]['throttled'] += 1
+                    wait = delay if wait is None else min(wait, delay)
+
+                if not block or self.closed:
+                    raise Empty
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None:
+                    if remaining <= 0:
+                        raise Empty
+                    wait = remaining if wait is None else min(wait, remaining)
+                # 所有通道都空着或者被限速：等新任务，或者等到最早有令牌的时候
+                self.not_empty.wait(wait)
+
+    def get_nowait(self):
+        return self.get(block=False)
+
+    def drop_oldest(self, lane=None):
+        """不考虑限速，取出lane(默认为优先级最低的非空通道)中最早的任务
+
+        用于通道满时丢弃任务。
+        """
+        with self.mutex:
+            lanes = reversed(self.lanes) if lane is None else [lane]
+            for lane in lanes:
+                if self.queues[lane]:
+                    item = self.queues[lane].popleft()[0]
+                    self.size -= 1
+                    self.stats[lane]['dropped'] += 1
+                    self.not_full[lane].notify()
+                    return item
+        raise Empty
+
+    def task_done(self):
+        with self.all_done:
+            self.unfinished -= 1
+            if self.unfinished < 0:
+                raise ValueError('task_done() called too many times')
+            if self.unfinished == 0:
+                self.all_done.notify_all()
+
+    def join(self, timeout=None):
+        """等待所有任务完成，返回是否在timeout秒内全部完成"""
+        deadline = None if timeout is None else time.time() + timeout
+        with self.all_done:
+            while self.unfinished:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.all_done.wait(remaining)
+            return True
+
+    def close(self):
+        """唤醒所有等待中的get()，之后get()不再阻塞"""
+        with self.mutex:
+            self.closed = True
+            self.not_empty.notify_all()
+
+    def drain(self):
+        """不考虑限速，按优先级取出所有剩余的任务(未标记完成)"""
+        with self.mutex:
+            items = []
+            for lane in self.lanes:
+                items.extend(entry[0] for entry in self.queues[lane])
+                self.queues[lane].clear()
+            self.size = 0
+            for not_full in self.not_full.values():
+                not_full.notify_all()
+            return items
+
+    def lane_stats(self):
+        """每个通道当前的排队数以及累计的统计"""
+        with self.mutex:
+            return {lane: dict(self.stats[lane], depth=len(self.queues[lane]))
+                    for lane in self.lanes}
@@ -1,6 +1,10 @@
-__all__ = ["MessageQueue", "declare_queues"]
+__all__ = ["MessageQueue", "RetryPolicy", "ShardedQueueFamily", "declare_queues"]
 
-from utils import tup
+import bisect
+import hashlib
+import zlib
+
+from utils.utils import tup
 
 
 class Queues(dict):
@@ -10,11 +14,13 @@ class Queues(dict):
         dict.__init__(self)
         self.__dict__ = self
         self.bindings = set()
+        # 分片队列族，前缀 -> ShardedQueueFamily
+        self.shards = {}
         self.declare(queues)
 
     def __iter__(self):
         for name, queue in self.items():
-            if name != "bindings":
+            if isinstance(queue, MessageQueue):
                 yield queue
 
     def declare(self, queues):
@@ -25,6 +31,49 @@ class Queues(dict):
                 queue._bind(name)
         self.update(queues)
 
+    def fingerprint(self, exchange=''):
+        """队列定义和绑定的摘要，拓扑没有变化时摘要不变"""
+        spec = [exchange]
+        spec.extend(sorted((q.name, q.durable, q.exclusive, q.auto_delete,
+                            sorted((q.arguments or {}).items()))
+                           for q in self))
+        spec.extend(sorted(self.bindings))
+        return hashlib.sha1(repr(spec).encode('utf-8')).hexdigest()
+
+    @property
+    def persistent(self):
+        """所有队列都不会随连接消失(非排他、非自动删除)时为True"""
+        return not any(q.exclusive or q.auto_delete for q in self)
+
+    def declare_retry(self, name, policy):
+        """为队列name声明重试队列和死信队列
+
+        每个重试延迟对应一个队列 <name>_retry_<毫秒>，消息在其中等待x-message-ttl后
+        由broker经默认交换机投递回name；超过最大次数的消息进入 <name>_dead。
+        重试队列和死信队列不绑定路由键，由消费者通过默认交换机直接发布。
+        """
+        queue = self[name]
+        queue.retry = policy
+        extra = {}
+        for delay in policy.delays:
+            extra[queue.retry_queue_name(delay)] = MessageQueue(
+                durable=queue.durable,
+                arguments={
+                    'x-message-ttl': delay,
+                    'x-dead-letter-exchange': '',
+                    'x-dead-letter-routing-key': name,
+                })
+        extra[queue.dead_letter_name] = MessageQueue(durable=queue.durable)
+        self.declare(extra)
+
+    def declare_sharded(self, prefix, count, **queue_kw):
+        """声明count个分片队列 <prefix>_<i>_q，每个分片绑定到自身"""
+        family = ShardedQueueFamily(prefix, count)
+        self.declare({name: MessageQueue(bind_to_self=True, **queue_kw)
+                      for name in family.names})
+        self.shards[prefix] = family
+        return family
+
 
 class MessageQueue(object):
     """AMQP消息队列的表示
@@ -34,11 +83,20 @@ class MessageQueue(object):
     """
 
     def __init__(self, durable=True, exclusive=False,
-                 auto_delete=False, bind_to_self=False):
+                 auto_delete=False, bind_to_self=False, arguments=None):
         self.durable = durable  # 持久的
         self.exclusive = exclusive  # 排他性
         self.auto_delete = auto_delete  # 自动删除
         self.bind_to_self = bind_to_self  # 绑定到自身
+        self.arguments = arguments  # 声明队列时的参数，如 x-message-ttl
+        self.retry = None  # 消费失败时的重试策略(RetryPolicy)
+
+    def retry_queue_name(self, delay):
+        return "%s_retry_%d" % (self.name, delay)
+
+    @property
+    def dead_letter_name(self):
+        return "%s_dead" % self.name
 
     def _bind(self, routing_key):
         # print(f"ssss, {self},{self.name}", self.bindings)
@@ -49,30 +107,113 @@ class MessageQueue(object):
         << 运算符实际上调用了__lshift__,方法，这个方法接受一个或多个路由键，并将它们添加到队列的绑定中，以便队列可以接收来自这些路由键的消息。
         """
         routing_keys = tup(routing_keys)
-        print(routing_keys)
         for routing_key in routing_keys:
             self._bind(routing_key)
 
 
-def declare_queues():
+class RetryPolicy(object):
+    """消费失败的消息的重试策略
+
+    第n次失败后消息等待 delays[n-1] 毫秒(超出列表长度时使用最后一个)再重新投递，
+    失败max_attempts次后进入死信队列，不再重试。
+    """
+
+    def __init__(self, delays=(1000, 10000, 60000, 300000), max_attempts=5):
+        if not delays:
+            raise ValueError("retry policy needs at least one delay")
+        if max_attempts < 1:
+            raise ValueError("max_attempts must be at least 1")
+        self.delays = tuple(int(d) for d in delays)
+        self.max_attempts = max_attempts
+
+    def delay_for(self, attempts):
+        return self.delays[min(attempts, len(self.delays)) - 1]
+
+
+class ShardedQueueFamily(object):
+    """一组分片队列 <prefix>_0_q ... <prefix>_<count-1>_q
+
+    用一致性哈希把key映射到分片：同一个key总是进入同一个分片(保证顺序)，
+    分片数量变化时只有约 1/count 的key会换到别的分片。
+    """
+
+    def __init__(self, prefix, count, replicas=100):
+        if count < 1:
+            raise ValueError("shard count must be at least 1")
+        self.prefix = prefix
+        self.names = ["%s_%d_q" % (prefix, i) for i in range(count)]
+
+        # 每个分片在环上放replicas个虚拟节点，使key分布更均匀
+        ring = sorted((self._hash("%s#%d" % (name, r)), name)
+                      for name in self.names for r in range(replicas))
+        self._points = [point for point, _ in ring]
+        self._owners = [name for _, name in ring]
+
+    @staticmethod
+    def _hash(key):
+        if not isinstance(key, bytes):
+            key = str(key).encode('utf-8')
+        return zlib.crc32(key)
+
+    def __len__(self):
+        return len(self.names)
+
+    def shard_for(self, key):
+        """返回key所在分片的队列名(也是它的路由键)"""
+        i = bisect.bisect(self._points, self._hash(key)) % len(self._points)
+        return self._owners[i]
+
+
+def _config(g, name, default=None):
+    if g is None:
+        return default
+    if isinstance(g, dict):
+        value = g.get(name, default)
+    else:
+        value = getattr(g, name, default)
+    if isinstance(value, str) and value.lower() in ('true', 'false'):
+        value = value.lower() == 'true'
+    return value
+
+
+# 可以分片的队列族：前缀 -> 开关配置项
+SHARDABLE_QUEUES = {
+    "commentstree": "shard_commentstree_queues",
+    "author_query": "shard_author_query_queues",
+    "subreddit_query": "shard_subreddit_query_queues",
+    "domain_query": "shard_domain_query_queues",
+}
+
+
+def declare_queues(g=None):
     queues = Queues({
         "vote_comment_q": MessageQueue(bind_to_self=True),
         "newcomments_q": MessageQueue()
     })
 
-    # if g.shard_commentstree_queues:
-    #     sharded_commentstree_queues = {"commentstree_%d_q" % i:
-    #                                        MessageQueue(bind_to_self=True)
-    #                                    for i in range(10)}
-    #     queues.declare(sharded_commentstree_queues)
+    # 打开了 shard_<prefix>_queues 的队列族，按 <prefix>_shard_count (默认10) 声明分片
+    for prefix, switch in sorted(SHARDABLE_QUEUES.items()):
+        if _config(g, switch, False):
+            count = int(_config(g, prefix + "_shard_count", 10))
+            queues.declare_sharded(prefix, count)
 
     # 然后通过 << 过载操作符将路由键注册到队列的绑定中
     # queues.vote_comment_q << ("vote_comment_q_test",)
     queues.vote_comment_q << "vote_comment_q_test"
     queues.newcomments_q << ("new_link", "link_text_edited")
 
+    # 所有队列都使用同样的重试策略，由 amqp_retry_delays (毫秒, 逗号分隔) 和
+    # amqp_max_attempts 配置
+    delays = _config(g, "amqp_retry_delays", None)
+    if isinstance(delays, str):
+        delays = [int(d) for d in delays.split(',') if d.strip()]
+    policy = RetryPolicy(delays or RetryPolicy().delays,
+                         int(_config(g, "amqp_max_attempts", 5)))
+    for name in [queue.name for queue in queues]:
+        queues.declare_retry(name, policy)
+
     return queues
 
 
-queues = declare_queues()
-print(queues.bindings)
+if __name__ == '__main__':
+    print(declare_queues().bindings)
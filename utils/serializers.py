@@ -0,0 +1,80 @@
+__all__ = ["register_serializer", "register_compressor", "encode", "decode",
+           "CODEC_HEADER", "COMPRESSION_HEADER"]
+
+import json
+import pickle
+import zlib
+
+# 消息头中记录序列化方式和压缩方式的字段
+CODEC_HEADER = 'x-codec'
+COMPRESSION_HEADER = 'x-compression'
+
+_serializers = {}
+_compressors = {}
+
+
+def register_serializer(name, dumps, loads):
+    """注册一种序列化方式，dumps(obj) -> bytes, loads(bytes) -> obj"""
+    _serializers[name] = (dumps, loads)
+
+
+def register_compressor(name, compress, decompress):
+    _compressors[name] = (compress, decompress)
+
+
+register_serializer('pickle',
+                    lambda obj: pickle.dumps(obj, pickle.HIGHEST_PROTOCOL),
+                    pickle.loads)
+register_serializer('json',
+                    lambda obj: json.dumps(obj, separators=(',', ':')).encode('utf-8'),
+                    json.loads)
+register_compressor('zlib', lambda data: zlib.compress(data, 1), zlib.decompress)
+
+try:
+    import msgpack
+except ImportError:
+    pass
+else:
+    register_serializer('msgpack',
+                        lambda obj: msgpack.packb(obj, use_bin_type=True),
+                        lambda data: msgpack.unpackb(data, raw=False))
+
+try:
+    import lz4.frame
+except ImportError:
+    pass
+else:
+    register_compressor('lz4', lz4.frame.compress, lz4.frame.decompress)
+
+
+def encode(obj, codec='pickle', compression=None, compress_threshold=1024):
+    """序列化obj，返回 (body, headers)
+
+    序列化后的大小不小于compress_threshold时才压缩，headers中记录了解码需要的信息。
+    """
+    try:
+        dumps = _serializers[codec][0]
+    except KeyError:
+        raise ValueError("unknown codec %r" % (codec,))
+
+    body = dumps(obj)
+    headers = {CODEC_HEADER: codec}
+    if compression and len(body) >= compress_threshold:
+        try:
+            compress = _compressors[compression][0]
+        except KeyError:
+            raise ValueError("unknown compression %r" % (compression,))
+        body = compress(body)
+        headers[COMPRESSION_HEADER] = compression
+    return body, headers
+
+
+def decode(body, headers):
+    """按headers中记录的方式解码body；没有记录序列化方式时原样返回body"""
+    if not headers or CODEC_HEADER not in headers:
+        return body
+
+    compression = headers.get(COMPRESSION_HEADER)
+    if compression:
+        body = _compressors[compression][1](body)
+    return _serializers[headers[CODEC_HEADER]][1](body)
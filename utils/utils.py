@@ -10,3 +10,15 @@ def tup(item, ret_is_single=False):
         return (item, False) if ret_is_single else item
     else:
         return ((item,), True) if ret_is_single else (item,)
+
+
+def in_chunks(it, size=25):
+    """把可迭代对象按size个一组切分，逐组返回列表"""
+    chunk = []
+    for item in it:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk